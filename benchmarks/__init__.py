@@ -0,0 +1,6 @@
+"""
+Performance benchmarks for the chat server.
+
+Each module is runnable on its own, e.g. ``python -m benchmarks.fanout_encoding``,
+and accepts ``--json PATH`` to write machine-readable results.
+"""
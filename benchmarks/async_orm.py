@@ -0,0 +1,160 @@
+"""
+Connect and send throughput of the consumers' database access under concurrency.
+
+'sync' runs the same queries as before, each wrapped in
+database_sync_to_async (connection checks around each call, which with
+CONN_MAX_AGE=0 means reconnecting); 'async' is the async ORM path the
+consumers and middleware use now. Both end up on the one shared sync
+thread, so this measures what each hop costs rather than parallelism.
+
+- connect  a handshake with cold caches: load the user, load the room's
+           members, count and load the messages missed since the last visit
+- send     save a message and bump its room (CHAT_WRITE_BEHIND off)
+"""
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from benchmarks.common import argument_parser, emit, setup_django, summarize
+
+
+def sync_operations():
+    """The same queries as the consumers make, each in database_sync_to_async"""
+    from channels.db import database_sync_to_async
+    from django.conf import settings
+    from django.contrib.auth import get_user_model
+    from django.utils import timezone
+
+    from chat.cache import membership_cache
+    from chat.models import Message, Room
+
+    User = get_user_model()
+
+    @database_sync_to_async
+    def load_user(user_id):
+        return User.objects.filter(id=user_id, is_active=True).first()
+
+    @database_sync_to_async
+    def count_missed_messages(room_id, last_seen_id):
+        limit = settings.CHAT_SYNC_MAX_MESSAGES + 1
+        return Message.objects.filter(room_id=room_id, id__gt=last_seen_id).order_by('id').values('id')[:limit].count()
+
+    @database_sync_to_async
+    def load_messages_after(room_id, message_id, limit):
+        return list(
+            Message.objects.filter(room_id=room_id, id__gt=message_id).select_related('sender').order_by('id')[:limit]
+        )
+
+    @database_sync_to_async
+    def save_message(user, room_id, content):
+        # The same two queries as the async path, so only the hops differ
+        message = Message.objects.create(room_id=room_id, sender=user, content=content)
+        Room.objects.filter(pk=room_id).update(updated_at=timezone.now())
+        return message
+
+    return SimpleNamespace(
+        load_user=load_user,
+        load_members=database_sync_to_async(membership_cache.fill),
+        count_missed_messages=count_missed_messages,
+        load_messages_after=load_messages_after,
+        save_message=save_message,
+    )
+
+
+def async_operations():
+    from chat.cache import membership_cache
+    from chat.consumers import BaseChatConsumer
+    from chat.middleware import load_active_user
+
+    return SimpleNamespace(
+        load_user=load_active_user,
+        load_members=membership_cache.afill,
+        count_missed_messages=lambda room_id, last_seen_id: BaseChatConsumer.count_missed_messages(
+            None, room_id, last_seen_id
+        ),
+        load_messages_after=lambda room_id, message_id, limit: BaseChatConsumer.load_messages_after(
+            None, room_id, message_id, limit
+        ),
+        save_message=lambda user, room_id, content: BaseChatConsumer.save_message_now(
+            SimpleNamespace(user=user), room_id, content
+        ),
+    )
+
+
+async def drive(clients, operations, step):
+    """`clients` concurrent clients running `operations` steps each; (latencies, elapsed)"""
+    latencies = []
+
+    async def client(index):
+        for i in range(operations):
+            started = time.perf_counter()
+            await step(index, i)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[client(index) for index in range(clients)])
+    return latencies, time.perf_counter() - started
+
+
+def run(clients, operations, backlog):
+    from django.conf import settings
+    from django.contrib.auth import get_user_model
+
+    from chat.models import Message, Room
+
+    User = get_user_model()
+    users = User.objects.bulk_create([
+        User(email=f'orm{i}@example.com', username=f'orm{i}@example.com') for i in range(clients)
+    ])
+    rooms = []
+    for i, user in enumerate(users):
+        room = Room.objects.create(name=f'room {i}', created_by=user)
+        room.participants.add(user)
+        rooms.append(room)
+    last_seen = {}
+    for room, user in zip(rooms, users):
+        messages = Message.objects.bulk_create([
+            Message(room=room, sender=user, content=f'backlog {i}') for i in range(backlog)
+        ])
+        last_seen[room.id] = messages[0].id
+    chunk = settings.CHAT_SYNC_CHUNK_SIZE + 1
+
+    results = []
+    for mode, ops in (('sync', sync_operations()), ('async', async_operations())):
+        async def connect(index, _):
+            room_id = rooms[index].id
+            user = await ops.load_user(users[index].id)
+            assert user.id in await ops.load_members(room_id)
+            await ops.count_missed_messages(room_id, last_seen[room_id])
+            await ops.load_messages_after(room_id, last_seen[room_id], chunk)
+
+        async def send(index, i):
+            await ops.save_message(users[index], rooms[index].id, f'{mode} {i}')
+
+        for scenario, step in (('connect', connect), ('send', send)):
+            latencies, elapsed = asyncio.run(drive(clients, operations, step))
+            results.append({
+                'mode': mode,
+                'scenario': scenario,
+                'clients': clients,
+                'per_s': len(latencies) / elapsed,
+                **summarize(latencies),
+            })
+    return results
+
+
+def main():
+    parser = argument_parser(__doc__)
+    parser.add_argument('--clients', type=int, default=200, help="Concurrent clients")
+    parser.add_argument('--operations', type=int, default=20, help="Connects and sends per client")
+    parser.add_argument('--backlog', type=int, default=20, help="Missed messages per room on connect")
+    args = parser.parse_args()
+
+    setup_django(database_path=Path(tempfile.mkdtemp()) / 'bench.sqlite3', migrate=True)
+    emit('async_orm', run(args.clients, args.operations, args.backlog), args.json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+
+def setup_django(database_path=None, migrate=False):
+    """
+    Configures Django for a benchmark run, with the rate limits off unless
+    set in the environment. With `database_path` the run uses its own SQLite
+    file instead of the project database.
+    """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chat_app.settings')
+    # Benchmarks measure the server, not the rate limiter (chat/ratelimit.py)
+    for name in ('CHAT_MESSAGE_RATE_PER_USER', 'CHAT_MESSAGE_RATE_PER_ROOM', 'CHAT_TYPING_RATE_PER_USER'):
+        os.environ.setdefault(name, '0')
+    if database_path:
+        os.environ['DATABASE_PATH'] = str(database_path)
+
+    import django
+    django.setup()
+
+    if migrate:
+        from django.core.management import call_command
+        call_command('migrate', verbosity=0)
+
+
+def summarize(samples):
+    """Latency summary in milliseconds for a list of durations in seconds"""
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))] * 1000
+
+    return {
+        'count': len(ordered),
+        'mean_ms': statistics.fmean(ordered) * 1000,
+        'p50_ms': percentile(50),
+        'p95_ms': percentile(95),
+        'p99_ms': percentile(99),
+        'max_ms': ordered[-1] * 1000,
+    }
+
+
+def argument_parser(description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--json', metavar='PATH', help="Write results as JSON to PATH ('-' for stdout)")
+    return parser
+
+
+def emit(benchmark, results, json_path=None):
+    """Prints results and optionally writes them as JSON with run metadata"""
+    for row in results:
+        print('  '.join(f'{key}={format_value(value)}' for key, value in row.items()))
+
+    if json_path:
+        document = json.dumps({
+            'benchmark': benchmark,
+            'timestamp': time.time(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'results': results,
+        }, indent=2)
+        if json_path == '-':
+            print(document)
+        else:
+            with open(json_path, 'w') as f:
+                f.write(document)
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return f'{value:.3f}'
+    return str(value)
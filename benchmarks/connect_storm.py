@@ -0,0 +1,87 @@
+"""
+WebSocket handshake latency through JWTAuthMiddleware during a reconnect storm.
+
+Every client authenticates at once, as after a deploy. 'uncached' is the
+previous behaviour (a thread hop and a query per handshake); 'cold' is the
+cached resolver with an empty cache; 'warm' is a second storm right after.
+"""
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+from unittest import mock
+
+from benchmarks.common import argument_parser, emit, setup_django, summarize
+
+
+async def storm(tokens):
+    from chat.middleware import JWTAuthMiddleware
+
+    async def inner(scope, receive, send):
+        assert scope['user'].is_authenticated
+
+    middleware = JWTAuthMiddleware(inner)
+
+    async def handshake(token):
+        scope = {'type': 'websocket', 'query_string': f'token={token}'.encode(), 'headers': []}
+        started = time.perf_counter()
+        await middleware(scope, None, None)
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    latencies = await asyncio.gather(*[handshake(token) for token in tokens])
+    return latencies, time.perf_counter() - started
+
+
+def run(clients, users):
+    from channels.db import database_sync_to_async
+    from django.contrib.auth import get_user_model
+    from django.contrib.auth.models import AnonymousUser
+    from rest_framework_simplejwt.tokens import AccessToken
+
+    from chat.middleware import user_cache
+
+    User = get_user_model()
+    accounts = User.objects.bulk_create([
+        User(email=f'storm{i}@example.com', username=f'storm{i}@example.com') for i in range(users)
+    ])
+    tokens = [str(AccessToken.for_user(accounts[i % users])) for i in range(clients)]
+
+    @database_sync_to_async
+    def uncached_get_user_from_token(token_string):
+        try:
+            return User.objects.get(id=AccessToken(token_string)['user_id'])
+        except Exception:
+            return AnonymousUser()
+
+    results = []
+    for mode in ('uncached', 'cold', 'warm'):
+        if mode == 'cold':
+            user_cache.clear()
+        if mode == 'uncached':
+            with mock.patch('chat.middleware.get_user_from_token', uncached_get_user_from_token):
+                latencies, elapsed = asyncio.run(storm(tokens))
+        else:
+            latencies, elapsed = asyncio.run(storm(tokens))
+        results.append({
+            'mode': mode,
+            'clients': clients,
+            'users': users,
+            'handshakes_per_s': clients / elapsed,
+            **summarize(latencies),
+        })
+    return results
+
+
+def main():
+    parser = argument_parser(__doc__)
+    parser.add_argument('--clients', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=1000)
+    args = parser.parse_args()
+
+    setup_django(database_path=Path(tempfile.mkdtemp()) / 'bench.sqlite3', migrate=True)
+    emit('connect_storm', run(args.clients, args.users), args.json)
+
+
+if __name__ == '__main__':
+    main()
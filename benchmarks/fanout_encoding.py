@@ -0,0 +1,72 @@
+"""
+Fan-out CPU cost of broadcasting one chat message to a room group.
+
+before: the group event carries the message dict; the channel layer copies
+        it for every recipient and every recipient runs json.dumps on it.
+after:  the sender encodes the frame once and recipients forward the text.
+
+Channel layer bookkeeping is left out so the numbers isolate the encoding.
+"""
+import time
+from copy import deepcopy
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from benchmarks.common import argument_parser, emit
+from chat.frames import chat_message_frame, encode, serialize_message
+
+
+def sample_message():
+    sender = SimpleNamespace(id=42, email='sender@example.com', first_name='Ada', last_name='Lovelace')
+    return SimpleNamespace(
+        id=123456,
+        content='The quick brown fox jumps over the lazy dog. ' * 3,
+        sender=sender,
+        created_at=datetime.now(timezone.utc),
+    )
+
+
+def fanout(recipients, encode_once):
+    """
+    CPU seconds spent delivering one broadcast to `recipients` consumers:
+    the per-recipient copy the in-memory channel layer makes of the event,
+    plus the recipient's handler turning the event into a text frame.
+    """
+    message = sample_message()
+
+    started = time.process_time()
+    if encode_once:
+        event = {'type': 'chat_message', 'text': encode(chat_message_frame(1, message))}
+        for _ in range(recipients):
+            deepcopy(event)['text']
+    else:
+        event = {'type': 'chat_message', 'message': serialize_message(message)}
+        for _ in range(recipients):
+            received = deepcopy(event)
+            encode({'type': 'chat_message', 'message': received['message']})
+    return time.process_time() - started
+
+
+def run(sizes, repeat):
+    results = []
+    for recipients in sizes:
+        row = {'recipients': recipients}
+        for label, encode_once in (('before', False), ('after', True)):
+            timings = [fanout(recipients, encode_once) for _ in range(repeat)]
+            row[f'{label}_cpu_ms'] = min(timings) * 1000
+            row[f'{label}_us_per_recipient'] = min(timings) / recipients * 1e6
+        row['speedup'] = row['before_cpu_ms'] / row['after_cpu_ms']
+        results.append(row)
+    return results
+
+
+def main():
+    parser = argument_parser(__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    emit('fanout_encoding', run(args.sizes, args.repeat), args.json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,310 @@
+"""
+End-to-end load scenarios against the ASGI application, run in-process.
+
+Clients talk to `chat_app.asgi.application` through the channels test
+communicators, so every frame and request goes through the real routing,
+JWT middleware, consumers, views and a throwaway SQLite database, without
+sockets or external services. Scenarios:
+
+- connect   concurrent WebSocket handshakes until `connection_established`
+- fanout    one sender, every other client in the room receives each message
+- typing    every client in a room sends a burst of typing frames at once
+- history   REST callers walking a room's history with `before` cursors
+- rooms     REST callers listing their rooms with last message and unread count
+- watch     every client following all its rooms, with one socket per room
+            versus one multiplexed socket, comparing handshake time and memory
+"""
+import asyncio
+import json
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from benchmarks.common import argument_parser, emit, setup_django, summarize
+
+SCENARIOS = ('connect', 'fanout', 'typing', 'history', 'rooms', 'watch')
+RECEIVE_TIMEOUT = 30
+
+
+class Fixture:
+    """Users with access tokens, sharing one group room"""
+
+    def __init__(self, users, history, extra_rooms):
+        from django.contrib.auth import get_user_model
+        from rest_framework_simplejwt.tokens import AccessToken
+
+        from chat.models import Message, Room
+
+        User = get_user_model()
+        self.users = User.objects.bulk_create([
+            User(email=f'load{i}@example.com', username=f'load{i}@example.com') for i in range(users)
+        ])
+        self.tokens = [str(AccessToken.for_user(user)) for user in self.users]
+
+        self.room = Room.objects.create(name='Load test', room_type='group', created_by=self.users[0])
+        self.room.participants.add(*self.users)
+        Message.objects.bulk_create(
+            [Message(room=self.room, sender=self.users[i % users], content=f'history {i}') for i in range(history)],
+            batch_size=1000,
+        )
+
+        # Extra rooms per user, so room listings have something to list
+        self.room_ids = [self.room.id]
+        for i in range(extra_rooms):
+            room = Room.objects.create(name=f'Side room {i}', room_type='group', created_by=self.users[0])
+            room.participants.add(*self.users)
+            Message.objects.create(room=room, sender=self.users[i % users], content='hello')
+            self.room_ids.append(room.id)
+
+
+async def open_socket(application, fixture, index, room_id=None):
+    """Socket for one room (the shared one by default), or multiplexed with room_id=False"""
+    from channels.testing import WebsocketCommunicator
+
+    if room_id is None:
+        room_id = fixture.room.id
+    path = f'/ws/chat/{room_id}/' if room_id else '/ws/chat/'
+    communicator = WebsocketCommunicator(
+        application,
+        f'{path}?token={fixture.tokens[index]}',
+        headers=[(b'host', b'localhost'), (b'origin', b'http://localhost')],
+    )
+    connected, _ = await communicator.connect(timeout=RECEIVE_TIMEOUT)
+    if not connected:
+        raise RuntimeError(f'WebSocket client {index} was rejected')
+    frame = await communicator.receive_json_from(timeout=RECEIVE_TIMEOUT)
+    assert frame['type'] == 'connection_established', frame
+    if room_id:
+        frame = await communicator.receive_json_from(timeout=RECEIVE_TIMEOUT)
+        assert frame['type'] == 'presence', frame
+    return communicator
+
+
+async def receive_frame(communicator, frame_type):
+    """Next frame of a type, skipping the batched presence updates"""
+    while True:
+        frame = await communicator.receive_json_from(timeout=RECEIVE_TIMEOUT)
+        if frame['type'] != 'presence':
+            assert frame['type'] == frame_type, frame
+            return frame
+
+
+async def close_sockets(communicators):
+    await asyncio.gather(*[communicator.disconnect() for communicator in communicators])
+
+
+async def http_get(application, fixture, index, path):
+    from channels.testing import HttpCommunicator
+
+    path, _, query = path.partition('?')
+    communicator = HttpCommunicator(
+        application, 'GET', path,
+        headers=[(b'host', b'localhost'), (b'authorization', f'Bearer {fixture.tokens[index]}'.encode())],
+    )
+    communicator.scope['query_string'] = query.encode()
+    response = await communicator.get_response(timeout=RECEIVE_TIMEOUT)
+    # Let the handler finish instead of leaving it pending when the loop closes
+    await communicator.send_input({'type': 'http.disconnect'})
+    await communicator.wait(timeout=RECEIVE_TIMEOUT)
+    if response['status'] != 200:
+        raise RuntimeError(f'GET {path}?{query} returned {response["status"]}')
+    return json.loads(response['body'])
+
+
+async def run_connect(application, fixture, options):
+    clients = options.clients
+    latencies = []
+
+    async def connect(index):
+        started = time.perf_counter()
+        communicator = await open_socket(application, fixture, index)
+        latencies.append(time.perf_counter() - started)
+        return communicator
+
+    started = time.perf_counter()
+    communicators = await asyncio.gather(*[connect(i) for i in range(clients)])
+    elapsed = time.perf_counter() - started
+    await close_sockets(communicators)
+    return {'clients': clients, 'ops_per_s': clients / elapsed, **summarize(latencies)}
+
+
+async def run_fanout(application, fixture, options):
+    communicators = await asyncio.gather(*[open_socket(application, fixture, i) for i in range(options.clients)])
+    sender = communicators[0]
+    latencies = []
+
+    async def receive(communicator, sent_at):
+        await receive_frame(communicator, 'chat_message')
+        latencies.append(time.perf_counter() - sent_at)
+
+    started = time.perf_counter()
+    for i in range(options.messages):
+        sent_at = time.perf_counter()
+        await sender.send_json_to({'type': 'chat_message', 'message': f'load {i}'})
+        # The sender gets its own broadcast too
+        await asyncio.gather(*[receive(communicator, sent_at) for communicator in communicators])
+    elapsed = time.perf_counter() - started
+    await close_sockets(communicators)
+    return {
+        'clients': options.clients,
+        'messages': options.messages,
+        'ops_per_s': len(latencies) / elapsed,
+        **summarize(latencies),
+    }
+
+
+async def run_typing(application, fixture, options):
+    communicators = await asyncio.gather(*[open_socket(application, fixture, i) for i in range(options.clients)])
+    received = [0] * len(communicators)
+    latencies = []
+
+    async def drain(index, started):
+        communicator = communicators[index]
+        while not await communicator.receive_nothing(timeout=0.5):
+            frame = await communicator.receive_json_from()
+            if frame['type'] == 'presence':
+                continue
+            assert frame['type'] == 'typing', frame
+            received[index] += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    sent = 0
+    for _ in range(options.typing_bursts):
+        for communicator in communicators:
+            await communicator.send_json_to({'type': 'typing', 'is_typing': True})
+            sent += 1
+    await asyncio.gather(*[drain(i, started) for i in range(len(communicators))])
+    # The last 0.5s of every drain was waiting for silence
+    elapsed = time.perf_counter() - started - 0.5
+    await close_sockets(communicators)
+    return {
+        'clients': options.clients,
+        'frames_sent': sent,
+        'frames_delivered': sum(received),
+        'ops_per_s': sent / elapsed,
+        **summarize(latencies),
+    }
+
+
+async def run_requests(application, fixture, options, path_for):
+    """`options.requests` GETs from `options.concurrency` callers at a time"""
+    latencies = []
+    semaphore = asyncio.Semaphore(options.concurrency)
+
+    async def call(index):
+        async with semaphore:
+            caller = index % len(fixture.tokens)
+            path = await path_for(caller, index)
+            started = time.perf_counter()
+            body = await http_get(application, fixture, caller, path)
+            latencies.append(time.perf_counter() - started)
+            return body
+
+    started = time.perf_counter()
+    await asyncio.gather(*[call(i) for i in range(options.requests)])
+    elapsed = time.perf_counter() - started
+    return {
+        'requests': options.requests,
+        'concurrency': options.concurrency,
+        'ops_per_s': options.requests / elapsed,
+        **summarize(latencies),
+    }
+
+
+async def run_history(application, fixture, options):
+    # Each caller starts at a different depth, walking back one page per call
+    from channels.db import database_sync_to_async
+
+    from chat.models import Message
+
+    ids = await database_sync_to_async(list)(
+        Message.objects.filter(room=fixture.room).order_by('-id').values_list('id', flat=True)
+    )
+
+    async def path_for(caller, index):
+        cursor = ids[(index * options.page_size) % len(ids)] if ids else ''
+        return f'/api/chat/messages/?room={fixture.room.id}&before={cursor}&page_size={options.page_size}'
+
+    row = await run_requests(application, fixture, options, path_for)
+    return {'history': len(ids), 'page_size': options.page_size, **row}
+
+
+async def run_rooms(application, fixture, options):
+    async def path_for(caller, index):
+        return '/api/chat/rooms/?include=last_message,unread_count'
+
+    row = await run_requests(application, fixture, options, path_for)
+    return {'rooms': options.rooms + 1, **row}
+
+
+async def run_watch(application, fixture, options):
+    async def per_room(index):
+        return await asyncio.gather(*[open_socket(application, fixture, index, room_id) for room_id in fixture.room_ids])
+
+    async def multiplexed(index):
+        communicator = await open_socket(application, fixture, index, room_id=False)
+        for room_id in fixture.room_ids:
+            await communicator.send_json_to({'type': 'subscribe', 'room': room_id})
+            await receive_frame(communicator, 'subscribed')
+        return [communicator]
+
+    row = {'clients': options.clients, 'rooms_per_client': len(fixture.room_ids)}
+    for mode, watch in (('per_room', per_room), ('multiplexed', multiplexed)):
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        sockets = await asyncio.gather(*[watch(i) for i in range(options.clients)])
+        elapsed = time.perf_counter() - started
+        allocated = tracemalloc.get_traced_memory()[0] - baseline
+        tracemalloc.stop()
+        await close_sockets([communicator for client in sockets for communicator in client])
+        row.update({
+            f'{mode}_sockets': sum(len(client) for client in sockets),
+            f'{mode}_seconds': elapsed,
+            f'{mode}_kib_per_client': allocated / 1024 / options.clients,
+        })
+    return row
+
+
+RUNNERS = {
+    'connect': run_connect,
+    'fanout': run_fanout,
+    'typing': run_typing,
+    'history': run_history,
+    'rooms': run_rooms,
+    'watch': run_watch,
+}
+
+
+def run(options):
+    from chat_app.asgi import application
+
+    fixture = Fixture(options.clients, options.history, options.rooms)
+    results = []
+    for scenario in options.scenarios:
+        row = asyncio.run(RUNNERS[scenario](application, fixture, options))
+        results.append({'scenario': scenario, **row})
+    return results
+
+
+def main():
+    parser = argument_parser(__doc__)
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--clients', type=int, default=50, help="WebSocket clients (and users)")
+    parser.add_argument('--messages', type=int, default=50, help="Messages sent in the fanout scenario")
+    parser.add_argument('--typing-bursts', type=int, default=5, help="Typing frames per client")
+    parser.add_argument('--history', type=int, default=5000, help="Messages seeded in the room")
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--rooms', type=int, default=20, help="Extra rooms every user belongs to")
+    parser.add_argument('--requests', type=int, default=500, help="REST requests per REST scenario")
+    parser.add_argument('--concurrency', type=int, default=10, help="REST requests in flight")
+    options = parser.parse_args()
+
+    setup_django(database_path=Path(tempfile.mkdtemp()) / 'bench.sqlite3', migrate=True)
+    emit('load', run(options), options.json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""
+Concurrent message ingest on SQLite: write throughput, tail latency and
+"database is locked" failures, with readers paging history meanwhile.
+
+Each mode runs in its own process against a fresh database file:
+- rollback   rollback journal, every writer thread commits its own messages
+             (the previous default)
+- wal        WAL, synchronous=NORMAL, busy timeout, IMMEDIATE transactions
+- wal+writer the same, with all inserts going through the MessageWriter
+             thread and committed in groups
+"""
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from benchmarks.common import argument_parser, emit, setup_django, summarize
+
+MODES = ('rollback', 'wal', 'wal+writer')
+
+
+def run_mode(mode, writers, messages, readers, results):
+    os.environ['SQLITE_WAL'] = 'False' if mode == 'rollback' else 'True'
+    os.environ['CHAT_WRITE_BEHIND_MAX_DELAY'] = '0.002'
+    setup_django(database_path=Path(tempfile.mkdtemp()) / 'ingest.sqlite3', migrate=True)
+
+    from django.contrib.auth import get_user_model
+    from django.db import DatabaseError, connection
+    from django.utils import timezone
+
+    from chat.models import Message, Room
+    from chat.writer import message_writer
+
+    User = get_user_model()
+    user = User.objects.create_user(email='ingest@example.com', password='x')
+    room = Room.objects.create(name='Ingest', room_type='group', created_by=user)
+    room.participants.add(user)
+    connection.close()
+
+    def save_directly(content):
+        # What MessageViewSet and ChatConsumer.save_message_now do per message
+        message = Message.objects.create(room=room, sender=user, content=content)
+        Room.objects.filter(pk=room.pk).update(updated_at=timezone.now())
+        return message
+
+    def write(index):
+        latencies, errors = [], 0
+        for i in range(messages):
+            started = time.perf_counter()
+            try:
+                if mode == 'wal+writer':
+                    message_writer.submit_sync(room.id, user, f'{index}:{i}')
+                else:
+                    save_directly(f'{index}:{i}')
+            except DatabaseError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+        connection.close()
+        return latencies, errors
+
+    stop_reading = threading.Event()
+    reads = []
+
+    def read():
+        while not stop_reading.is_set():
+            started = time.perf_counter()
+            list(Message.objects.filter(room=room).order_by('-id')[:50])
+            reads.append(time.perf_counter() - started)
+        connection.close()
+
+    reader_threads = [threading.Thread(target=read) for _ in range(readers)]
+    for thread in reader_threads:
+        thread.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=writers) as pool:
+        outcomes = list(pool.map(write, range(writers)))
+    elapsed = time.perf_counter() - started
+    stop_reading.set()
+    for thread in reader_threads:
+        thread.join()
+    message_writer.close()
+
+    latencies = [latency for thread_latencies, _ in outcomes for latency in thread_latencies]
+    write_summary = summarize(latencies)
+    read_summary = summarize(reads)
+    results.put({
+        'mode': mode,
+        'writers': writers,
+        'readers': readers,
+        'written': len(latencies),
+        'errors': sum(errors for _, errors in outcomes),
+        'writes_per_s': len(latencies) / elapsed,
+        **{f'write_{key}': value for key, value in write_summary.items() if key.endswith('_ms')},
+        'reads': read_summary['count'],
+        'read_p99_ms': read_summary.get('p99_ms'),
+    })
+
+
+def run(modes, writers, messages, readers):
+    ctx = multiprocessing.get_context('spawn')
+    rows = []
+    for mode in modes:
+        results = ctx.Queue()
+        process = ctx.Process(target=run_mode, args=(mode, writers, messages, readers, results))
+        process.start()
+        rows.append(results.get())
+        process.join()
+    return rows
+
+
+def main():
+    parser = argument_parser(__doc__)
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument('--writers', type=int, default=16, help="Concurrent writer threads")
+    parser.add_argument('--messages', type=int, default=200, help="Messages per writer")
+    parser.add_argument('--readers', type=int, default=4, help="Threads paging history meanwhile")
+    args = parser.parse_args()
+    emit('sqlite_ingest', run(args.modes, args.writers, args.messages, args.readers), args.json)
+
+
+if __name__ == '__main__':
+    main()
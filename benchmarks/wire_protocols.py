@@ -0,0 +1,115 @@
+"""
+Size and CPU cost of a chat_message broadcast in each wire protocol.
+
+For every protocol in chat/protocols.py, over a set of sample messages:
+- bytes        mean size of a chat_message frame on the wire
+- encode_us    sender CPU to encode the frame once for the broadcast
+- recipient_us CPU per recipient to deliver it: the in-memory channel
+               layer's copy of the event plus the recipient picking its
+               payload, with the one-off encode spread over the room
+- decode_us    client CPU to turn the frame back into an object
+
+The encode cost is per protocol; a broadcast pays it for every enabled
+protocol, shown as `all` (every protocol unless CHAT_WIRE_PROTOCOLS is set).
+"""
+import os
+import time
+from copy import deepcopy
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from benchmarks.common import argument_parser, emit, setup_django
+
+
+def sample_messages():
+    sender = SimpleNamespace(id=42, email='sender@example.com', first_name='Ada', last_name='Lovelace')
+    contents = [
+        'ok',
+        'See you at 10, bringing the slides.',
+        'The quick brown fox jumps over the lazy dog. ' * 3,
+        'Release notes: ' + ' '.join(f'item {i} fixed;' for i in range(40)),
+    ]
+    return [
+        SimpleNamespace(id=123456 + i, content=content, sender=sender, created_at=datetime.now(timezone.utc))
+        for i, content in enumerate(contents)
+    ]
+
+
+def timed(function, repeat):
+    """Best CPU seconds per call over `repeat` rounds"""
+    best = None
+    for _ in range(repeat):
+        started = time.process_time()
+        function()
+        elapsed = time.process_time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run(recipients, iterations, repeat):
+    from chat.frames import chat_message_frame
+    from chat.protocols import PROTOCOLS, encode_all
+
+    frames = [chat_message_frame(1, message) for message in sample_messages()]
+    results = []
+
+    def deliver(name, payloads):
+        event = {'type': 'chat_message', 'room': 1, 'message_id': 1, 'payloads': payloads}
+        for _ in range(recipients):
+            deepcopy(event)['payloads'][name]
+
+    for name, protocol in PROTOCOLS.items():
+        encoded = [protocol.encode(frame) for frame in frames]
+        size = sum(len(payload.encode() if isinstance(payload, str) else payload) for payload in encoded) / len(encoded)
+
+        def encode():
+            for _ in range(iterations):
+                for frame in frames:
+                    protocol.encode(frame)
+
+        def decode():
+            for _ in range(iterations):
+                for payload in encoded:
+                    protocol.decode(payload)
+
+        encode_s = timed(encode, repeat) / (iterations * len(frames))
+        decode_s = timed(decode, repeat) / (iterations * len(frames))
+        deliver_s = timed(lambda: deliver(name, {name: encoded[-1]}), repeat) / recipients
+        results.append({
+            'protocol': name,
+            'bytes': size,
+            'vs_json': size / results[0]['bytes'] if results else 1.0,
+            'encode_us': encode_s * 1e6,
+            'recipient_us': (deliver_s + encode_s / recipients) * 1e6,
+            'decode_us': decode_s * 1e6,
+        })
+
+    def encode_everything():
+        for _ in range(iterations):
+            for frame in frames:
+                encode_all(frame)
+
+    payloads = encode_all(frames[-1])
+    encode_s = timed(encode_everything, repeat) / (iterations * len(frames))
+    deliver_s = timed(lambda: deliver('json', payloads), repeat) / recipients
+    results.append({
+        'protocol': 'all',
+        'encode_us': encode_s * 1e6,
+        'recipient_us': (deliver_s + encode_s / recipients) * 1e6,
+    })
+    return results
+
+
+def main():
+    parser = argument_parser(__doc__)
+    parser.add_argument('--recipients', type=int, default=100, help="Room size the encode cost is spread over")
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    os.environ.setdefault('CHAT_WIRE_PROTOCOLS', 'msgpack,json+deflate,msgpack+deflate')
+    setup_django()
+    emit('wire_protocols', run(args.recipients, args.iterations, args.repeat), args.json)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Room, Message
+from .models import Room, Message, ReadCursor
 
 
 @admin.register(Room)
@@ -8,11 +8,11 @@ class RoomAdmin(admin.ModelAdmin):
     list_filter = ['room_type', 'created_at']
     search_fields = ['name', 'participants__email']
     filter_horizontal = ['participants']
-    readonly_fields = ['created_at', 'updated_at']
+    readonly_fields = ['direct_key', 'created_at', 'updated_at']
     
     fieldsets = (
         ('Room Information', {
-            'fields': ('name', 'room_type', 'created_by')
+            'fields': ('name', 'room_type', 'created_by', 'direct_key')
         }),
         ('Participants', {
             'fields': ('participants',)
@@ -26,8 +26,8 @@ class RoomAdmin(admin.ModelAdmin):
 
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
-    list_display = ['id', 'room', 'sender', 'content_preview', 'is_read', 'created_at']
-    list_filter = ['is_read', 'created_at']
+    list_display = ['id', 'room', 'sender', 'content_preview', 'created_at']
+    list_filter = ['created_at']
     search_fields = ['content', 'sender__email', 'room__name']
     readonly_fields = ['created_at', 'updated_at']
     
@@ -37,10 +37,17 @@ class MessageAdmin(admin.ModelAdmin):
     
     fieldsets = (
         ('Message Details', {
-            'fields': ('room', 'sender', 'content', 'is_read')
+            'fields': ('room', 'sender', 'content')
         }),
         ('Timestamps', {
             'fields': ('created_at', 'updated_at'),
             'classes': ('collapse',)
         }),
     )
+
+
+@admin.register(ReadCursor)
+class ReadCursorAdmin(admin.ModelAdmin):
+    list_display = ['id', 'user', 'room', 'last_read_message_id', 'updated_at']
+    search_fields = ['user__email', 'room__name']
+    readonly_fields = ['updated_at']
@@ -0,0 +1,143 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    Small thread-safe LRU cache with optional TTL and hit/miss counters.
+
+    Used for process-local caches shared between the event loop (consumers,
+    ASGI middleware) and the sync threads serving REST requests.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is not _MISSING:
+                value, expires_at = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class MembershipCache(LRUCache):
+    """
+    Per-room sets of participant user ids.
+
+    Entries are invalidated by the `m2m_changed` handler on
+    `Room.participants` (see chat/signals.py). The TTL bounds staleness for
+    changes made by other processes, which this process never hears about.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self._generation = 0
+
+    def members_query(self, room_id):
+        from chat.models import Room
+
+        return Room.participants.through.objects.filter(room_id=room_id).values_list('user_id', flat=True)
+
+    def load_members(self, room_id):
+        return frozenset(self.members_query(room_id))
+
+    async def aload_members(self, room_id):
+        return frozenset([user_id async for user_id in self.members_query(room_id)])
+
+    def get_members(self, room_id):
+        """Returns the set of participant user ids of a room"""
+        members = self.get(room_id, _MISSING)
+        if members is _MISSING:
+            members = self.fill(room_id)
+        return members
+
+    def fill(self, room_id):
+        """Loads a room's members from the database and caches them"""
+        generation = self._generation
+        return self.store(room_id, generation, self.load_members(room_id))
+
+    async def afill(self, room_id):
+        generation = self._generation
+        return self.store(room_id, generation, await self.aload_members(room_id))
+
+    def store(self, room_id, generation, members):
+        # Don't cache a result that an invalidation may have outdated
+        # while it was being loaded.
+        if generation == self._generation:
+            self.set(room_id, members)
+        return members
+
+    def is_member(self, room_id, user_id):
+        return user_id in self.get_members(int(room_id))
+
+    async def aget_members(self, room_id):
+        """Async variant that only leaves the event loop on a cache miss"""
+        members = self.get(int(room_id), _MISSING)
+        if members is _MISSING:
+            members = await self.afill(int(room_id))
+        return members
+
+    async def ais_member(self, room_id, user_id):
+        return user_id in await self.aget_members(room_id)
+
+    def invalidate(self, room_id):
+        self._generation += 1
+        self.delete(int(room_id))
+
+    def invalidate_all(self):
+        self._generation += 1
+        self.clear()
+
+
+membership_cache = MembershipCache(
+    maxsize=settings.CHAT_MEMBERSHIP_CACHE_SIZE,
+    ttl=settings.CHAT_MEMBERSHIP_CACHE_TTL,
+)
@@ -0,0 +1,45 @@
+import hashlib
+
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+
+
+class ConditionalGetMixin:
+    """
+    Answers GETs with 304 Not Modified when the client's copy is current.
+
+    Views return cheap validators from `get_validators(action)`: a tuple of
+    values that changes whenever the response would (hashed into the ETag)
+    and a `last_modified` datetime. The conditional headers are checked
+    before the queryset is built or anything is serialized.
+    """
+
+    def get_validators(self, action):
+        """Returns (etag_parts, last_modified), or None to skip the check"""
+        return None
+
+    def conditional(self, action, respond):
+        validators = self.get_validators(action)
+        if validators is None:
+            return respond()
+
+        parts, last_modified = validators
+        # The same resource looks different per user and per query string
+        parts = (self.request.user.pk, self.request.get_full_path(), *parts)
+        etag = '"%s"' % hashlib.sha1(repr(parts).encode()).hexdigest()
+        # HTTP dates have whole-second resolution
+        last_modified = int(last_modified.timestamp()) if last_modified else None
+
+        response = get_conditional_response(self.request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = respond()
+            if response.status_code != 200:
+                return response
+
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+        # Let browsers keep the body but revalidate it on every request
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ['Authorization'])
+        return response
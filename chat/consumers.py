@@ -1,150 +1,606 @@
-import json
+from functools import partial
+from urllib.parse import parse_qs
+
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from chat.models import Room, Message
+from django.utils import timezone
+from chat.cache import membership_cache
+from chat.metrics import InstrumentedConsumerMixin
+from chat.frames import chat_message_frame, chat_messages_frame, presence_frame, sync_frame, typing_frame
+from chat.models import Room, Message, ReadCursor
+from chat.notifications import notify_room_bumped, room_group, user_group
+from chat.outbound import create_outbound_queue, outbound_registry
+from chat.presence import presence_registry
+from chat.protocols import JSON, InvalidFrame, encode_all, negotiate
+from chat.ratelimit import RateLimited, rate_limiter
+from chat.typing_indicators import typing_throttle
+from chat.writer import message_writer
 
 User = get_user_model()
 
+# Close code sent to clients that can't keep up with their room
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+# Frame types clients may send. Anything else is labelled 'unknown' in the
+# metrics, so clients can't create a histogram series per made-up type.
+CLIENT_FRAME_TYPES = frozenset({
+    'chat_message', 'chat_messages', 'mark_read', 'typing', 'heartbeat', 'subscribe', 'unsubscribe',
+})
+
+
+def receive_metrics_event(message_type):
+    if isinstance(message_type, str) and message_type in CLIENT_FRAME_TYPES:
+        return f'receive.{message_type}'
+    return 'receive.unknown'
+
+
+def parse_message_id(value):
+    """Message id from a client frame or query string, None if it isn't one"""
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.isdecimal():
+        return int(value)
+    return None
+
+
+class QueuedConsumer(InstrumentedConsumerMixin, AsyncWebsocketConsumer):
+    """
+    Sends every frame through a bounded outbound queue, in the wire protocol
+    the client negotiated (see chat/protocols.py).
+    """
+    outbound = None
+    protocol = JSON
+
+    async def accept_negotiated(self):
+        """Accepts in the client's protocol; False (and closed) if it's not one we speak"""
+        protocol, subprotocol = negotiate(self.scope)
+        if protocol is None:
+            await self.close()
+            return False
+        self.protocol = protocol
+        await self.accept(subprotocol=subprotocol)
+        await self.start_outbound()
+        return True
+
+    def invalid_frame_message(self):
+        return 'Invalid JSON' if self.protocol is JSON else f'Invalid {self.protocol.name} frame'
+
+    def decode(self, text_data, bytes_data):
+        """A client frame as a dict, None if it can't be decoded"""
+        try:
+            data = self.protocol.decode(text_data if text_data is not None else bytes_data)
+        except InvalidFrame:
+            return None
+        return data if isinstance(data, dict) else None
+
+    async def start_outbound(self):
+        # Frames go through a bounded queue so a slow client can't build an
+        # unbounded backlog in this process
+        self.outbound = create_outbound_queue(self.send)
+        self.outbound.start()
+        outbound_registry.register(self.channel_name, self.outbound)
+
+    def stop_outbound(self):
+        if self.outbound is not None:
+            self.outbound.stop()
+            outbound_registry.unregister(self.channel_name)
+
+    async def push_error(self, message, room_id=None, droppable=False, **fields):
+        frame = {'type': 'error', 'message': message, **fields}
+        if room_id is not None:
+            frame['room'] = room_id
+        await self.push(frame, droppable)
+
+    async def push_rate_limited(self, error, room_id=None, droppable=False):
+        await self.push_error(
+            'Rate limit exceeded', room_id, droppable,
+            code='rate_limited', limit=error.limit, retry_after=error.retry_after,
+        )
+
+    async def push(self, frame, droppable=False):
+        """Queue a frame for this client, encoded in its protocol"""
+        await self.enqueue(self.protocol.encode(frame), droppable)
+
+    async def push_payloads(self, payloads, droppable=False):
+        """Queue a broadcast frame the sender already encoded for every protocol"""
+        await self.enqueue(payloads[self.protocol.name], droppable)
+
+    async def enqueue(self, payload, droppable):
+        """Queue an encoded frame, dropping the client if it can't keep up"""
+        if self.outbound is None or self.outbound.overflowed:
+            return
+        if not self.outbound.put(self.protocol.send_kwargs(payload), droppable=droppable):
+            self.outbound.overflowed = True
+            outbound_registry.disconnected += 1
+            await self.close(code=SLOW_CONSUMER_CLOSE_CODE)
+
 
-class ChatConsumer(AsyncWebsocketConsumer):
+class BaseChatConsumer(QueuedConsumer):
     """
-    WebSocket consumer for real-time chat messaging
+    What the per-room and the multiplexed endpoints share: the room frames
+    a client can send and the group events of the rooms it joined.
+    Everything room-specific takes the room id, and every frame sent about
+    a room carries it.
     """
-    
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Per room, id of the last message sent by the reconnect sync; live
+        # broadcasts up to it were already delivered
+        self.synced_up_to = {}
+
+    async def join_room(self, room_id, last_seen_id=None):
+        """Start receiving a room's events, after the presence snapshot and missed messages"""
+        await self.channel_layer.group_add(f'chat_{room_id}', self.channel_name)
+
+        # Who else is here; changes follow as batched presence frames
+        presence_registry.connect(room_id, self.user.id)
+        await self.push(presence_frame(
+            room_id, presence_registry.online_members(room_id), [], snapshot=True
+        ))
+
+        # Group events that arrive meanwhile are dispatched after the
+        # current handler returns, so the missed messages go out before any
+        # live ones
+        if last_seen_id is not None:
+            await self.send_missed_messages(room_id, last_seen_id)
+
+    async def leave_room(self, room_id):
+        # Stop showing this user as typing
+        if typing_throttle.clear(room_id, self.user.id):
+            await self.broadcast_typing(room_id, False)
+
+        presence_registry.disconnect(room_id, self.user.id)
+        self.synced_up_to.pop(room_id, None)
+        await self.channel_layer.group_discard(f'chat_{room_id}', self.channel_name)
+
+    async def send_missed_messages(self, room_id, last_seen_id):
+        """Stream messages newer than `last_seen_id` in bounded chunks"""
+        if await self.count_missed_messages(room_id, last_seen_id) > settings.CHAT_SYNC_MAX_MESSAGES:
+            # Too far behind: cheaper for the client to reload over REST
+            await self.push(sync_frame(room_id, [], complete=True, truncated=True))
+            return
+
+        cursor = last_seen_id
+        while True:
+            chunk = await self.load_messages_after(room_id, cursor, settings.CHAT_SYNC_CHUNK_SIZE + 1)
+            complete = len(chunk) <= settings.CHAT_SYNC_CHUNK_SIZE
+            chunk = chunk[:settings.CHAT_SYNC_CHUNK_SIZE]
+            if chunk:
+                cursor = chunk[-1].id
+            self.synced_up_to[room_id] = cursor
+            await self.push(sync_frame(room_id, chunk, complete=complete))
+            if complete:
+                return
+
+    async def handle_room_frame(self, room_id, message_type, data):
+        """Handles a client frame about one room; returns False for unknown types"""
+        if message_type == 'chat_message':
+            content = data.get('message', '')
+
+            if not isinstance(content, str) or not content.strip():
+                await self.push_error('Message content cannot be empty', room_id)
+                return True
+
+            try:
+                rate_limiter.take_messages('ws', self.user.id, room_id)
+            except RateLimited as e:
+                await self.push_rate_limited(e, room_id)
+                return True
+
+            # Sending a message ends the sender's typing state
+            if typing_throttle.clear(room_id, self.user.id):
+                await self.broadcast_typing(room_id, False)
+
+            # Save message to database
+            message = await self.save_message(room_id, content)
+
+            # Broadcast message to room group, encoded once for everyone
+            await self.channel_layer.group_send(
+                f'chat_{room_id}',
+                {
+                    'type': 'chat_message',
+                    'room': room_id,
+                    'message_id': message.id,
+                    'payloads': encode_all(chat_message_frame(room_id, message)),
+                }
+            )
+            # Members' room lists move the room to the top
+            await notify_room_bumped(room_id, message)
+
+        elif message_type == 'chat_messages':
+            await self.send_batch(room_id, data.get('messages'))
+
+        elif message_type == 'mark_read':
+            # Move this user's read cursor forward in one write
+            last_read = await self.mark_read(room_id, data.get('message_id'))
+            if last_read is None:
+                await self.push_error('Message not found in this room', room_id)
+                return True
+            await self.push({
+                'type': 'read_cursor',
+                'room': room_id,
+                'last_read_message_id': last_read,
+            })
+
+        elif message_type == 'typing':
+            # Broadcast typing indicator, only when it changes something
+            is_typing = bool(data.get('is_typing', False))
+            # Only typing frames that would be broadcast are limited (not
+            # repeats the throttle drops anyway), and a stop always gets through
+            if is_typing and typing_throttle.would_broadcast(room_id, self.user.id, True):
+                try:
+                    rate_limiter.take_typing('ws', self.user.id)
+                except RateLimited as e:
+                    await self.push_rate_limited(e, room_id, droppable=True)
+                    return True
+            on_expire = partial(self.broadcast_typing, room_id, False)
+            if typing_throttle.update(room_id, self.user.id, is_typing, on_expire):
+                await self.broadcast_typing(room_id, is_typing)
+
+        else:
+            return False
+        return True
+
+    async def send_batch(self, room_id, items):
+        """
+        Saves several messages with one bulk insert, broadcasts them as one
+        chat_messages frame in the order given, and answers the sender with
+        a result per item: the message id or an error, with the item's
+        `client_id` if it had one.
+        """
+        if not isinstance(items, list) or not items:
+            await self.push_error("'messages' must be a non-empty list", room_id)
+            return
+        if len(items) > settings.CHAT_MAX_BATCH_MESSAGES:
+            await self.push_error(f'At most {settings.CHAT_MAX_BATCH_MESSAGES} messages per batch', room_id)
+            return
+
+        results = []
+        contents = []
+        for item in items:
+            result = {}
+            if isinstance(item, dict) and 'client_id' in item:
+                result['client_id'] = item['client_id']
+            content = item.get('message') if isinstance(item, dict) else None
+            if isinstance(content, str) and content.strip():
+                contents.append(content)
+            else:
+                result['error'] = 'Message content cannot be empty'
+            results.append(result)
+
+        # The batch is all-or-nothing against the limits
+        if contents:
+            try:
+                rate_limiter.take_messages('ws', self.user.id, room_id, count=len(contents))
+            except RateLimited as e:
+                await self.push_rate_limited(e, room_id)
+                return
+
+        # Sending a message ends the sender's typing state
+        if typing_throttle.clear(room_id, self.user.id):
+            await self.broadcast_typing(room_id, False)
+
+        outcomes = iter(await self.save_messages(room_id, contents) if contents else [])
+        messages = []
+        for result in results:
+            if 'error' in result:
+                continue
+            outcome = next(outcomes)
+            if isinstance(outcome, Exception):
+                result['error'] = 'Message could not be saved'
+            else:
+                result['id'] = outcome.id
+                messages.append(outcome)
+
+        if messages:
+            await self.channel_layer.group_send(
+                f'chat_{room_id}',
+                {
+                    'type': 'chat_messages',
+                    'room': room_id,
+                    'last_message_id': messages[-1].id,
+                    'payloads': encode_all(chat_messages_frame(room_id, messages)),
+                }
+            )
+            await notify_room_bumped(room_id, messages[-1])
+
+        await self.push({'type': 'chat_messages_result', 'room': room_id, 'results': results})
+
+    async def broadcast_typing(self, room_id, is_typing):
+        """Send this user's typing state to the room group"""
+        await self.channel_layer.group_send(
+            f'chat_{room_id}',
+            {
+                'type': 'typing_indicator',
+                'user_id': self.user.id,
+                'payloads': encode_all(typing_frame(room_id, self.user, is_typing)),
+            }
+        )
+
+    async def chat_message(self, event):
+        """Called when a message is sent to the group"""
+        # Already delivered by the reconnect sync
+        if event['message_id'] <= self.synced_up_to.get(event['room'], 0):
+            return
+        # Send the pre-encoded frame to WebSocket
+        await self.push_payloads(event['payloads'])
+
+    async def chat_messages(self, event):
+        """Called when a batch of messages is sent to the group"""
+        # Batches are saved after any reconnect sync started, so one is
+        # either entirely delivered by the sync or not at all
+        if event['last_message_id'] <= self.synced_up_to.get(event['room'], 0):
+            return
+        await self.push_payloads(event['payloads'])
+
+    async def typing_indicator(self, event):
+        """Called when typing indicator is sent to the group"""
+        # Don't send typing indicator back to the sender
+        if event['user_id'] != self.user.id:
+            await self.push_payloads(event['payloads'], droppable=True)
+
+    async def presence_update(self, event):
+        """Called with a batch of presence changes in a room"""
+        await self.push_payloads(event['payloads'], droppable=True)
+
+    async def check_room_participant(self, room_id):
+        """Check if user is a participant of the room"""
+        return await membership_cache.ais_member(room_id, self.user.id)
+
+    # Single queries use the async ORM, which runs them on the shared sync
+    # thread without database_sync_to_async's connection checks (and, with
+    # CONN_MAX_AGE=0, a reconnect) around every call. Work that needs a
+    # transaction or several dependent queries stays on database_sync_to_async.
+
+    async def count_missed_messages(self, room_id, last_seen_id):
+        """Number of missed messages, counting no further than the sync limit"""
+        limit = settings.CHAT_SYNC_MAX_MESSAGES + 1
+        return await Message.objects.filter(
+            room_id=room_id, id__gt=last_seen_id
+        ).order_by('id').values('id')[:limit].acount()
+
+    async def load_messages_after(self, room_id, message_id, limit):
+        return [
+            message async for message in
+            Message.objects.filter(room_id=room_id, id__gt=message_id)
+            .select_related('sender').order_by('id')[:limit]
+        ]
+
+    @database_sync_to_async
+    def mark_read(self, room_id, message_id):
+        """Advance the user's read cursor; None if the message isn't in this room"""
+        if message_id is not None:
+            try:
+                message_id = int(message_id)
+            except (TypeError, ValueError):
+                return None
+        return ReadCursor.mark_read(self.user, room_id, message_id)
+
+    async def save_message(self, room_id, content):
+        """Save message to database"""
+        if settings.CHAT_WRITE_BEHIND:
+            # Committed together with other queued messages in one batch
+            return await message_writer.submit(room_id, self.user, content)
+        return await self.save_message_now(room_id, content)
+
+    async def save_messages(self, room_id, contents):
+        """Save several messages in order; one result per message, as MessageWriter.write_batch"""
+        if settings.CHAT_WRITE_BEHIND:
+            return await message_writer.submit_many(room_id, self.user, contents)
+        # The same bulk insert the writer thread does, on this request's thread
+        messages = [Message(room_id=room_id, sender=self.user, content=content) for content in contents]
+        return await database_sync_to_async(message_writer.write_batch)(messages)
+
+    async def save_message_now(self, room_id, content):
+        """Save a single message and bump the room in their own queries"""
+        message = await Message.objects.acreate(room_id=room_id, sender=self.user, content=content)
+        # Update room's updated_at timestamp
+        await Room.objects.filter(pk=room_id).aupdate(updated_at=timezone.now())
+        return message
+
+
+class ChatConsumer(BaseChatConsumer):
+    """
+    WebSocket consumer for real-time chat messaging in one room
+    """
+
     async def connect(self):
         """Called when WebSocket connection is established"""
-        self.room_id = self.scope['url_route']['kwargs']['room_id']
-        self.room_group_name = f'chat_{self.room_id}'
+        self.room_id = int(self.scope['url_route']['kwargs']['room_id'])
         self.user = self.scope['user']
-        
+
         # Reject if user is not authenticated
         if not self.user.is_authenticated:
             await self.close()
             return
-        
+
         # Check if user is participant of this room
-        is_participant = await self.check_room_participant()
+        is_participant = await self.check_room_participant(self.room_id)
         if not is_participant:
             await self.close()
             return
-        
-        # Join room group
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
-        
-        await self.accept()
-        
+
+        if not await self.accept_negotiated():
+            return
+
         # Send connection success message
-        await self.send(text_data=json.dumps({
+        await self.push({
             'type': 'connection_established',
-            'message': f'Connected to room {self.room_id}'
-        }))
-    
+            'message': f'Connected to room {self.room_id}',
+            'heartbeat_interval': settings.CHAT_PRESENCE_HEARTBEAT_INTERVAL,
+        })
+
+        await self.join_room(self.room_id, self.get_last_seen_id())
+
+    def get_last_seen_id(self):
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        return parse_message_id(query.get('last_seen_id', [''])[0])
+
     async def disconnect(self, close_code):
         """Called when WebSocket connection is closed"""
-        # Leave room group
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
-        )
-    
-    async def receive(self, text_data):
+        # Only accepted connections joined the room
+        if self.outbound is not None:
+            await self.leave_room(self.room_id)
+            self.stop_outbound()
+
+    async def receive(self, text_data=None, bytes_data=None):
         """Called when message is received from WebSocket"""
-        try:
-            data = json.loads(text_data)
-            message_type = data.get('type', 'chat_message')
-            
-            if message_type == 'chat_message':
-                content = data.get('message', '')
-                
-                if not content.strip():
-                    await self.send(text_data=json.dumps({
-                        'type': 'error',
-                        'message': 'Message content cannot be empty'
-                    }))
-                    return
-                
-                # Save message to database
-                message = await self.save_message(content)
-                
-                # Broadcast message to room group
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'chat_message',
-                        'message': {
-                            'id': message.id,
-                            'content': message.content,
-                            'sender': {
-                                'id': message.sender.id,
-                                'email': message.sender.email,
-                                'first_name': message.sender.first_name,
-                                'last_name': message.sender.last_name,
-                            },
-                            'created_at': message.created_at.isoformat(),
-                            'is_read': message.is_read,
-                        }
-                    }
-                )
-            
-            elif message_type == 'typing':
-                # Broadcast typing indicator
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'typing_indicator',
-                        'user_id': self.user.id,
-                        'email': self.user.email,
-                        'is_typing': data.get('is_typing', False)
-                    }
-                )
-        
-        except json.JSONDecodeError:
-            await self.send(text_data=json.dumps({
-                'type': 'error',
-                'message': 'Invalid JSON'
-            }))
-    
-    async def chat_message(self, event):
-        """Called when a message is sent to the group"""
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'chat_message',
-            'message': event['message']
-        }))
-    
-    async def typing_indicator(self, event):
-        """Called when typing indicator is sent to the group"""
-        # Don't send typing indicator back to the sender
-        if event['user_id'] != self.user.id:
-            await self.send(text_data=json.dumps({
-                'type': 'typing',
-                'user_id': event['user_id'],
-                'email': event['email'],
-                'is_typing': event['is_typing']
-            }))
-    
-    @database_sync_to_async
-    def check_room_participant(self):
-        """Check if user is a participant of the room"""
-        try:
-            room = Room.objects.get(id=self.room_id)
-            return room.participants.filter(id=self.user.id).exists()
-        except Room.DoesNotExist:
-            return False
-    
-    @database_sync_to_async
-    def save_message(self, content):
-        """Save message to database"""
-        room = Room.objects.get(id=self.room_id)
-        message = Message.objects.create(
-            room=room,
-            sender=self.user,
-            content=content
-        )
-        # Update room's updated_at timestamp
-        room.save(update_fields=['updated_at'])
-        return message
\ No newline at end of file
+        data = self.decode(text_data, bytes_data)
+        if data is None:
+            await self.push_error(self.invalid_frame_message())
+            return
+
+        message_type = data.get('type', 'chat_message')
+        self.metrics_event = receive_metrics_event(message_type)
+
+        if message_type == 'heartbeat':
+            # Keeps this user online; answered so clients can spot dead sockets
+            presence_registry.heartbeat(self.room_id, self.user.id)
+            await self.push({'type': 'heartbeat_ack'}, droppable=True)
+        else:
+            await self.handle_room_frame(self.room_id, message_type, data)
+
+
+class MultiplexChatConsumer(BaseChatConsumer):
+    """
+    One WebSocket per user for any number of rooms.
+
+    The client sends `subscribe` / `unsubscribe` frames with a `room` id,
+    and tags every room frame (chat_message, mark_read, typing) with the
+    room it is about; everything sent back carries the room id as well.
+    Membership is checked once, when subscribing. A heartbeat keeps the
+    user online in every subscribed room.
+    """
+
+    async def connect(self):
+        self.user = self.scope['user']
+        self.rooms = set()
+
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+
+        if not await self.accept_negotiated():
+            return
+        await self.push({
+            'type': 'connection_established',
+            'message': 'Connected',
+            'heartbeat_interval': settings.CHAT_PRESENCE_HEARTBEAT_INTERVAL,
+        })
+
+    async def disconnect(self, close_code):
+        if self.outbound is not None:
+            for room_id in list(self.rooms):
+                await self.leave_room(room_id)
+            self.rooms.clear()
+            self.stop_outbound()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        data = self.decode(text_data, bytes_data)
+        if data is None:
+            await self.push_error(self.invalid_frame_message())
+            return
+
+        message_type = data.get('type', 'chat_message')
+        self.metrics_event = receive_metrics_event(message_type)
+
+        if message_type == 'heartbeat':
+            for room_id in self.rooms:
+                presence_registry.heartbeat(room_id, self.user.id)
+            await self.push({'type': 'heartbeat_ack'}, droppable=True)
+            return
+
+        room_id = parse_message_id(data.get('room'))
+        if room_id is None:
+            await self.push_error("Frame needs a 'room' id")
+            return
+
+        if message_type == 'subscribe':
+            await self.subscribe(room_id, parse_message_id(data.get('last_seen_id')))
+        elif message_type == 'unsubscribe':
+            if room_id in self.rooms:
+                self.rooms.discard(room_id)
+                await self.leave_room(room_id)
+            await self.push({'type': 'unsubscribed', 'room': room_id})
+        elif room_id not in self.rooms:
+            await self.push_error('Not subscribed to this room', room_id)
+        elif not await self.handle_room_frame(room_id, message_type, data):
+            await self.push_error(f"Unknown frame type '{message_type}'", room_id)
+
+    async def subscribe(self, room_id, last_seen_id):
+        if room_id in self.rooms:
+            await self.push({'type': 'subscribed', 'room': room_id})
+            return
+        if len(self.rooms) >= settings.CHAT_MAX_SUBSCRIPTIONS:
+            await self.push_error('Too many subscriptions', room_id)
+            return
+        if not await self.check_room_participant(room_id):
+            await self.push_error('Room not found', room_id)
+            return
+
+        self.rooms.add(room_id)
+        await self.push({'type': 'subscribed', 'room': room_id})
+        await self.join_room(room_id, last_seen_id)
+
+
+class NotificationConsumer(QueuedConsumer):
+    """
+    Per-user socket for room list updates (see chat/notifications.py).
+    Clients load the room list once over REST and apply the deltas pushed
+    here; nothing is expected from the client.
+    """
+
+    async def connect(self):
+        self.user = self.scope['user']
+        self.rooms = set()
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+
+        if not await self.accept_negotiated():
+            return
+        # The user's group first, so rooms added meanwhile aren't missed
+        self.group_name = user_group(self.user.id)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        for room_id in await self.load_room_ids():
+            await self.join_room(room_id)
+
+    async def disconnect(self, close_code):
+        if self.outbound is not None:
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+            for room_id in self.rooms:
+                await self.channel_layer.group_discard(room_group(room_id), self.channel_name)
+            self.rooms.clear()
+            self.stop_outbound()
+
+    async def load_room_ids(self):
+        return [
+            room_id async for room_id in
+            Room.participants.through.objects.filter(user_id=self.user.id).values_list('room_id', flat=True)
+        ]
+
+    async def join_room(self, room_id):
+        if room_id not in self.rooms:
+            self.rooms.add(room_id)
+            await self.channel_layer.group_add(room_group(room_id), self.channel_name)
+
+    async def notification(self, event):
+        """A frame for this user; `join_room` when they were added to a room"""
+        if 'join_room' in event:
+            await self.join_room(event['join_room'])
+        await self.push_payloads(event['payloads'])
+
+    async def room_notification(self, event):
+        """A frame for every member of one of the user's rooms"""
+        room_id = event['room']
+        if self.user.id in event['exclude']:
+            return
+        # Removals aren't announced: leave rooms the user is no longer in
+        if not await membership_cache.ais_member(room_id, self.user.id):
+            self.rooms.discard(room_id)
+            await self.channel_layer.group_discard(room_group(room_id), self.channel_name)
+            return
+        await self.push_payloads(event['payloads'])
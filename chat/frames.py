@@ -0,0 +1,112 @@
+"""
+Builders for the frames the chat and notification consumers send to clients.
+
+Broadcast frames are encoded once by the sender, in every wire protocol
+(see chat/protocols.py), and travel through the channel layer ready-made,
+so recipients only forward them. `encode` is the JSON encoding.
+"""
+import json
+
+
+def encode(frame):
+    return json.dumps(frame, separators=(',', ':'))
+
+
+def serialize_sender(user):
+    return {
+        'id': user.id,
+        'email': user.email,
+        'first_name': user.first_name,
+        'last_name': user.last_name,
+    }
+
+
+def serialize_message(message):
+    return {
+        'id': message.id,
+        'content': message.content,
+        'sender': serialize_sender(message.sender),
+        'created_at': message.created_at.isoformat(),
+    }
+
+
+def chat_message_frame(room_id, message):
+    return {
+        'type': 'chat_message',
+        'room': int(room_id),
+        'message': serialize_message(message),
+    }
+
+
+def chat_messages_frame(room_id, messages):
+    """Several messages sent together in one batch, oldest first"""
+    return {
+        'type': 'chat_messages',
+        'room': int(room_id),
+        'messages': [serialize_message(message) for message in messages],
+    }
+
+
+def typing_frame(room_id, user, is_typing):
+    return {
+        'type': 'typing',
+        'room': int(room_id),
+        'user_id': user.id,
+        'email': user.email,
+        'is_typing': is_typing,
+    }
+
+
+def sync_frame(room_id, messages, complete, truncated=False):
+    return {
+        'type': 'sync',
+        'room': int(room_id),
+        'messages': [serialize_message(message) for message in messages],
+        'complete': complete,
+        'truncated': truncated,
+    }
+
+
+def presence_frame(room_id, online, offline, snapshot=False):
+    return {
+        'type': 'presence',
+        'room': int(room_id),
+        'online': online,
+        'offline': offline,
+        'snapshot': snapshot,
+    }
+
+
+# Room list notifications, sent to each user's notification socket
+
+
+def room_bumped_frame(room_id, message):
+    """A new message moved the room to the top of the list"""
+    return {
+        'type': 'room_bumped',
+        'room': int(room_id),
+        'last_message': serialize_message(message),
+    }
+
+
+def room_added_frame(room, participant_count):
+    """The user was added to a room, or created it"""
+    return {
+        'type': 'room_added',
+        'room': {
+            'id': room.id,
+            'name': room.name,
+            'room_type': room.room_type,
+            'participant_count': participant_count,
+            'created_at': room.created_at.isoformat(),
+        },
+    }
+
+
+def participants_added_frame(room_id, user_ids, participant_count):
+    return {
+        'type': 'participants_added',
+        'room': int(room_id),
+        'user_ids': sorted(user_ids),
+        'participant_count': participant_count,
+    }
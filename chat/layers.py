@@ -0,0 +1,242 @@
+import asyncio
+import fcntl
+import logging
+import os
+import random
+import string
+import struct
+
+import msgpack
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer
+
+logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct('!I')
+
+
+def pack_frame(payload):
+    body = msgpack.packb(payload, use_bin_type=True)
+    return HEADER.pack(len(body)) + body
+
+
+async def read_frame(reader):
+    """Reads one length-prefixed frame and returns it undecoded, header included"""
+    header = await reader.readexactly(HEADER.size)
+    (length,) = HEADER.unpack(header)
+    return header + await reader.readexactly(length)
+
+
+def unpack_frame(frame):
+    return msgpack.unpackb(frame[HEADER.size:], raw=False)
+
+
+class ChannelBroker:
+    """
+    Relays frames between the worker processes connected to a Unix socket.
+
+    The broker never decodes frames: every frame a worker writes is copied
+    to all other connected workers, which deliver it to their own local
+    group members and channels. A worker that stops reading and lets more
+    than `max_buffer` bytes pile up is disconnected rather than allowed to
+    grow the broker's memory.
+    """
+
+    def __init__(self, path, max_buffer=16 * 1024 * 1024):
+        self.path = path
+        self.max_buffer = max_buffer
+        self.clients = set()
+        self.handlers = set()
+        self.server = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            # Left behind by a broker that died; we hold the lock now
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self.handle_client, path=self.path)
+
+    async def handle_client(self, reader, writer):
+        self.clients.add(writer)
+        self.handlers.add(asyncio.current_task())
+        try:
+            while True:
+                frame = await read_frame(reader)
+                for client in list(self.clients):
+                    if client is writer:
+                        continue
+                    if client.transport.get_write_buffer_size() > self.max_buffer:
+                        logger.warning("Dropping channel layer worker that is not keeping up")
+                        self.clients.discard(client)
+                        client.close()
+                        continue
+                    client.write(frame)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.clients.discard(writer)
+            self.handlers.discard(asyncio.current_task())
+            writer.close()
+
+    async def close(self):
+        for client in list(self.clients):
+            client.close()
+        # Closed transports end each handler's read loop; let them finish
+        # instead of leaving them to be cancelled with the event loop.
+        await asyncio.gather(*self.handlers, return_exceptions=True)
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+
+class UnixSocketChannelLayer(InMemoryChannelLayer):
+    """
+    Channel layer for running several worker processes on one machine.
+
+    Each process keeps its own channels and group memberships in memory,
+    exactly like InMemoryChannelLayer. `group_send` delivers to local members
+    and also publishes the message through a broker on a Unix socket, so
+    every other process delivers it to its members too. Sends to a specific
+    channel owned by another process are routed the same way.
+
+    There is no separate broker to run: the first process to take the lock
+    file next to the socket hosts the broker, and if it dies the survivors
+    reconnect and one of them takes over. Messages published while no broker
+    is reachable are only delivered locally.
+    """
+
+    def __init__(self, path='/tmp/chat-channel-layer.sock', reconnect_delay=0.5, connect_timeout=2, **kwargs):
+        super().__init__(**kwargs)
+        self.path = str(path)
+        self.reconnect_delay = reconnect_delay
+        self.connect_timeout = connect_timeout
+        self.worker_id = ''.join(random.choice(string.ascii_letters) for _ in range(8))
+        self._loop = None
+        self._connected = None
+        self._writer = None
+        self._maintainer = None
+        self._broker = None
+        self._lock_file = None
+
+    # Channel names carry the worker id so sends can be routed to the owner
+
+    async def new_channel(self, prefix='specific.'):
+        return '%s%s!%s' % (
+            prefix,
+            self.worker_id,
+            ''.join(random.choice(string.ascii_letters) for _ in range(12)),
+        )
+
+    def is_local_channel(self, channel):
+        if '!' not in channel:
+            return True
+        return channel.split('!', 1)[0].endswith(self.worker_id)
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        if self.is_local_channel(channel):
+            return await super().send(channel, message)
+        self.require_valid_channel_name(channel)
+        await self.publish({'op': 'send', 'channel': channel, 'message': message})
+
+    async def group_add(self, group, channel):
+        # Members must be reachable before anyone publishes to them
+        await self.connect()
+        await super().group_add(group, channel)
+
+    async def group_send(self, group, message):
+        await super().group_send(group, message)
+        await self.publish({'op': 'group_send', 'group': group, 'message': message})
+
+    async def close(self):
+        if self._maintainer is not None:
+            self._maintainer.cancel()
+            self._maintainer = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._broker is not None:
+            await self._broker.close()
+            self._broker = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+        self._loop = None
+
+    # Broker connection
+
+    async def connect(self):
+        """
+        Starts the background connection to the broker on first use in an
+        event loop and waits for it. Later calls return immediately; lost
+        connections are re-established in the background.
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+
+        # Sockets and servers from a previous event loop died with it
+        self._loop = loop
+        self._connected = asyncio.Event()
+        self._writer = None
+        self._broker = None
+        self._maintainer = loop.create_task(self._maintain())
+        try:
+            await asyncio.wait_for(self._connected.wait(), timeout=self.connect_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Channel layer broker at %s is unreachable; delivering locally only", self.path)
+
+    async def publish(self, payload):
+        await self.connect()
+        if self._writer is None:
+            # Broker is down; the reconnect loop will pick it up again
+            return
+        self._writer.write(pack_frame(payload))
+        await self._writer.drain()
+
+    async def _maintain(self):
+        while True:
+            try:
+                await self._host_broker_if_free()
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except OSError:
+                await asyncio.sleep(self.reconnect_delay)
+                continue
+
+            self._writer = writer
+            self._connected.set()
+            try:
+                await self._read_loop(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                logger.info("Lost channel layer broker connection, reconnecting")
+            finally:
+                self._connected.clear()
+                self._writer = None
+                writer.close()
+            await asyncio.sleep(self.reconnect_delay)
+
+    async def _host_broker_if_free(self):
+        if self._lock_file is None:
+            lock_file = open(self.path + '.lock', 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                return
+            self._lock_file = lock_file
+        if self._broker is None:
+            self._broker = ChannelBroker(self.path)
+            await self._broker.start()
+
+    async def _read_loop(self, reader):
+        while True:
+            payload = unpack_frame(await read_frame(reader))
+            op = payload.get('op')
+            try:
+                if op == 'group_send':
+                    await InMemoryChannelLayer.group_send(self, payload['group'], payload['message'])
+                elif op == 'send' and self.is_local_channel(payload['channel']):
+                    await InMemoryChannelLayer.send(self, payload['channel'], payload['message'])
+            except ChannelFull:
+                pass
@@ -0,0 +1,102 @@
+import asyncio
+import multiprocessing
+import os
+import statistics
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.layers import UnixSocketChannelLayer
+
+GROUP = 'harness'
+
+
+def run_worker(index, path, messages, barrier, results):
+    results.put(asyncio.run(worker_main(index, path, messages, barrier)))
+
+
+async def worker_main(index, path, messages, barrier):
+    loop = asyncio.get_running_loop()
+    layer = UnixSocketChannelLayer(path=path, capacity=messages + 10)
+    channel = await layer.new_channel()
+    await layer.group_add(GROUP, channel)
+
+    # Everyone is connected and in the group before anything is sent
+    await loop.run_in_executor(None, barrier.wait)
+
+    started = time.perf_counter()
+    if index == 0:
+        for seq in range(messages):
+            await layer.group_send(GROUP, {'type': 'harness.message', 'seq': seq, 'sent_at': time.time()})
+
+    latencies = []
+    received = []
+    try:
+        while len(received) < messages:
+            message = await asyncio.wait_for(layer.receive(channel), timeout=10)
+            latencies.append(time.time() - message['sent_at'])
+            received.append(message['seq'])
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.perf_counter() - started
+
+    # Keep the broker host alive until every worker is done
+    await loop.run_in_executor(None, barrier.wait)
+    await layer.close()
+
+    return {
+        'worker': index,
+        'pid': os.getpid(),
+        'received': len(received),
+        'in_order': received == sorted(received),
+        'elapsed': elapsed,
+        'latencies': latencies,
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs N worker processes on the Unix socket channel layer, sends group "
+        "messages from one of them and checks every worker receives them all."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--messages', type=int, default=1000)
+        parser.add_argument('--socket', help="Socket path (defaults to a temporary file)")
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        messages = options['messages']
+        path = options['socket'] or os.path.join(tempfile.mkdtemp(), 'layer.sock')
+
+        ctx = multiprocessing.get_context('spawn')
+        barrier = ctx.Barrier(workers)
+        results = ctx.Queue()
+        processes = [
+            ctx.Process(target=run_worker, args=(index, path, messages, barrier, results))
+            for index in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        reports = sorted((results.get(timeout=120) for _ in processes), key=lambda r: r['worker'])
+        for process in processes:
+            process.join()
+
+        failed = False
+        for report in reports:
+            latencies = sorted(report['latencies']) or [0]
+            ok = report['received'] == messages and report['in_order']
+            failed = failed or not ok
+            self.stdout.write(
+                f"worker {report['worker']} (pid {report['pid']}): "
+                f"{report['received']}/{messages} received, in order: {report['in_order']}, "
+                f"{report['received'] / report['elapsed']:.0f} msg/s, "
+                f"p50 {statistics.median(latencies) * 1000:.2f}ms, "
+                f"p99 {latencies[int(len(latencies) * 0.99) - 1 if len(latencies) > 1 else 0] * 1000:.2f}ms"
+            )
+
+        if failed:
+            raise CommandError("Some workers did not receive every message")
+        self.stdout.write(self.style.SUCCESS(f"All {workers} workers received {messages} messages"))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from chat.models import Message
+from chat.search import install_fts, rebuild_fts
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuilds the full-text message search index from the message table. "
+        "Also recreates the index triggers, which SQLite drops whenever a "
+        "migration rebuilds the message table."
+    )
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError("The full-text message index is only used on SQLite")
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            install_fts(cursor)
+            rebuild_fts(cursor)
+
+        self.stdout.write(self.style.SUCCESS(f"Indexed {Message.objects.count()} messages"))
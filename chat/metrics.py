@@ -0,0 +1,373 @@
+"""
+Process-local metrics in the Prometheus text format.
+
+- MetricsMiddleware: HTTP latency, status and ORM query counts per view
+- WebSocketMetricsMiddleware: live connections, wraps the websocket router
+- InstrumentedConsumerMixin: latency and query counts per consumer event
+- instrument_channel_layer: channel layer group call timings
+
+Queries are counted by an execute wrapper installed on every new database
+connection, adding to a counter held in a context variable for the request
+or event being handled. The existing `stats()` of the caches, writer,
+typing throttle and outbound queues are exported as gauges at scrape time,
+as are the channel layer's group memberships.
+"""
+import ipaddress
+import threading
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def format_labels(self, labels, extra=()):
+        pairs = list(zip(self.labelnames, labels)) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (
+            '%s="%s"' % (name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+            for name, value in pairs
+        )
+        return '{%s}' % ','.join(escaped)
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            values = list(self.values.items())
+        for labels, value in sorted(values):
+            lines.extend(self.expose_value(labels, value))
+        return lines
+
+    def expose_value(self, labels, value):
+        return [f'{self.name}{self.format_labels(labels)} {value}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value, *labels):
+        with self._lock:
+            self.values[labels] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        with self._lock:
+            state = self.values.get(labels)
+            if state is None:
+                # Per-bucket counts (not cumulative), then sum and count
+                state = self.values[labels] = [[0] * len(self.buckets), 0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def expose_value(self, labels, state):
+        counts, total, count = state
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f'{self.name}_bucket{self.format_labels(labels, [("le", bound)])} {cumulative}')
+        lines.append(f'{self.name}_bucket{self.format_labels(labels, [("le", "+Inf")])} {count}')
+        lines.append(f'{self.name}_sum{self.format_labels(labels)} {total}')
+        lines.append(f'{self.name}_count{self.format_labels(labels)} {count}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """`collector()` returns extra metrics, computed at scrape time"""
+        self.collectors.append(collector)
+
+    def expose(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.expose())
+        for collector in self.collectors:
+            for metric in collector():
+                lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+http_request_duration = registry.register(Histogram(
+    'chat_http_request_duration_seconds', 'HTTP request latency by view', ('view', 'method'),
+))
+http_requests = registry.register(Counter(
+    'chat_http_requests_total', 'HTTP responses by view and status', ('view', 'method', 'status'),
+))
+http_request_queries = registry.register(Histogram(
+    'chat_http_request_queries', 'Database queries per HTTP request', ('view',), buckets=QUERY_BUCKETS,
+))
+ws_event_duration = registry.register(Histogram(
+    'chat_ws_event_duration_seconds', 'Consumer handler latency by event type', ('consumer', 'event'),
+))
+ws_event_queries = registry.register(Histogram(
+    'chat_ws_event_queries', 'Database queries per consumer event', ('consumer', 'event'), buckets=QUERY_BUCKETS,
+))
+ws_connections = registry.register(Gauge(
+    'chat_ws_connections', 'Open WebSocket connections',
+))
+ws_connections_total = registry.register(Counter(
+    'chat_ws_connections_total', 'Accepted WebSocket connections',
+))
+channel_layer_duration = registry.register(Histogram(
+    'chat_channel_layer_seconds', 'Channel layer call latency', ('operation',),
+))
+rate_limited = registry.register(Counter(
+    'chat_rate_limited_total', 'Sends refused by a rate limit', ('limit', 'path'),
+))
+ws_connections.set(0)
+ws_connections_total.inc(amount=0)
+
+
+# Query counting
+
+_query_count = ContextVar('chat_query_count', default=None)
+
+
+def count_queries(execute, sql, params, many, context):
+    counter = _query_count.get()
+    if counter is not None:
+        counter[0] += 1
+    return execute(sql, params, many, context)
+
+
+def install_query_counter(connection):
+    """Called for every new connection (see chat/signals.py)"""
+    if count_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_queries)
+
+
+class QueryCounter:
+    """
+    Counts queries made while active, including from sync_to_async threads,
+    which run in a copy of the caller's context sharing the same counter.
+    """
+
+    def __enter__(self):
+        self.counter = [0]
+        self.token = _query_count.set(self.counter)
+        return self
+
+    def __exit__(self, *exc_info):
+        _query_count.reset(self.token)
+
+    @property
+    def count(self):
+        return self.counter[0]
+
+
+# HTTP
+
+class MetricsMiddleware:
+    """Records latency, status and query count per resolved view"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        with QueryCounter() as queries:
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - started
+
+        match = getattr(request, 'resolver_match', None)
+        view = (match.view_name or match._func_path) if match else 'unresolved'
+        http_request_duration.observe(elapsed, view, request.method)
+        http_requests.inc(view, request.method, str(response.status_code))
+        http_request_queries.observe(queries.count, view)
+        return response
+
+
+# WebSocket
+
+class WebSocketMetricsMiddleware:
+    """ASGI middleware counting open WebSocket connections"""
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    async def __call__(self, scope, receive, send):
+        from channels.layers import get_channel_layer
+
+        instrument_channel_layer(get_channel_layer())
+        accepted = False
+
+        async def counting_send(message):
+            nonlocal accepted
+            if message['type'] == 'websocket.accept' and not accepted:
+                accepted = True
+                ws_connections.inc()
+                ws_connections_total.inc()
+            await send(message)
+
+        try:
+            return await self.inner(scope, receive, counting_send)
+        finally:
+            if accepted:
+                ws_connections.dec()
+
+
+class InstrumentedConsumerMixin:
+    """
+    Times every dispatched event and counts its queries. Handlers can set
+    `self.metrics_event` to label an event more precisely than its ASGI
+    type, e.g. by the type of the client frame being handled.
+    """
+    metrics_event = None
+
+    async def dispatch(self, message):
+        self.metrics_event = None
+        started = time.perf_counter()
+        with QueryCounter() as queries:
+            try:
+                await super().dispatch(message)
+            finally:
+                event = self.metrics_event or message['type']
+                consumer = type(self).__name__
+                ws_event_duration.observe(time.perf_counter() - started, consumer, event)
+                ws_event_queries.observe(queries.count, consumer, event)
+
+
+def instrument_channel_layer(layer):
+    """
+    Wraps a channel layer's group calls with timings, once per layer
+    instance. Plain `send` is left alone: in-memory layers call it once per
+    member inside `group_send`.
+    """
+    if layer is None or getattr(layer, '_metrics_instrumented', False):
+        return
+    layer._metrics_instrumented = True
+
+    def timed(operation, method):
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                channel_layer_duration.observe(time.perf_counter() - started, operation)
+        return wrapper
+
+    for operation in ('group_send', 'group_add', 'group_discard'):
+        setattr(layer, operation, timed(operation, getattr(layer, operation)))
+
+
+# Gauges from existing stats() at scrape time
+
+def collect_component_stats():
+    from channels.layers import channel_layers
+
+    from chat.cache import membership_cache
+    from chat.middleware import user_cache
+    from chat.outbound import outbound_registry
+    from chat.presence import presence_registry
+    from chat.ratelimit import rate_limiter
+    from chat.typing_indicators import typing_throttle
+    from chat.writer import message_writer
+
+    components = {
+        'membership_cache': membership_cache,
+        'auth_cache': user_cache,
+        'message_writer': message_writer,
+        'typing_throttle': typing_throttle,
+        'outbound': outbound_registry,
+        'presence': presence_registry,
+        'rate_limiter': rate_limiter,
+    }
+    for component, source in components.items():
+        for key, value in source.stats().items():
+            if isinstance(value, (int, float)):
+                gauge = Gauge(f'chat_{component}_{key}', f'{component} {key.replace("_", " ")}')
+                gauge.set(value)
+                yield gauge
+
+    # Per connection, only for the slowest few to bound the label values
+    connection_gauges = {
+        key: Gauge(
+            f'chat_outbound_connection_{key}',
+            f'Outbound queue {key.replace("_", " ")} of the slowest connections',
+            ('channel',),
+        )
+        for key in ('depth', 'dropped_typing', 'dropped_messages')
+    }
+    for channel_name, stats in outbound_registry.slowest(settings.CHAT_METRICS_SLOWEST_CONNECTIONS):
+        for key, gauge in connection_gauges.items():
+            gauge.set(stats[key], channel_name)
+    yield from connection_gauges.values()
+
+    groups = Gauge('chat_channel_layer_groups', 'Groups with local members', ('alias',))
+    memberships = Gauge('chat_channel_layer_group_memberships', 'Local group memberships', ('alias',))
+    for alias, layer in list(channel_layers.backends.items()):
+        # In-process layers keep their groups in memory; others can't be inspected
+        layer_groups = getattr(layer, 'groups', None)
+        if isinstance(layer_groups, dict):
+            groups.set(len(layer_groups), alias)
+            memberships.set(sum(len(members) for members in layer_groups.values()), alias)
+    yield groups
+    yield memberships
+
+
+registry.add_collector(collect_component_stats)
+
+
+def client_allowed(request):
+    address = request.META.get('REMOTE_ADDR', '')
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(address in ipaddress.ip_network(network) for network in settings.CHAT_METRICS_ALLOWED_NETWORKS)
+
+
+def metrics_view(request):
+    if not client_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(registry.expose(), content_type='text/plain; version=0.0.4; charset=utf-8')
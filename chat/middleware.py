@@ -1,20 +1,95 @@
-from channels.db import database_sync_to_async
+import asyncio
+from functools import partial
+
 from channels.middleware import BaseMiddleware
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
 from rest_framework_simplejwt.tokens import AccessToken
 from django.contrib.auth import get_user_model
 
+from chat.cache import LRUCache
+
 User = get_user_model()
 
-@database_sync_to_async
-def get_user_from_token(token_string):
+
+class UserCache(LRUCache):
+    """
+    Validated users by id, so reconnect storms don't turn into a query per
+    handshake. Entries are invalidated when the user is saved or deleted
+    (see chat/signals.py); the TTL bounds changes made by other processes.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self._generation = 0
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def store(self, user_id, generation, user):
+        # Don't cache a user that an invalidation may have outdated while
+        # it was being loaded
+        if generation == self._generation:
+            self.set(user_id, user)
+
+    def invalidate(self, user_id):
+        self._generation += 1
+        self.delete(user_id)
+        # Later handshakes mustn't join a lookup that started before
+        _pending_lookups.pop(user_id, None)
+
+    def clear(self):
+        self._generation += 1
+        super().clear()
+
+
+user_cache = UserCache(maxsize=settings.CHAT_AUTH_CACHE_SIZE, ttl=settings.CHAT_AUTH_CACHE_TTL)
+
+# Lookups in flight, so concurrent handshakes for one user share a query
+_pending_lookups = {}
+
+
+async def load_active_user(user_id):
+    return await User.objects.filter(id=user_id, is_active=True).afirst()
+
+
+async def load_and_cache_user(user_id):
+    generation = user_cache.generation
+    user = await load_active_user(user_id)
+    if user is not None:
+        user_cache.store(user_id, generation, user)
+    return user
+
+
+def _forget_lookup(user_id, lookup):
+    # An invalidation may already have replaced it with a newer one
+    if _pending_lookups.get(user_id) is lookup:
+        del _pending_lookups[user_id]
+
+
+async def get_user_from_token(token_string):
     try:
         access_token = AccessToken(token_string)
-        user_id = access_token['user_id']
-        return User.objects.get(id=user_id)
+        user_id = str(access_token['user_id'])
     except Exception:
         return AnonymousUser()
 
+    user = user_cache.get(user_id)
+    if user is None:
+        lookup = _pending_lookups.get(user_id)
+        if lookup is None:
+            lookup = asyncio.ensure_future(load_and_cache_user(user_id))
+            _pending_lookups[user_id] = lookup
+            lookup.add_done_callback(partial(_forget_lookup, user_id))
+        try:
+            user = await asyncio.shield(lookup)
+        except Exception:
+            return AnonymousUser()
+        if user is None:
+            return AnonymousUser()
+    return user
+
 class JWTAuthMiddleware(BaseMiddleware):
     async def __call__(self, scope, receive, send):
         # Extract token from query string or headers
@@ -0,0 +1,70 @@
+# Generated by Django 5.2.18 on 2026-10-17 22:57
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def start_cursors_at_latest_message(apps, schema_editor):
+    """
+    Existing history counts as read: per-message read flags were never
+    per reader, so there is no reliable read state to carry over.
+    """
+    Room = apps.get_model('chat', 'Room')
+    Message = apps.get_model('chat', 'Message')
+    ReadCursor = apps.get_model('chat', 'ReadCursor')
+
+    latest = dict(
+        Message.objects.order_by().values('room').annotate(latest=Max('id')).values_list('room', 'latest')
+    )
+    memberships = Room.participants.through.objects.filter(room_id__in=latest).values_list('room_id', 'user_id')
+    ReadCursor.objects.bulk_create(
+        [
+            ReadCursor(room_id=room_id, user_id=user_id, last_read_message_id=latest[room_id])
+            for room_id, user_id in memberships
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_message_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RemoveField(
+            model_name='message',
+            name='is_read',
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', 'id'], name='chat_messag_room_id_12c833_idx'),
+        ),
+        migrations.AddField(
+            model_name='readcursor',
+            name='room',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_cursors', to='chat.room'),
+        ),
+        migrations.AddField(
+            model_name='readcursor',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_cursors', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='readcursor',
+            constraint=models.UniqueConstraint(fields=('user', 'room'), name='unique_read_cursor'),
+        ),
+        migrations.RunPython(start_cursors_at_latest_message, migrations.RunPython.noop),
+    ]
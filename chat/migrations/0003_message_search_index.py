@@ -0,0 +1,29 @@
+from django.db import migrations
+
+from chat.search import install_fts, rebuild_fts, uninstall_fts
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        install_fts(cursor)
+        rebuild_fts(cursor)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        uninstall_fts(cursor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_read_cursors'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
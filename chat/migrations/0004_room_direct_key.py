@@ -0,0 +1,63 @@
+# Generated by Django 5.2.18 on 2026-10-17 23:13
+
+from collections import defaultdict
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def merge_duplicate_direct_rooms(apps, schema_editor):
+    """
+    Gives every two-person direct room its key. When a pair of users has
+    several direct rooms, the oldest one is kept: the others' messages move
+    into it, read cursors keep the furthest position, and they are deleted.
+    """
+    Room = apps.get_model('chat', 'Room')
+    Message = apps.get_model('chat', 'Message')
+    ReadCursor = apps.get_model('chat', 'ReadCursor')
+    Membership = Room.participants.through
+
+    members = defaultdict(set)
+    memberships = Membership.objects.filter(room__room_type='direct').values_list('room_id', 'user_id')
+    for room_id, user_id in memberships:
+        members[room_id].add(user_id)
+
+    rooms_by_key = defaultdict(list)
+    for room_id, user_ids in members.items():
+        if len(user_ids) == 2:
+            low, high = sorted(user_ids)
+            rooms_by_key[f"{low}:{high}"].append(room_id)
+
+    for key, room_ids in rooms_by_key.items():
+        keeper, *duplicates = sorted(room_ids)
+        if duplicates:
+            Message.objects.filter(room_id__in=duplicates).update(room_id=keeper)
+
+            furthest = ReadCursor.objects.filter(room_id__in=[keeper, *duplicates]).values('user_id').annotate(
+                last_read=Max('last_read_message_id')
+            )
+            for row in furthest:
+                ReadCursor.objects.update_or_create(
+                    room_id=keeper, user_id=row['user_id'], defaults={'last_read_message_id': row['last_read']}
+                )
+
+            latest = Room.objects.filter(id__in=room_ids).aggregate(latest=Max('updated_at'))['latest']
+            Room.objects.filter(id__in=duplicates).delete()
+            Room.objects.filter(id=keeper).update(updated_at=latest)
+        Room.objects.filter(id=keeper).update(direct_key=key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_message_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='direct_key',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, unique=True),
+        ),
+        migrations.RunPython(merge_duplicate_direct_rooms, migrations.RunPython.noop),
+    ]
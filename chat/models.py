@@ -1,5 +1,6 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.conf import settings
+from django.utils import timezone
 
 
 class Room(models.Model):
@@ -22,6 +23,9 @@ class Room(models.Model):
     )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # "<lower user id>:<higher user id>" for direct rooms, so each pair of
+    # users has at most one DM and finding it is one unique index lookup
+    direct_key = models.CharField(max_length=64, unique=True, null=True, blank=True, editable=False)
 
 
     class Meta:
@@ -44,6 +48,28 @@ class Room(models.Model):
         """Returns the last message in this room"""
         return self.messages.first()  # Already ordered by -created_at
 
+    @staticmethod
+    def direct_key_for(user_id, other_user_id):
+        """Canonical key of the direct room between two users, in either order"""
+        low, high = sorted((int(user_id), int(other_user_id)))
+        return f"{low}:{high}"
+
+    @classmethod
+    def get_or_create_direct(cls, user, other, name=None):
+        """Returns (room, created) for the direct room between two users"""
+        key = cls.direct_key_for(user.id, other.id)
+        room = cls.objects.filter(direct_key=key).first()
+        if room is not None:
+            return room, False
+        try:
+            with transaction.atomic():
+                room = cls.objects.create(name=name, room_type='direct', created_by=user, direct_key=key)
+                room.participants.add(user, other)
+        except IntegrityError:
+            # Someone created it concurrently
+            return cls.objects.get(direct_key=key), False
+        return room, True
+
 
 class Message(models.Model):
     """
@@ -52,7 +78,6 @@ class Message(models.Model):
     room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='messages')
     sender = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='sent_messages')
     content = models.TextField()
-    is_read = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
@@ -61,14 +86,67 @@ class Message(models.Model):
         indexes = [
             models.Index(fields=['room', '-created_at']),
             models.Index(fields=['sender', '-created_at']),
+            models.Index(fields=['room', 'id']),  # Unread counts are id ranges
         ]
 
     def __str__(self):
         return f"{self.sender.email}: {self.content[:50]}"
-    
-    def mark_as_read(self):
-        """Mark message as read"""
-        if not self.is_read:
-            self.is_read = True
-            self.save(update_fields=['is_read'])
+
+
+class ReadCursor(models.Model):
+    """
+    How far a user has read in a room: every message with an id up to
+    `last_read_message_id` counts as read for that user.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='read_cursors')
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='read_cursors')
+    last_read_message_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'room'], name='unique_read_cursor'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} read room {self.room_id} up to {self.last_read_message_id}"
+
+    @classmethod
+    def mark_read(cls, user, room_id, message_id=None):
+        """
+        Marks the room read up to `message_id` (default: its latest message)
+        in a single write. The cursor never moves backwards. Returns the
+        cursor position, or None if the message isn't in the room.
+        """
+        messages = Message.objects.filter(room_id=room_id)
+        if message_id is None:
+            message_id = messages.order_by('-id').values_list('id', flat=True).first() or 0
+        elif not messages.filter(id=message_id).exists():
+            return None
+
+        cursors = cls.objects.filter(user=user, room_id=room_id)
+
+        def advance():
+            return cursors.filter(last_read_message_id__lt=message_id).update(
+                last_read_message_id=message_id, updated_at=timezone.now()
+            )
+
+        if advance():
+            return message_id
+
+        _, created = cls.objects.get_or_create(
+            user=user, room_id=room_id, defaults={'last_read_message_id': message_id}
+        )
+        # A concurrent request may have created the cursor behind us
+        if created or advance():
+            return message_id
+        return cursors.values_list('last_read_message_id', flat=True).get()
+
+    @classmethod
+    def unread_count(cls, user, room_id):
+        """Messages from others after the user's cursor, as one indexed range count"""
+        last_read = cls.objects.filter(user=user, room_id=room_id).values_list(
+            'last_read_message_id', flat=True
+        ).first() or 0
+        return Message.objects.filter(room_id=room_id, id__gt=last_read).exclude(sender=user).count()
 
@@ -0,0 +1,77 @@
+"""
+Room list updates pushed to each user's notification socket.
+
+Whatever changes a room listing sends a small delta instead of making
+clients refetch the list: `room_bumped` for a new message, `room_added`
+when a room appears in the user's list and `participants_added` when
+others join one of their rooms. Frames are encoded once per wire protocol
+and sent ready-made.
+
+NotificationConsumer connections join the `user_<id>` group and, for each
+of the user's rooms, the room's `room_notifications_<id>` group. Room
+events are sent once to the room's group rather than to every member's,
+so a message costs one group_send however large the room; `room_added`
+tells the sockets of the users added to join the new room's group.
+"""
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+
+from chat.frames import participants_added_frame, room_added_frame, room_bumped_frame
+from chat.protocols import encode_all
+
+
+def user_group(user_id):
+    return f'user_{user_id}'
+
+
+def room_group(room_id):
+    return f'room_notifications_{room_id}'
+
+
+async def notify_users(user_ids, frame, join_room=None):
+    layer = get_channel_layer()
+    event = {'type': 'notification', 'payloads': encode_all(frame)}
+    if join_room is not None:
+        event['join_room'] = join_room
+    for user_id in user_ids:
+        await layer.group_send(user_group(user_id), event)
+
+
+def notify_users_on_commit(user_ids, frame, join_room=None):
+    """For sync callers: sent once the current transaction has committed"""
+    user_ids = list(user_ids)
+    transaction.on_commit(lambda: async_to_sync(notify_users)(user_ids, frame, join_room))
+
+
+async def notify_room(room_id, frame, exclude=()):
+    """Sends a frame to every member of a room with a notification socket"""
+    await get_channel_layer().group_send(room_group(room_id), {
+        'type': 'room_notification',
+        'room': int(room_id),
+        'exclude': sorted(exclude),
+        'payloads': encode_all(frame),
+    })
+
+
+def notify_room_on_commit(room_id, frame, exclude=()):
+    transaction.on_commit(lambda: async_to_sync(notify_room)(room_id, frame, exclude))
+
+
+async def notify_room_bumped(room_id, message):
+    await notify_room(room_id, room_bumped_frame(room_id, message))
+
+
+def notify_room_bumped_on_commit(room_id, message):
+    notify_room_on_commit(room_id, room_bumped_frame(room_id, message))
+
+
+def notify_room_added_on_commit(user_ids, room, participant_count):
+    notify_users_on_commit(user_ids, room_added_frame(room, participant_count), join_room=room.id)
+
+
+def notify_participants_added(room, added_ids, participant_count):
+    """New members get the room; existing ones its new participant count"""
+    added_ids = set(added_ids)
+    notify_room_added_on_commit(added_ids, room, participant_count)
+    notify_room_on_commit(room.id, participants_added_frame(room.id, added_ids, participant_count), exclude=added_ids)
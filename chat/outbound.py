@@ -0,0 +1,142 @@
+import asyncio
+from collections import deque
+
+from django.conf import settings
+
+
+DISCONNECT = 'disconnect'
+DROP_OLDEST = 'drop_oldest'
+
+
+class OutboundQueue:
+    """
+    Bounded queue of frames waiting to be written to one WebSocket.
+
+    Group events are queued instead of awaited inline, and a single sender
+    task per connection drains the queue in order. When the queue is full:
+    - droppable frames (typing indicators) are dropped first, newest or
+      queued, since a later one supersedes them anyway
+    - otherwise the `overflow_policy` applies: DISCONNECT refuses the frame
+      so the caller can close the connection, DROP_OLDEST discards the
+      oldest queued frame to make room
+    """
+
+    def __init__(self, send, maxsize=256, overflow_policy=DISCONNECT):
+        self.send = send
+        self.maxsize = maxsize
+        self.overflow_policy = overflow_policy
+        self.frames = deque()
+        self.sent = 0
+        self.dropped_typing = 0
+        self.dropped_messages = 0
+        self.overflowed = False
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self.frames)
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def put(self, frame, droppable=False):
+        """
+        Queues a frame (keyword arguments for `send`). Returns False when the
+        queue overflowed and the connection should be dropped.
+        """
+        if len(self.frames) >= self.maxsize and not self._make_room(droppable):
+            return droppable or self.overflow_policy != DISCONNECT
+        self.frames.append((frame, droppable))
+        self._wakeup.set()
+        return True
+
+    def _make_room(self, droppable):
+        if droppable:
+            self.dropped_typing += 1
+            return False
+        for index, (_, queued_droppable) in enumerate(self.frames):
+            if queued_droppable:
+                del self.frames[index]
+                self.dropped_typing += 1
+                return True
+        if self.overflow_policy == DROP_OLDEST:
+            self.frames.popleft()
+            self.dropped_messages += 1
+            return True
+        return False
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self.frames:
+                frame, _ = self.frames.popleft()
+                await self.send(**frame)
+                self.sent += 1
+
+    def stats(self):
+        return {
+            'depth': len(self.frames),
+            'sent': self.sent,
+            'dropped_typing': self.dropped_typing,
+            'dropped_messages': self.dropped_messages,
+        }
+
+
+class OutboundRegistry:
+    """Tracks the live outbound queues of this process for reporting"""
+
+    def __init__(self):
+        self.queues = {}
+        self.disconnected = 0
+        # Drops from connections that have since closed
+        self.closed_dropped_typing = 0
+        self.closed_dropped_messages = 0
+
+    def register(self, channel_name, queue):
+        self.queues[channel_name] = queue
+
+    def unregister(self, channel_name):
+        queue = self.queues.pop(channel_name, None)
+        if queue is not None:
+            self.closed_dropped_typing += queue.dropped_typing
+            self.closed_dropped_messages += queue.dropped_messages
+
+    def slowest(self, limit):
+        """Depth and drop counts of the `limit` connections furthest behind, deepest first"""
+        behind = [
+            (channel_name, queue.stats()) for channel_name, queue in self.queues.items()
+            if len(queue) or queue.dropped_typing or queue.dropped_messages
+        ]
+        behind.sort(
+            key=lambda item: (item[1]['depth'], item[1]['dropped_messages'], item[1]['dropped_typing']),
+            reverse=True,
+        )
+        return behind[:limit]
+
+    def stats(self):
+        queues = list(self.queues.values())
+        return {
+            'connections': len(queues),
+            'total_depth': sum(len(queue) for queue in queues),
+            'max_depth': max((len(queue) for queue in queues), default=0),
+            'dropped_typing': self.closed_dropped_typing + sum(q.dropped_typing for q in queues),
+            'dropped_messages': self.closed_dropped_messages + sum(q.dropped_messages for q in queues),
+            'slow_consumers_disconnected': self.disconnected,
+        }
+
+
+outbound_registry = OutboundRegistry()
+
+
+def create_outbound_queue(send):
+    return OutboundQueue(
+        send,
+        maxsize=settings.CHAT_OUTBOUND_QUEUE_SIZE,
+        overflow_policy=settings.CHAT_OUTBOUND_OVERFLOW_POLICY,
+    )
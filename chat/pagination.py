@@ -0,0 +1,108 @@
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+
+
+class MessageKeysetPagination(BasePagination):
+    """
+    Keyset (cursor) pagination for a room's message history.
+
+    Pages are addressed by message ids instead of offsets:
+    - ?before=<id>  messages older than <id>
+    - ?after=<id>   messages newer than <id>
+    - neither       the newest page
+
+    Each page is a range scan on the (room, -created_at) index, so page N
+    costs the same as page 1. Results are always returned newest first.
+    """
+    page_size = 50
+    max_page_size = 200
+    page_size_query_param = 'page_size'
+    before_query_param = 'before'
+    after_query_param = 'after'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size_value = self.get_page_size(request)
+        before = self.get_cursor(request, self.before_query_param)
+        after = self.get_cursor(request, self.after_query_param)
+
+        if before is not None and after is not None:
+            raise ValidationError({'error': "Use either 'before' or 'after', not both."})
+
+        if after is not None:
+            queryset = self.filter_after(queryset, after).order_by('created_at', 'id')
+        else:
+            if before is not None:
+                queryset = self.filter_before(queryset, before)
+            queryset = queryset.order_by('-created_at', '-id')
+
+        # Fetch one extra row to know whether another page exists
+        rows = list(queryset[:self.page_size_value + 1])
+        self.has_more = len(rows) > self.page_size_value
+        rows = rows[:self.page_size_value]
+
+        if after is not None:
+            rows.reverse()
+
+        self.direction = 'after' if after is not None else 'before'
+        self.page = rows
+        return rows
+
+    def get_paginated_response(self, data):
+        return Response({
+            'results': data,
+            'has_more': self.has_more,
+            'next_before': self.page[-1].id if self.page else None,
+            'next_after': self.page[0].id if self.page else None,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'results': schema,
+                'has_more': {'type': 'boolean'},
+                'next_before': {'type': 'integer', 'nullable': True},
+                'next_after': {'type': 'integer', 'nullable': True},
+            },
+        }
+
+    def get_page_size(self, request):
+        value = request.query_params.get(self.page_size_query_param)
+        if value is None:
+            return self.page_size
+        try:
+            size = int(value)
+        except ValueError:
+            raise ValidationError({self.page_size_query_param: ['Must be an integer.']})
+        return max(1, min(size, self.max_page_size))
+
+    def get_cursor(self, request, param):
+        value = request.query_params.get(param)
+        if value in (None, ''):
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            raise ValidationError({param: ['Must be a message id.']})
+
+    def resolve_cursor(self, queryset, message_id):
+        """Returns (created_at, id) of the cursor message within the room"""
+        created_at = queryset.filter(id=message_id).values_list('created_at', flat=True).first()
+        if created_at is None:
+            raise ValidationError({'error': f'Unknown message cursor: {message_id}'})
+        return created_at, message_id
+
+    def filter_before(self, queryset, message_id):
+        created_at, pk = self.resolve_cursor(queryset, message_id)
+        # The range bound keeps this an index range scan; the exclude only
+        # breaks ties between messages sharing the cursor's timestamp.
+        return queryset.filter(created_at__lte=created_at).exclude(
+            created_at=created_at, id__gte=pk
+        )
+
+    def filter_after(self, queryset, message_id):
+        created_at, pk = self.resolve_cursor(queryset, message_id)
+        return queryset.filter(created_at__gte=created_at).exclude(
+            created_at=created_at, id__lte=pk
+        )
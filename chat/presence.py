@@ -0,0 +1,251 @@
+import asyncio
+import logging
+import os
+import time
+from collections import defaultdict
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from chat.frames import presence_frame
+from chat.protocols import encode_all
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_GROUP = 'chat_presence'
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel: scheduling and cancelling are O(1) and expiry only
+    looks at the slots the clock has moved past since the previous call.
+    Deadlines more than one revolution ahead stay in their slot until due.
+    """
+
+    def __init__(self, tick=1.0, slots=128):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]
+        self.slot_of = {}
+        self.position = None
+
+    def __len__(self):
+        return len(self.slot_of)
+
+    def schedule(self, key, deadline):
+        self.cancel(key)
+        index = int(deadline // self.tick) % len(self.slots)
+        self.slots[index][key] = deadline
+        self.slot_of[key] = index
+
+    def cancel(self, key):
+        index = self.slot_of.pop(key, None)
+        if index is not None:
+            del self.slots[index][key]
+
+    def advance(self, now):
+        """Removes and returns the keys whose deadline is at or before `now`"""
+        current = int(now // self.tick)
+        # The first call has no previous position, so it sweeps every slot
+        first = current - len(self.slots) + 1
+        if self.position is not None:
+            first = max(self.position, first)
+        expired = []
+        for tick in range(first, current + 1):
+            slot = self.slots[tick % len(self.slots)]
+            for key, deadline in list(slot.items()):
+                if deadline <= now:
+                    del slot[key]
+                    del self.slot_of[key]
+                    expired.append(key)
+        self.position = current
+        return expired
+
+
+class PresenceRegistry:
+    """
+    Who is online in which room, kept in memory and shared between workers.
+
+    Consumers report connects, disconnects and client heartbeats. Each
+    (room, user) entry expires `ttl` seconds after it was last refreshed,
+    tracked on a timer wheel, so a client that vanished without closing its
+    socket drops out too. Several tabs of one user count once.
+
+    Changes are collected and flushed every `flush_interval` seconds: one
+    `presence` frame per room to that room's group, and one message to the
+    other worker processes on the `chat_presence` group, which apply it to
+    their own copy without rebroadcasting. Every `ttl / 3` seconds that
+    message also lists all entries this process owns (those whose
+    heartbeats arrive here), keeping them alive elsewhere; only the owner
+    announces an entry going offline. Nothing here touches the database.
+    """
+
+    def __init__(self, ttl=60.0, flush_interval=1.0, tick=1.0):
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.origin = f'{os.getpid()}-{id(self)}'
+        self.rooms = defaultdict(set)
+        self.local_connections = defaultdict(int)
+        self.owned = set()
+        self.wheel = TimerWheel(tick=tick)
+        self.pending = defaultdict(dict)
+        self.broadcast_frames = 0
+        self.expired = 0
+        self._last_announce = 0
+        self._loop = None
+        self._tasks = []
+        self._channel = None
+
+    # Queries
+
+    def online_members(self, room_id):
+        """User ids currently online in a room"""
+        return sorted(self.rooms.get(int(room_id), ()))
+
+    def is_online(self, room_id, user_id):
+        return user_id in self.rooms.get(int(room_id), ())
+
+    # Updates from this process's consumers
+
+    def connect(self, room_id, user_id):
+        self._ensure_started()
+        key = (int(room_id), user_id)
+        self.local_connections[key] += 1
+        self._refresh(key, owned=True)
+
+    def heartbeat(self, room_id, user_id):
+        key = (int(room_id), user_id)
+        if self.local_connections.get(key):
+            self._refresh(key, owned=True)
+
+    def disconnect(self, room_id, user_id):
+        key = (int(room_id), user_id)
+        remaining = self.local_connections.get(key, 0) - 1
+        if remaining > 0:
+            self.local_connections[key] = remaining
+            return
+        self.local_connections.pop(key, None)
+        if key in self.owned:
+            self._remove(key, announce=True)
+
+    def _refresh(self, key, owned):
+        room_id, user_id = key
+        self.wheel.schedule(key, time.monotonic() + self.ttl)
+        if owned:
+            self.owned.add(key)
+        if user_id not in self.rooms[room_id]:
+            self.rooms[room_id].add(user_id)
+            if owned:
+                self.pending[room_id][user_id] = True
+
+    def _remove(self, key, announce):
+        room_id, user_id = key
+        self.wheel.cancel(key)
+        self.owned.discard(key)
+        members = self.rooms.get(room_id)
+        if members is None or user_id not in members:
+            return
+        members.discard(user_id)
+        if not members:
+            del self.rooms[room_id]
+        if announce:
+            self.pending[room_id][user_id] = False
+
+    # Updates from other processes
+
+    def apply_remote(self, message):
+        if message['origin'] == self.origin:
+            return
+        for room_id, user_id in message['online']:
+            key = (room_id, user_id)
+            if key not in self.owned:
+                self._refresh(key, owned=False)
+        for room_id, user_id in message['offline']:
+            key = (room_id, user_id)
+            # Still connected here: this process keeps announcing them
+            if self.local_connections.get(key):
+                self.pending[room_id][user_id] = True
+                continue
+            self._remove(key, announce=False)
+
+    # Background tasks, one set per event loop
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if loop is self._loop:
+            return
+        self._loop = loop
+        self._tasks = [loop.create_task(self._run()), loop.create_task(self._listen())]
+
+    async def _run(self):
+        # Flushes and expiry run on the same beat
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                self.expire(time.monotonic())
+                await self.flush()
+            except Exception:
+                logger.exception("Presence flush failed")
+
+    async def _listen(self):
+        layer = get_channel_layer()
+        self._channel = await layer.new_channel()
+        await layer.group_add(PRESENCE_GROUP, self._channel)
+        while True:
+            message = await layer.receive(self._channel)
+            if message.get('type') == 'presence.sync':
+                self.apply_remote(message)
+
+    def expire(self, now):
+        for key in self.wheel.advance(now):
+            self.expired += 1
+            self._remove(key, announce=key in self.owned)
+
+    async def flush(self):
+        """Broadcast the changes collected since the previous flush"""
+        now = time.monotonic()
+        announce = now - self._last_announce >= self.ttl / 3
+        if not self.pending and not announce:
+            return
+        pending, self.pending = self.pending, defaultdict(dict)
+        layer = get_channel_layer()
+
+        online, offline = [], []
+        for room_id, changes in pending.items():
+            came_online = sorted(user_id for user_id, is_online in changes.items() if is_online)
+            went_offline = sorted(user_id for user_id, is_online in changes.items() if not is_online)
+            online.extend([room_id, user_id] for user_id in came_online)
+            offline.extend([room_id, user_id] for user_id in went_offline)
+            await layer.group_send(f'chat_{room_id}', {
+                'type': 'presence_update',
+                'payloads': encode_all(presence_frame(room_id, came_online, went_offline)),
+            })
+            self.broadcast_frames += 1
+
+        if announce:
+            self._last_announce = now
+            online = [list(key) for key in self.owned]
+            # Channel layers drop group members after group_expiry, so
+            # renew the listener's membership as often as we announce
+            if self._channel is not None:
+                await layer.group_add(PRESENCE_GROUP, self._channel)
+        await layer.group_send(PRESENCE_GROUP, {
+            'type': 'presence.sync',
+            'origin': self.origin,
+            'online': online,
+            'offline': offline,
+        })
+
+    def stats(self):
+        return {
+            'rooms': len(self.rooms),
+            'online_entries': len(self.wheel),
+            'local_connections': sum(self.local_connections.values()),
+            'broadcast_frames': self.broadcast_frames,
+            'expired': self.expired,
+        }
+
+
+presence_registry = PresenceRegistry(
+    ttl=settings.CHAT_PRESENCE_TTL,
+    flush_interval=settings.CHAT_PRESENCE_FLUSH_INTERVAL,
+)
@@ -0,0 +1,139 @@
+"""
+Wire protocols a WebSocket client can choose at connect time.
+
+- json             text frames, the default
+- msgpack          binary MessagePack frames
+- json+deflate     JSON, each frame compressed with raw DEFLATE
+- msgpack+deflate  MessagePack, each frame compressed with raw DEFLATE
+
+Clients ask for one with the `chat.<name>` subprotocol (e.g.
+`chat.msgpack+deflate`) or a `?protocol=<name>` query parameter; without
+either they get JSON. Frames carry the same objects whatever the
+encoding, and clients send theirs in the encoding they chose.
+
+Every frame is compressed on its own (no shared window between frames),
+so a broadcast is compressed once and forwarded as-is to every recipient
+using that protocol; browsers can inflate it with
+`DecompressionStream('deflate-raw')`. Broadcast events carry one payload
+per enabled protocol (`CHAT_WIRE_PROTOCOLS`), built once by the sender.
+"""
+import json
+import zlib
+from urllib.parse import parse_qs
+
+import msgpack
+from django.conf import settings
+
+from chat.frames import encode as encode_json
+
+SUBPROTOCOL_PREFIX = 'chat.'
+
+
+class InvalidFrame(ValueError):
+    """A client frame that can't be decoded in the connection's protocol"""
+
+
+class WireProtocol:
+    def __init__(self, name, binary, dumps, loads, deflate=False):
+        self.name = name
+        self.binary = binary
+        self.dumps = dumps
+        self.loads = loads
+        self.deflate = deflate
+
+    def __repr__(self):
+        return f'<WireProtocol {self.name}>'
+
+    @property
+    def subprotocol(self):
+        return SUBPROTOCOL_PREFIX + self.name
+
+    def encode(self, frame):
+        return self.finish(self.dumps(frame))
+
+    def finish(self, serialized):
+        """The payload for a frame already serialized with `dumps`"""
+        if not self.deflate:
+            return serialized
+        if isinstance(serialized, str):
+            serialized = serialized.encode()
+        compressor = zlib.compressobj(settings.CHAT_WIRE_DEFLATE_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return compressor.compress(serialized) + compressor.flush()
+
+    def decode(self, data):
+        """Frame sent by the client, as text or bytes"""
+        try:
+            if self.deflate:
+                if isinstance(data, str):
+                    data = data.encode()
+                inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+                data = inflater.decompress(data, settings.CHAT_WIRE_MAX_FRAME_SIZE)
+                if inflater.unconsumed_tail:
+                    raise InvalidFrame('Frame too large')
+            return self.loads(data)
+        except (ValueError, TypeError, zlib.error, msgpack.UnpackException) as e:
+            raise InvalidFrame(str(e)) from e
+
+    def send_kwargs(self, payload):
+        """Keyword arguments for `send` carrying an encoded frame"""
+        return {'bytes_data': payload} if self.binary else {'text_data': payload}
+
+
+def _msgpack_dumps(frame):
+    return msgpack.packb(frame, use_bin_type=True)
+
+
+def _msgpack_loads(data):
+    return msgpack.unpackb(data, raw=False)
+
+
+JSON = WireProtocol('json', binary=False, dumps=encode_json, loads=json.loads)
+
+PROTOCOLS = {protocol.name: protocol for protocol in (
+    JSON,
+    WireProtocol('msgpack', binary=True, dumps=_msgpack_dumps, loads=_msgpack_loads),
+    WireProtocol('json+deflate', binary=True, dumps=encode_json, loads=json.loads, deflate=True),
+    WireProtocol('msgpack+deflate', binary=True, dumps=_msgpack_dumps, loads=_msgpack_loads, deflate=True),
+)}
+
+
+def enabled_protocols():
+    # JSON is always available: it's what clients get without asking
+    return [JSON] + [
+        PROTOCOLS[name] for name in settings.CHAT_WIRE_PROTOCOLS if name in PROTOCOLS and name != JSON.name
+    ]
+
+
+def negotiate(scope):
+    """
+    Returns (protocol, subprotocol to accept) for a connection, or
+    (None, None) when the client asked for a protocol that isn't enabled.
+    """
+    enabled = {protocol.name: protocol for protocol in enabled_protocols()}
+
+    query = parse_qs(scope.get('query_string', b'').decode())
+    # An unescaped '+' arrives as a space
+    requested = query.get('protocol', [''])[0].replace(' ', '+')
+    if requested:
+        return (enabled[requested], None) if requested in enabled else (None, None)
+
+    offered = scope.get('subprotocols') or []
+    for subprotocol in offered:
+        name = subprotocol[len(SUBPROTOCOL_PREFIX):] if subprotocol.startswith(SUBPROTOCOL_PREFIX) else None
+        if name in enabled:
+            return enabled[name], subprotocol
+    if offered:
+        return None, None
+    return JSON, None
+
+
+def encode_all(frame):
+    """A broadcast frame encoded once for every enabled protocol"""
+    serialized = {}
+    payloads = {}
+    for protocol in enabled_protocols():
+        # The deflate variants compress what the plain ones serialized
+        if protocol.dumps not in serialized:
+            serialized[protocol.dumps] = protocol.dumps(frame)
+        payloads[protocol.name] = protocol.finish(serialized[protocol.dumps])
+    return payloads
@@ -0,0 +1,140 @@
+"""
+In-memory token buckets limiting how fast clients can send.
+
+Each limit has a refill rate (tokens per second) and a burst size (bucket
+capacity). Buckets are refilled lazily from the time of the previous check,
+so a check is O(1) with no background work, and they live in a bounded
+LRU: a bucket idle long enough to be evicted would have been full anyway,
+unless the cache is too small for the traffic.
+
+Limits:
+- message_user  messages one user may send, over all rooms and both paths
+- message_room  messages one room may receive from everyone
+- typing_user   typing frames one user may send
+
+Messages are checked against both their user's and their room's bucket
+and only take tokens when both have enough. Both the WebSocket consumers
+and the REST message endpoint go through `rate_limiter`. A rate of 0
+disables a limit. Limits are per process.
+"""
+import threading
+import time
+
+from django.conf import settings
+
+from chat.cache import LRUCache
+from chat.metrics import rate_limited
+
+
+class TokenBucketLimit:
+    """One limit's buckets, keyed by user or room id"""
+
+    def __init__(self, name, rate, burst, maxsize=100000):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        # key -> [tokens, last refill]
+        self.buckets = LRUCache(maxsize=maxsize)
+        self.allowed = 0
+        self.limited = 0
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def refill(self, key, now):
+        """The bucket for `key` with the tokens it has at `now`"""
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = [float(self.burst), now]
+            self.buckets.set(key, bucket)
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        return bucket
+
+    def wait_time(self, bucket, cost):
+        """Seconds until `bucket` has `cost` tokens; None if never (cost over the burst)"""
+        if cost > self.burst:
+            return None
+        return max(0.0, (cost - bucket[0]) / self.rate)
+
+    def stats(self):
+        return {
+            'allowed': self.allowed,
+            'limited': self.limited,
+            'buckets': len(self.buckets),
+        }
+
+
+class RateLimited(Exception):
+    """Raised with the limit that was hit and when to retry (None: never)"""
+
+    def __init__(self, limit, retry_after):
+        super().__init__(limit)
+        self.limit = limit
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    def __init__(self, limits):
+        self.limits = {limit.name: limit for limit in limits}
+        self._lock = threading.Lock()
+
+    def take(self, path, cost=1, **keys):
+        """
+        Takes `cost` tokens from each named limit's bucket for its key, e.g.
+        `take('ws', message_user=user.id, message_room=room.id)`, or from none
+        of them if any has too few. Raises RateLimited in that case.
+        `path` ('ws' or 'http') only labels the exported counter.
+        """
+        active = [(self.limits[name], key) for name, key in keys.items() if self.limits[name].enabled]
+        if not active:
+            return
+        now = time.monotonic()
+        with self._lock:
+            buckets = [(limit, limit.refill(key, now)) for limit, key in active]
+            for limit, bucket in buckets:
+                if bucket[0] < cost:
+                    limit.limited += 1
+                    rate_limited.inc(limit.name, path)
+                    retry_after = limit.wait_time(bucket, cost)
+                    raise RateLimited(limit.name, None if retry_after is None else round(retry_after, 3))
+            for limit, bucket in buckets:
+                bucket[0] -= cost
+                limit.allowed += 1
+
+    def take_messages(self, path, user_id, room_id, count=1):
+        self.take(path, cost=count, message_user=user_id, message_room=int(room_id))
+
+    def take_typing(self, path, user_id):
+        self.take(path, typing_user=user_id)
+
+    def clear(self):
+        with self._lock:
+            for limit in self.limits.values():
+                limit.buckets.clear()
+
+    def stats(self):
+        return {
+            f'{name}_{key}': value
+            for name, limit in self.limits.items()
+            for key, value in limit.stats().items()
+        }
+
+
+rate_limiter = RateLimiter([
+    TokenBucketLimit(
+        'message_user', settings.CHAT_MESSAGE_RATE_PER_USER, settings.CHAT_MESSAGE_BURST_PER_USER,
+        maxsize=settings.CHAT_RATE_LIMIT_BUCKETS,
+    ),
+    TokenBucketLimit(
+        'message_room', settings.CHAT_MESSAGE_RATE_PER_ROOM, settings.CHAT_MESSAGE_BURST_PER_ROOM,
+        maxsize=settings.CHAT_RATE_LIMIT_BUCKETS,
+    ),
+    TokenBucketLimit(
+        'typing_user', settings.CHAT_TYPING_RATE_PER_USER, settings.CHAT_TYPING_BURST_PER_USER,
+        maxsize=settings.CHAT_RATE_LIMIT_BUCKETS,
+    ),
+])
+
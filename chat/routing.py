@@ -1,6 +1,10 @@
 from django.urls import re_path
-from chat.consumers import ChatConsumer
+from chat.consumers import ChatConsumer, MultiplexChatConsumer, NotificationConsumer
 
 websocket_urlpatterns = [
     re_path(r'ws/chat/(?P<room_id>\d+)/$', ChatConsumer.as_asgi()),
+    # One socket per user, subscribing to rooms by id
+    re_path(r'ws/chat/$', MultiplexChatConsumer.as_asgi()),
+    # Room list updates for the connected user
+    re_path(r'ws/notifications/$', NotificationConsumer.as_asgi()),
 ]
\ No newline at end of file
@@ -0,0 +1,145 @@
+"""
+Full-text message search.
+
+On SQLite, messages are indexed by an FTS5 table kept current by triggers on
+the message table, so every insert path (including bulk_create) updates the
+index in the same transaction. Other databases fall back to a plain
+substring search; another backend can be plugged in with CHAT_SEARCH_BACKEND.
+"""
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+
+from chat.models import Message, Room
+
+FTS_TABLE = 'chat_message_fts'
+
+INSTALL_FTS_SQL = [
+    f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        content,
+        content='chat_message',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_insert AFTER INSERT ON chat_message BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_delete AFTER DELETE ON chat_message BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content) VALUES ('delete', old.id, old.content);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_update AFTER UPDATE OF content ON chat_message BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO {FTS_TABLE}(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+]
+
+UNINSTALL_FTS_SQL = [
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_insert",
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_delete",
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_update",
+    f"DROP TABLE IF EXISTS {FTS_TABLE}",
+]
+
+
+def install_fts(cursor):
+    """Creates the FTS table and its triggers if missing (SQLite only)"""
+    for statement in INSTALL_FTS_SQL:
+        cursor.execute(statement)
+
+
+def rebuild_fts(cursor):
+    """Re-indexes every message from scratch"""
+    cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+
+
+def uninstall_fts(cursor):
+    for statement in UNINSTALL_FTS_SQL:
+        cursor.execute(statement)
+
+
+class MessageSearchBackend:
+    """
+    Interface for message search backends.
+
+    `search` returns up to `limit` messages matching `query` from rooms
+    `user` participates in, best match first, skipping the first `offset`.
+    """
+    def search(self, user, query, limit, offset=0, room_id=None):
+        raise NotImplementedError
+
+    def member_rooms(self, user):
+        return Room.participants.through.objects.filter(user=user).values('room_id')
+
+    def load(self, ids):
+        """Messages for `ids`, in that order"""
+        messages = Message.objects.select_related('sender').in_bulk(ids)
+        return [messages[pk] for pk in ids if pk in messages]
+
+
+class SubstringSearchBackend(MessageSearchBackend):
+    """Unindexed fallback: case-insensitive substring match, newest first"""
+
+    def search(self, user, query, limit, offset=0, room_id=None):
+        queryset = Message.objects.filter(
+            room_id__in=self.member_rooms(user), content__icontains=query
+        )
+        if room_id is not None:
+            queryset = queryset.filter(room_id=room_id)
+        return list(queryset.select_related('sender').order_by('-created_at')[offset:offset + limit])
+
+
+class SQLiteFTSSearchBackend(MessageSearchBackend):
+    """FTS5 index ranked by bm25, restricted to the caller's rooms"""
+
+    def match_expression(self, query):
+        # Quote every term so user input can't use (or break) FTS syntax;
+        # the last term matches as a prefix for search-as-you-type.
+        terms = re.findall(r'\w+', query)
+        if not terms:
+            return None
+        quoted = [f'"{term}"' for term in terms]
+        quoted[-1] += '*'
+        return ' '.join(quoted)
+
+    def search(self, user, query, limit, offset=0, room_id=None):
+        expression = self.match_expression(query)
+        if expression is None:
+            return []
+
+        participants = Room.participants.through._meta.db_table
+        sql = f"""
+            SELECT m.id
+            FROM {FTS_TABLE}
+            JOIN chat_message m ON m.id = {FTS_TABLE}.rowid
+            WHERE {FTS_TABLE} MATCH %s
+              AND m.room_id IN (SELECT room_id FROM {participants} WHERE user_id = %s)
+        """
+        params = [expression, user.id]
+        if room_id is not None:
+            sql += " AND m.room_id = %s"
+            params.append(room_id)
+        sql += f" ORDER BY bm25({FTS_TABLE}), m.id DESC LIMIT %s OFFSET %s"
+        params += [limit, offset]
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            ids = [row[0] for row in cursor.fetchall()]
+        return self.load(ids)
+
+
+def get_search_backend():
+    if settings.CHAT_SEARCH_BACKEND:
+        return import_string(settings.CHAT_SEARCH_BACKEND)()
+    if connection.vendor == 'sqlite':
+        return SQLiteFTSSearchBackend()
+    return SubstringSearchBackend()
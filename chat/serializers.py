@@ -5,10 +5,24 @@ from chat.models import (
     Room, 
     Message
     )
+from chat.notifications import notify_room_added_on_commit
 
 User = get_user_model()
 
 
+def resolve_participant_emails(emails):
+    """
+    Looks up users for a list of emails in one query. Returns the users found
+    (in the order their emails were given, without duplicates) and the
+    emails that matched nobody.
+    """
+    emails = list(dict.fromkeys(emails))
+    by_email = {user.email: user for user in User.objects.filter(email__in=emails)}
+    users = [by_email[email] for email in emails if email in by_email]
+    missing = [email for email in emails if email not in by_email]
+    return users, missing
+
+
 class UserMinimalSerializer(serializers.ModelSerializer):
     """Minimal user info for chat contexts"""
     class Meta:
@@ -23,7 +37,7 @@ class MessageSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = Message
-        fields = ['id', 'room', 'sender', 'content', 'is_read', 'created_at', 'updated_at']
+        fields = ['id', 'room', 'sender', 'content', 'created_at', 'updated_at']
         read_only_fields = ['id', 'sender', 'created_at', 'updated_at']
     
     def create(self, validated_data):
@@ -39,18 +53,55 @@ class RoomSerializer(serializers.ModelSerializer):
         required=False
     )
     participant_count = serializers.SerializerMethodField()
+    last_message = serializers.SerializerMethodField()
+    unread_count = serializers.SerializerMethodField()
+
+    # Only rendered when requested through the 'include' context
+    optional_fields = ('last_message', 'unread_count')
 
     class Meta:
         model = Room
         fields = [
             'id', 'name', 'room_type',
             'participants', 'participant_emails', 'participant_count',
+            'last_message', 'unread_count',
             'created_at'
         ]
         read_only_fields = ['id', 'participants', 'created_at']
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        include = self.context.get('include', ())
+        for field in self.optional_fields:
+            if field not in include:
+                self.fields.pop(field)
+
     def get_participant_count(self, obj):
-        return obj.participants.count()
+        # Annotated by RoomViewSet.get_queryset; fall back for fresh instances
+        count = getattr(obj, 'participant_count', None)
+        if count is None:
+            count = obj.participants.count()
+        return count
+
+    def get_last_message(self, obj):
+        messages = getattr(obj, 'latest_messages', None)
+        if messages is None:
+            message = obj.get_last_message()
+        else:
+            message = messages[0] if messages else None
+        if message is None:
+            return None
+        return MessageSerializer(message, context=self.context).data
+
+    def get_unread_count(self, obj):
+        return getattr(obj, 'unread_count', 0)
+
+    def validate_room_type(self, value):
+        # A direct room keeps its direct_key, so it can't become a group
+        # (or the other way around) once created
+        if self.instance is not None and value != self.instance.room_type:
+            raise serializers.ValidationError("The room type can't be changed.")
+        return value
 
     def validate_participant_emails(self, value):
         if self.instance is None and not value:
@@ -64,17 +115,20 @@ class RoomSerializer(serializers.ModelSerializer):
         if not participant_emails:
             raise serializers.ValidationError({'participant_emails': ['At least one participant email is required.']})
 
-        users = []
-        missing_emails = []
-        for email in participant_emails:
-            try:
-                users.append(User.objects.get(email=email))
-            except User.DoesNotExist:
-                missing_emails.append(email)
-
+        users, missing_emails = resolve_participant_emails(participant_emails)
         if missing_emails:
             raise serializers.ValidationError({'participant_emails': [f"User(s) not found: {', '.join(missing_emails)}"]})
 
+        if validated_data.get('room_type', 'direct') == 'direct':
+            others = [user for user in users if user.id != request.user.id]
+            if len(others) != 1:
+                raise serializers.ValidationError({'participant_emails': ['A direct message needs exactly one other participant.']})
+            # Reuse the existing DM between the two users, if any
+            room, created = Room.get_or_create_direct(request.user, others[0], name=validated_data.get('name'))
+            if created:
+                notify_room_added_on_commit([request.user.id, others[0].id], room, 2)
+            return room
+
         room = Room.objects.create(
             name=validated_data.get('name'),
             room_type=validated_data.get('room_type', 'direct'),
@@ -83,8 +137,39 @@ class RoomSerializer(serializers.ModelSerializer):
 
         room.participants.add(request.user, *users)
 
+        # The room shows up in every participant's room list
+        member_ids = {request.user.id, *(user.id for user in users)}
+        notify_room_added_on_commit(member_ids, room, len(member_ids))
+
         return room
 
 
 class AddParticipantSerializer(serializers.Serializer):
-    email = serializers.EmailField()
\ No newline at end of file
+    email = serializers.EmailField()
+
+
+class DirectRoomSerializer(serializers.Serializer):
+    email = serializers.EmailField()
+
+
+class AddParticipantsSerializer(serializers.Serializer):
+    emails = serializers.ListField(child=serializers.EmailField(), allow_empty=False, max_length=2000)
+
+
+class AddParticipantsResultSerializer(serializers.Serializer):
+    room = RoomSerializer(read_only=True)
+    added = serializers.ListField(child=serializers.EmailField(), read_only=True)
+    already_participants = serializers.ListField(child=serializers.EmailField(), read_only=True)
+    not_found = serializers.ListField(child=serializers.EmailField(), read_only=True)
+
+
+class PresenceSerializer(serializers.Serializer):
+    room = serializers.IntegerField(read_only=True)
+    online = serializers.ListField(child=serializers.IntegerField(), read_only=True)
+
+
+class MarkReadSerializer(serializers.Serializer):
+    message_id = serializers.IntegerField(required=False, min_value=1)
+    room = serializers.IntegerField(read_only=True)
+    last_read_message_id = serializers.IntegerField(read_only=True)
+    unread_count = serializers.IntegerField(read_only=True)
@@ -0,0 +1,62 @@
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from chat.cache import membership_cache
+from chat.metrics import install_query_counter
+from chat.middleware import user_cache
+from chat.models import Room
+
+User = get_user_model()
+
+
+@receiver(m2m_changed, sender=Room.participants.through)
+def invalidate_room_membership(sender, instance, action, reverse, pk_set, **kwargs):
+    """Drop cached participant sets and bump the rooms when membership changes"""
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        room_ids = [instance.pk]
+    elif pk_set:
+        # user.chat_rooms.add(...): pk_set holds room ids
+        room_ids = list(pk_set)
+    else:
+        # user.chat_rooms.clear(): we don't know which rooms were affected
+        room_ids = None
+
+    # Room listings and their conditional GET validators key off updated_at
+    if room_ids is not None:
+        Room.objects.filter(pk__in=room_ids).update(updated_at=timezone.now())
+
+    def invalidate():
+        if room_ids is None:
+            membership_cache.invalidate_all()
+        else:
+            for room_id in room_ids:
+                membership_cache.invalidate(room_id)
+
+    invalidate()
+    # Again once committed, in case another thread re-cached the old
+    # membership before this transaction became visible.
+    transaction.on_commit(invalidate)
+
+
+@receiver(post_delete, sender=Room)
+def invalidate_deleted_room(sender, instance, **kwargs):
+    membership_cache.invalidate(instance.pk)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    """Edited, deactivated or deleted users must authenticate afresh"""
+    user_cache.invalidate(str(instance.pk))
+
+
+@receiver(connection_created)
+def count_connection_queries(sender, connection, **kwargs):
+    install_query_counter(connection)
@@ -1,3 +1,1358 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from importlib import import_module
+from unittest import mock
 
-# Create your tests here.
+from django.apps import apps as django_apps
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import AccessToken
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+
+from chat.cache import LRUCache, membership_cache
+from chat.consumers import ChatConsumer, MultiplexChatConsumer, NotificationConsumer
+from chat.layers import UnixSocketChannelLayer
+from chat.metrics import Histogram, http_request_queries, ws_event_duration, ws_event_queries
+from chat.metrics import registry as metrics_registry
+from chat.middleware import get_user_from_token, load_active_user, user_cache
+from chat.pagination import MessageKeysetPagination
+from chat.outbound import DROP_OLDEST, OutboundQueue, outbound_registry
+from chat.presence import PresenceRegistry, TimerWheel, presence_registry
+from chat.frames import room_added_frame
+from chat.notifications import notify_room, notify_users
+from chat.protocols import PROTOCOLS, InvalidFrame, encode_all
+from chat.ratelimit import RateLimited, RateLimiter, TokenBucketLimit, rate_limiter
+from chat.typing_indicators import TypingThrottle
+from chat.models import Room, Message, ReadCursor
+from chat.writer import MessageWriter
+
+User = get_user_model()
+
+
+class ChatTestMixin:
+    def create_user(self, email, **kwargs):
+        return User.objects.create_user(email=email, password='pass1234', **kwargs)
+
+    async def create_user_async(self, email, **kwargs):
+        return await database_sync_to_async(self.create_user)(email, **kwargs)
+
+    def create_room(self, *users, room_type='group', name='Test room'):
+        # Room ids get reused once a test's data is rolled back, which
+        # never fires the invalidation signals. User ids get reused too,
+        # with the rate limit buckets of earlier tests.
+        membership_cache.invalidate_all()
+        rate_limiter.clear()
+        room = Room.objects.create(name=name, room_type=room_type, created_by=users[0])
+        room.participants.add(*users)
+        return room
+
+    async def connect(self, user, room, query=''):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{room.id}/?{query}')
+        communicator.scope['user'] = user
+        communicator.scope['url_route'] = {'kwargs': {'room_id': str(room.id)}}
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        established = await communicator.receive_json_from()
+        self.assertEqual(established['type'], 'connection_established')
+        presence = await communicator.receive_json_from()
+        self.assertTrue(presence['snapshot'])
+        return communicator
+
+
+class MessagePaginationTests(ChatTestMixin, APITestCase):
+    def setUp(self):
+        self.alice = self.create_user('alice@example.com')
+        self.bob = self.create_user('bob@example.com')
+        self.room = self.create_room(self.alice, self.bob)
+        self.messages = [
+            Message.objects.create(room=self.room, sender=self.alice, content=f'message {i}')
+            for i in range(7)
+        ]
+        self.client.force_authenticate(self.alice)
+
+    def get_page(self, **params):
+        response = self.client.get('/api/chat/messages/', {'room': self.room.id, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_first_page_is_newest_first_and_bounded(self):
+        page = self.get_page(page_size=3)
+        ids = [m['id'] for m in page['results']]
+        self.assertEqual(ids, [m.id for m in reversed(self.messages)][:3])
+        self.assertTrue(page['has_more'])
+        self.assertEqual(page['next_before'], ids[-1])
+
+    def test_walk_history_with_before_cursor(self):
+        seen = []
+        page = self.get_page(page_size=3)
+        seen += [m['id'] for m in page['results']]
+        while page['has_more']:
+            page = self.get_page(page_size=3, before=page['next_before'])
+            seen += [m['id'] for m in page['results']]
+        self.assertEqual(seen, [m.id for m in reversed(self.messages)])
+
+    def test_after_cursor_returns_newer_messages(self):
+        page = self.get_page(after=self.messages[4].id)
+        self.assertEqual([m['id'] for m in page['results']], [self.messages[6].id, self.messages[5].id])
+        self.assertFalse(page['has_more'])
+
+    def test_page_size_is_capped(self):
+        with mock.patch.object(MessageKeysetPagination, 'max_page_size', 3):
+            page = self.get_page(page_size=10000)
+        self.assertEqual([m['id'] for m in page['results']], [m.id for m in reversed(self.messages[-3:])])
+        self.assertTrue(page['has_more'])
+
+    def test_since_lists_only_newer_messages(self):
+        page = self.get_page(since=self.messages[4].id)
+        self.assertEqual([m['id'] for m in page['results']], [self.messages[6].id, self.messages[5].id])
+        for since in ('x', '²'):
+            response = self.client.get('/api/chat/messages/', {'room': self.room.id, 'since': since})
+            self.assertEqual(response.status_code, 400)
+
+    def test_cursor_from_another_room_is_rejected(self):
+        other = self.create_room(self.bob, name='Other')
+        foreign = Message.objects.create(room=other, sender=self.bob, content='hidden')
+        response = self.client.get('/api/chat/messages/', {'room': self.room.id, 'before': foreign.id})
+        self.assertEqual(response.status_code, 400)
+
+
+class MessageWriterTests(ChatTestMixin, TransactionTestCase):
+    def setUp(self):
+        self.alice = self.create_user('alice@example.com')
+        self.room = self.create_room(self.alice)
+
+    def create_writer(self, **kwargs):
+        writer = MessageWriter(**kwargs)
+        self.addCleanup(writer.close)
+        return writer
+
+    async def test_submissions_are_committed_in_one_ordered_batch(self):
+        writer = self.create_writer(max_batch_size=10, max_delay=0.01)
+        messages = await asyncio.gather(*[
+            writer.submit(self.room.id, self.alice, f'message {i}') for i in range(5)
+        ])
+
+        self.assertEqual(writer.flushes, 1)
+        self.assertEqual([m.content for m in messages], [f'message {i}' for i in range(5)])
+        ids = [m.id for m in messages]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(await Message.objects.filter(room=self.room).acount(), 5)
+
+    async def test_full_batch_flushes_without_waiting_for_the_timer(self):
+        writer = self.create_writer(max_batch_size=2, max_delay=60)
+        await asyncio.wait_for(asyncio.gather(
+            writer.submit(self.room.id, self.alice, 'one'),
+            writer.submit(self.room.id, self.alice, 'two'),
+        ), timeout=5)
+        self.assertEqual(writer.messages_written, 2)
+
+    async def test_submit_many_keeps_order_in_one_flush(self):
+        writer = self.create_writer(max_batch_size=100, max_delay=0.01)
+        results = await writer.submit_many(self.room.id, self.alice, [f'batch {i}' for i in range(20)])
+        self.assertEqual(writer.flushes, 1)
+        self.assertEqual([m.content for m in results], [f'batch {i}' for i in range(20)])
+        self.assertEqual([m.id for m in results], sorted(m.id for m in results))
+
+    def test_sync_callers_share_the_writer_thread(self):
+        writer = self.create_writer(max_batch_size=100, max_delay=0.05)
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            messages = list(pool.map(
+                lambda i: writer.submit_sync(self.room.id, self.alice, f'message {i}'), range(8)
+            ))
+        self.assertEqual(sorted(m.content for m in messages), sorted(f'message {i}' for i in range(8)))
+        self.assertLess(writer.flushes, 8)
+        self.assertEqual(Message.objects.filter(room=self.room).count(), 8)
+
+    def test_close_commits_queued_messages(self):
+        writer = self.create_writer(max_batch_size=100, max_delay=60)
+        future = writer.submit_nowait(self.room.id, self.alice, 'last words')
+        writer.close()
+        self.assertEqual(future.result(timeout=0).content, 'last words')
+
+    async def test_bad_row_fails_alone(self):
+        writer = self.create_writer(max_batch_size=10, max_delay=0.01)
+        with self.assertLogs('chat.writer', 'WARNING'):
+            results = await asyncio.gather(
+                writer.submit(self.room.id, self.alice, 'kept'),
+                writer.submit(999999, self.alice, 'orphan'),
+                return_exceptions=True,
+            )
+        self.assertEqual(results[0].content, 'kept')
+        self.assertIsInstance(results[1], Exception)
+
+
+class MembershipCacheTests(ChatTestMixin, TestCase):
+    def setUp(self):
+        self.alice = self.create_user('alice@example.com')
+        self.bob = self.create_user('bob@example.com')
+        self.room = self.create_room(self.alice)
+
+    def test_repeated_checks_hit_the_cache(self):
+        self.assertTrue(membership_cache.is_member(self.room.id, self.alice.id))
+        with self.assertNumQueries(0):
+            self.assertTrue(membership_cache.is_member(self.room.id, self.alice.id))
+            self.assertFalse(membership_cache.is_member(self.room.id, self.bob.id))
+
+    def test_participant_changes_invalidate(self):
+        self.assertFalse(membership_cache.is_member(self.room.id, self.bob.id))
+        self.room.participants.add(self.bob)
+        self.assertTrue(membership_cache.is_member(self.room.id, self.bob.id))
+        self.bob.chat_rooms.remove(self.room)
+        self.assertFalse(membership_cache.is_member(self.room.id, self.bob.id))
+
+    def test_lru_eviction_and_counters(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+
+class RoomListQueryTests(ChatTestMixin, APITestCase):
+    def setUp(self):
+        self.alice = self.create_user('alice@example.com')
+        self.bob = self.create_user('bob@example.com')
+        self.client.force_authenticate(self.alice)
+
+    def make_rooms(self, count):
+        for i in range(count):
+            room = self.create_room(self.alice, self.bob, name=f'Room {i}')
+            Message.objects.create(room=room, sender=self.bob, content=f'hello {i}')
+
+    def count_list_queries(self, **params):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/api/chat/rooms/', params)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries), response.data
+
+    def test_query_count_does_not_grow_with_rooms(self):
+        self.make_rooms(2)
+        few, _ = self.count_list_queries(include='last_message,unread_count')
+        self.make_rooms(8)
+        many, data = self.count_list_queries(include='last_message,unread_count')
+        self.assertEqual(few, many)
+        self.assertEqual(len(data), 10)
+
+    def test_includes_are_opt_in(self):
+        self.make_rooms(1)
+        _, data = self.count_list_queries()
+        self.assertNotIn('last_message', data[0])
+        self.assertEqual(data[0]['participant_count'], 2)
+
+        _, data = self.count_list_queries(include='last_message,unread_count')
+        self.assertEqual(data[0]['last_message']['content'], 'hello 0')
+        self.assertEqual(data[0]['unread_count'], 1)
+
+
+class UnixSocketChannelLayerTests(SimpleTestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'layer.sock')
+
+    async def test_group_send_reaches_members_in_other_workers(self):
+        first = UnixSocketChannelLayer(path=self.path)
+        second = UnixSocketChannelLayer(path=self.path)
+        try:
+            local = await first.new_channel()
+            remote = await second.new_channel()
+            await first.group_add('room', local)
+            await second.group_add('room', remote)
+
+            await first.group_send('room', {'type': 'chat.message', 'text': 'hi'})
+
+            self.assertEqual((await first.receive(local))['text'], 'hi')
+            received = await asyncio.wait_for(second.receive(remote), timeout=2)
+            self.assertEqual(received['text'], 'hi')
+        finally:
+            await first.close()
+            await second.close()
+
+    async def test_send_to_a_channel_owned_by_another_worker(self):
+        first = UnixSocketChannelLayer(path=self.path)
+        second = UnixSocketChannelLayer(path=self.path)
+        try:
+            await first.connect()
+            await second.connect()
+            channel = await second.new_channel()
+            self.assertFalse(first.is_local_channel(channel))
+
+            await first.send(channel, {'type': 'ping'})
+
+            received = await asyncio.wait_for(second.receive(channel), timeout=2)
+            self.assertEqual(received['type'], 'ping')
+        finally:
+            await first.close()
+            await second.close()
+
+
+class ChatConsumerTests(ChatTestMixin, TestCase):
+    def setUp(self):
+        self.alice = self.create_user('alice@example.com')
+        self.bob = self.create_user('bob@example.com')
+        self.room = self.create_room(self.alice, self.bob)
+
+    async def test_message_is_saved_and_broadcast(self):
+        alice = await self.connect(self.alice, self.room)
+        bob = await self.connect(self.bob, self.room)
+
+        await alice.send_json_to({'type': 'chat_message', 'message': 'hello'})
+        frame = await bob.receive_json_from()
+
+        self.assertEqual(frame['type'], 'chat_message')
+        self.assertEqual(frame['message']['content'], 'hello')
+        self.assertEqual(frame['message']['sender']['id'], self.alice.id)
+        self.assertEqual(frame['room'], self.room.id)
+        self.assertTrue(await Message.objects.filter(id=frame['message']['id']).aexists())
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_non_text_message_is_rejected(self):
+        alice = await self.connect(self.alice, self.room)
+        for content in (42, None, ['hi']):
+            await alice.send_json_to({'type': 'chat_message', 'message': content})
+            self.assertEqual((await alice.receive_json_from())['message'], 'Message content cannot be empty')
+        self.assertFalse(await Message.objects.filter(room=self.room).aexists())
+        await alice.disconnect()
+
+    async def test_mark_read_over_websocket(self):
+        message = await Message.objects.acreate(room=self.room, sender=self.bob, content='hi')
+        alice = await self.connect(self.alice, self.room)
+
+        await alice.send_json_to({'type': 'mark_read', 'message_id': message.id})
+        frame = await alice.receive_json_from()
+
+        self.assertEqual(frame, {'type': 'read_cursor', 'room': self.room.id, 'last_read_message_id': message.id})
+        await alice.disconnect()
+
+    @override_settings(CHAT_SYNC_CHUNK_SIZE=2)
+    async def test_reconnect_streams_missed_messages_in_chunks(self):
+        seen = await Message.objects.acreate(room=self.room, sender=self.bob, content='seen')
+        for i in range(3):
+            await Message.objects.acreate(room=self.room, sender=self.bob, content=f'missed {i}')
+        alice = await self.connect(self.alice, self.room, f'last_seen_id={seen.id}')
+
+        first = await alice.receive_json_from()
+        second = await alice.receive_json_from()
+        self.assertEqual([m['content'] for m in first['messages']], ['missed 0', 'missed 1'])
+        self.assertFalse(first['complete'])
+        self.assertEqual([m['content'] for m in second['messages']], ['missed 2'])
+        self.assertTrue(second['complete'])
+        await alice.disconnect()
+
+    @override_settings(CHAT_SYNC_MAX_MESSAGES=2)
+    async def test_reconnect_too_far_behind_is_truncated(self):
+        for i in range(3):
+            await Message.objects.acreate(room=self.room, sender=self.bob, content=f'missed {i}')
+        alice = await self.connect(self.alice, self.room, 'last_seen_id=0')
+
+        frame = await alice.receive_json_from()
+        self.assertEqual((frame['type'], frame['messages'], frame['truncated']), ('sync', [], True))
+        await alice.disconnect()
+
+    async def test_live_messages_already_synced_are_skipped(self):
+        message = await Message.objects.acreate(room=self.room, sender=self.bob, content='missed')
+        alice = await self.connect(self.alice, self.room, f'last_seen_id={message.id - 1}')
+        await alice.receive_json_from()
+
+        communicator = await self.connect(self.bob, self.room)
+        event = {'type': 'chat_message', 'room': self.room.id, 'message_id': message.id, 'payloads': {'json': '{}'}}
+        await get_channel_layer().group_send(f'chat_{self.room.id}', event)
+        self.assertTrue(await alice.receive_nothing())
+        self.assertEqual(await communicator.receive_from(), '{}')
+        await alice.disconnect()
+        await communicator.disconnect()
+
+    async def test_batch_is_saved_in_order_and_broadcast_once(self):
+        alice = await self.connect(self.alice, self.room)
+        bob = await self.connect(self.bob, self.room)
+
+        await alice.send_json_to({'type': 'chat_messages', 'messages': [
+            {'message': 'one', 'client_id': 'a'},
+            {'message': '  ', 'client_id': 'b'},
+            {'message': 'two'},
+        ]})
+        frame = await bob.receive_json_from()
+        self.assertEqual(frame['type'], 'chat_messages')
+        self.assertEqual([m['content'] for m in frame['messages']], ['one', 'two'])
+        self.assertTrue(await bob.receive_nothing())
+
+        # The sender's answer comes before its copy of the broadcast
+        result = await alice.receive_json_from()
+        self.assertEqual((await alice.receive_json_from())['type'], 'chat_messages')
+        ids = [m['id'] for m in frame['messages']]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(result['results'], [
+            {'client_id': 'a', 'id': ids[0]},
+            {'client_id': 'b', 'error': 'Message content cannot be empty'},
+            {'id': ids[1]},
+        ])
+        self.assertEqual(await Message.objects.filter(room=self.room).acount(), 2)
+        await alice.disconnect()
+        await bob.disconnect()
+
+    @override_settings(CHAT_MAX_BATCH_MESSAGES=2)
+    async def test_oversized_batch_is_refused(self):
+        alice = await self.connect(self.alice, self.room)
+        await alice.send_json_to({'type': 'chat_messages', 'messages': [{'message': 'x'}] * 3})
+        self.assertEqual((await alice.receive_json_from())['message'], 'At most 2 messages per batch')
+        self.assertFalse(await Message.objects.filter(room=self.room).aexists())
+        await alice.disconnect()
+
+    async def test_non_participant_is_rejected(self):
+        carol = await self.create_user_async('carol@example.com')
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{self.room.id}/')
+        communicator.scope['user'] = carol
+        communicator.scope['url_route'] = {'kwargs': {'room_id': str(self.room.id)}}
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+    async def test_typing_frames_are_coalesced(self):
+        alice = await self.connect(self.alice, self.room)
+        bob = await self.connect(self.bob, self.room)
+
+        for _ in range(5):
+            await alice.send_json_to({'type': 'typing', 'is_typing': True})
+        await alice.send_json_to({'type': 'typing', 'is_typing': False})
+
+        started = await bob.receive_json_from()
+        stopped = await bob.receive_json_from()
+        self.assertEqual((started['type'], started['is_typing']), ('typing', True))
+        self.assertEqual((stopped['type'], stopped['is_typing']), ('typing', False))
+        self.assertTrue(await bob.receive_nothing())
+        await alice.disconnect()
+        await bob.disconnect()
+
+
+class TypingThrottleTests(SimpleTestCase):
+    async def noop(self):
+        pass
+
+    async def test_only_state_changes_and_refreshes_are_broadcast(self):
+        throttle = TypingThrottle(refresh_interval=60, expiry=60)
+        results = [throttle.update(1, 1, True, self.noop) for _ in range(10)]
+        results.append(throttle.update(1, 1, False, self.noop))
+        results.append(throttle.update(1, 1, False, self.noop))
+
+        self.assertEqual(results.count(True), 2)
+        self.assertEqual(throttle.stats()['suppressed'], 10)
+        self.assertEqual(throttle.stats()['typing_users'], 0)
+
+    async def test_refresh_interval_allows_periodic_rebroadcast(self):
+        throttle = TypingThrottle(refresh_interval=0.01, expiry=60)
+        self.assertTrue(throttle.update(1, 1, True, self.noop))
+        await asyncio.sleep(0.02)
+        self.assertTrue(throttle.update(1, 1, True, self.noop))
+        throttle.clear(1, 1)
+
+    async def test_stale_typing_state_expires(self):
+        expired = asyncio.Event()
+
+        async def on_expire():
+            expired.set()
+
+        throttle = TypingThrottle(refresh_interval=60, expiry=0.01)
+        throttle.update(1, 1, True, on_expire)
+        await asyncio.wait_for(expired.wait(), timeout=1)
+        self.assertEqual(throttle.stats()['expired'], 1)
+        self.assertEqual(throttle.stats()['typing_users'], 0)
+
+
+class OutboundQueueTests(SimpleTestCase):
+    async def record(self, text_data):
+        self.sent.append(text_data)
+
+    def setUp(self):
+        self.sent = []
+
+    def test_typing_frames_are_dropped_before_messages(self):
+        queue = OutboundQueue(self.record, maxsize=2)
+        self.assertTrue(queue.put({'text_data': 'typing'}, droppable=True))
+        self.assertTrue(queue.put({'text_data': 'm1'}))
+        self.assertTrue(queue.put({'text_data': 'typing again'}, droppable=True))
+        self.assertTrue(queue.put({'text_data': 'm2'}))
+
+        self.assertEqual([frame['text_data'] for frame, _ in queue.frames], ['m1', 'm2'])
+        self.assertEqual(queue.stats()['dropped_typing'], 2)
+
+    def test_overflowing_messages_disconnect_by_default(self):
+        queue = OutboundQueue(self.record, maxsize=1)
+        self.assertTrue(queue.put({'text_data': 'm1'}))
+        self.assertFalse(queue.put({'text_data': 'm2'}))
+
+    def test_drop_oldest_policy_keeps_newest_messages(self):
+        queue = OutboundQueue(self.record, maxsize=2, overflow_policy=DROP_OLDEST)
+        for i in range(4):
+            self.assertTrue(queue.put({'text_data': f'm{i}'}))
+        self.assertEqual([frame['text_data'] for frame, _ in queue.frames], ['m2', 'm3'])
+        self.assertEqual(queue.stats()['dropped_messages'], 2)
+
+    def test_slowest_connections_are_exported(self):
+        idle = OutboundQueue(self.record, maxsize=10)
+        behind = OutboundQueue(self.record, maxsize=10)
+        furthest = OutboundQueue(self.record, maxsize=10)
+        for i in range(2):
+            behind.put({'text_data': f'm{i}'})
+        for i in range(5):
+            furthest.put({'text_data': f'm{i}'})
+        for name, queue in (('idle', idle), ('behind', behind), ('furthest', furthest)):
+            outbound_registry.register(name, queue)
+        try:
+            slowest = outbound_registry.slowest(2)
+            self.assertEqual([(name, stats['depth']) for name, stats in slowest], [('furthest', 5), ('behind', 2)])
+            self.assertIn('chat_outbound_connection_depth{channel="furthest"} 5', metrics_registry.expose())
+        finally:
+            for name in ('idle', 'behind', 'furthest'):
+                outbound_registry.unregister(name)
+
+    async def test_frames_are_sent_in_order(self):
+        queue = OutboundQueue(self.record, maxsize=10)
+        queue.start()
+        for i in range(3):
+            queue.put({'text_data': f'm{i}'})
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        queue.stop()
+        self.assertEqual(self.sent, ['m0', 'm1', 'm2'])
+
+
+class ReadCursorTests(ChatTestMixin, APITestCase):
+    def setUp(self):
+        self.alice = self.create_user('alice@example.com')
+        self.bob = self.create_user('bob@example.com')
+        self.room = self.create_room(self.alice, self.bob)
+        self.messages = [
+            Message.objects.create(room=self.room, sender=self.bob, content=f'message {i}')
+            for i in range(5)
+        ]
+        self.client.force_authenticate(self.alice)
+
+    def mark_read(self, **data):
+        return self.client.post(f'/api/chat/rooms/{self.room.id}/mark_read/', data)
+
+    def test_everything_from_others_starts_unread(self):
+        Message.objects.create(room=self.room, sender=self.alice, content='mine')
+        self.assertEqual(ReadCursor.unread_count(self.alice, self.room.id), 5)
+
+    def test_mark_read_up_to_a_message(self):
+        response = self.mark_read(message_id=self.messages[2].id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['last_read_message_id'], self.messages[2].id)
+        self.assertEqual(response.data['unread_count'], 2)
+
+    def test_mark_whole_room_read(self):
+        response = self.mark_read()
+        self.assertEqual(response.data['last_read_message_id'], self.messages[-1].id)
+        self.assertEqual(response.data['unread_count'], 0)
+
+    def test_cursor_never_moves_backwards(self):
+        self.mark_read(message_id=self.messages[3].id)
+        response = self.mark_read(message_id=self.messages[1].id)
+        self.assertEqual(response.data['last_read_message_id'], self.messages[3].id)
+
+    def test_racing_first_marks_keep_the_higher_one(self):
+        get_or_create = ReadCursor.objects.get_or_create
+
+        def lose_the_race(**kwargs):
+            # Another request creates the cursor at a lower message first
+            ReadCursor.objects.create(user=self.alice, room=self.room, last_read_message_id=self.messages[1].id)
+            return get_or_create(**kwargs)
+
+        with mock.patch.object(ReadCursor.objects, 'get_or_create', side_effect=lose_the_race):
+            last_read = ReadCursor.mark_read(self.alice, self.room.id, self.messages[3].id)
+        self.assertEqual(last_read, self.messages[3].id)
+        self.assertEqual(
+            ReadCursor.objects.get(user=self.alice, room=self.room).last_read_message_id, self.messages[3].id
+        )
+
+    def test_message_from_another_room_is_rejected(self):
+        other = self.create_room(self.alice, name='Other')
+        foreign = Message.objects.create(room=other, sender=self.alice, content='elsewhere')
+        self.assertEqual(self.mark_read(message_id=foreign.id).status_code, 400)
+
+    def test_marking_a_large_backlog_is_one_write(self):
+        Message.objects.bulk_create([
+            Message(room=self.room, sender=self.bob, content='backlog') for _ in range(200)
+        ])
+        ReadCursor.mark_read(self.alice, self.room.id, self.messages[0].id)
+        with self.assertNumQueries(2):
+            ReadCursor.mark_read(self.alice, self.room.id)
+        self.assertEqual(ReadCursor.unread_count(self.alice, self.room.id), 0)
+
+
+class JWTUserCacheTests(ChatTestMixin, TestCase):
+    def setUp(self):
+        user_cache.clear()
+        self.alice = self.create_user('alice@example.com')
+        self.token = str(AccessToken.for_user(self.alice))
+
+    async def test_repeated_handshakes_reuse_the_cached_user(self):
+        first = await get_user_from_token(self.token)
+        self.assertEqual(first.id, self.alice.id)
+        await database_sync_to_async(self.assert_cached_without_queries)()
+
+    def assert_cached_without_queries(self):
+        with self.assertNumQueries(0):
+            user = async_to_sync(get_user_from_token)(self.token)
+        self.assertEqual(user.id, self.alice.id)
+
+    async def test_concurrent_handshakes_share_one_lookup(self):
+        with mock.patch('chat.middleware.load_active_user', wraps=load_active_user) as load:
+            users = await asyncio.gather(*[get_user_from_token(self.token) for _ in range(20)])
+        self.assertEqual({user.id for user in users}, {self.alice.id})
+        self.assertEqual(load.call_count, 1)
+
+    async def test_deactivated_user_is_rejected_after_save(self):
+        await get_user_from_token(self.token)
+        self.alice.is_active = False
+        await self.alice.asave()
+
+        user = await get_user_from_token(self.token)
+        self.assertFalse(user.is_authenticated)
+
+    async def test_lookup_overlapping_a_deactivation_is_not_cached(self):
+        async def load_then_deactivate(user_id):
+            # The user is loaded, then deactivated before the lookup returns
+            user = await load_active_user(user_id)
+            self.alice.is_active = False
+            await self.alice.asave()
+            return user
+
+        with mock.patch('chat.middleware.load_active_user', side_effect=load_then_deactivate):
+            await get_user_from_token(self.token)
+        self.assertIsNone(user_cache.get(str(self.alice.id)))
+        user = await get_user_from_token(self.token)
+        self.assertFalse(user.is_authenticated)
+
+    async def test_invalid_token_is_anonymous(self):
+        user = await get_user_from_token('not-a-token')
+        self.assertFalse(user.is_authenticated)
+
+
+class MessageSearchTests(ChatTestMixin, APITestCase):
+    def setUp(self):
+        self.alice = self.create_user('alice@example.com')
+        self.bob = self.create_user('bob@example.com')
+        self.carol = self.create_user('carol@example.com')
+        self.room = self.create_room(self.alice, self.bob)
+        self.other_room = self.create_room(self.bob, self.carol)
+        self.client.force_authenticate(self.alice)
+
+    def search(self, **params):
+        response = self.client.get('/api/chat/search/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_only_searches_the_callers_rooms(self):
+        mine = Message.objects.create(room=self.room, sender=self.bob, content='deploy on friday')
+        Message.objects.create(room=self.other_room, sender=self.bob, content='deploy on monday')
+        page = self.search(q='deploy')
+        self.assertEqual([m['id'] for m in page['results']], [mine.id])
+
+    def test_index_follows_edits_deletes_and_bulk_inserts(self):
+        message = Message.objects.create(room=self.room, sender=self.bob, content='old wording')
+        message.content = 'new wording'
+        message.save()
+        self.assertEqual(self.search(q='old')['results'], [])
+        self.assertEqual(len(self.search(q='new')['results']), 1)
+
+        Message.objects.bulk_create(
+            [Message(room=self.room, sender=self.bob, content=f'bulk {i}') for i in range(3)]
+        )
+        self.assertEqual(len(self.search(q='bulk')['results']), 3)
+
+        message.delete()
+        self.assertEqual(self.search(q='new')['results'], [])
+
+    def test_ranked_and_paginated(self):
+        Message.objects.create(room=self.room, sender=self.bob, content='release notes and other things')
+        best = Message.objects.create(room=self.room, sender=self.bob, content='release release release')
+        page = self.search(q='release', page_size=1)
+        self.assertEqual(page['results'][0]['id'], best.id)
+        self.assertTrue(page['has_more'])
+        page = self.search(q='release', page_size=1, offset=page['next_offset'])
+        self.assertFalse(page['has_more'])
+
+    def test_query_syntax_is_not_interpreted(self):
+        Message.objects.create(room=self.room, sender=self.bob, content='what about "quotes" OR stars*')
+        self.assertEqual(len(self.search(q='"quotes" OR')['results']), 1)
+        self.assertEqual(self.client.get('/api/chat/search/').status_code, 400)
+        for offset in ('x', '²'):
+            self.assertEqual(self.client.get('/api/chat/search/', {'q': 'x', 'offset': offset}).status_code, 400)
+
+
+class ConditionalGetTests(ChatTestMixin, APITestCase):
+    def setUp(self):
+        self.alice = self.create_user('alice@example.com')
+        self.bob = self.create_user('bob@example.com')
+        self.room = self.create_room(self.alice, self.bob)
+        Message.objects.create(room=self.room, sender=self.bob, content='hi')
+        self.client.force_authenticate(self.alice)
+
+    def revalidate(self, url, params=None):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return self.client.get(url, params, HTTP_IF_NONE_MATCH=response['ETag'])
+
+    def test_unchanged_room_list_is_one_query(self):
+        first = self.client.get('/api/chat/rooms/')
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/chat/rooms/', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], first['ETag'])
+
+    def test_room_list_has_no_last_modified(self):
+        # It would go back in time when the user leaves their newest room
+        newer = self.create_room(self.alice, self.bob, name='Newer')
+        first = self.client.get('/api/chat/rooms/')
+        self.assertNotIn('Last-Modified', first)
+        newer.participants.remove(self.alice)
+        response = self.client.get('/api/chat/rooms/', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([room['id'] for room in response.data], [self.room.id])
+
+    def test_participant_profile_edits_change_the_validators(self):
+        room_url = f'/api/chat/rooms/{self.room.id}/'
+        messages_params = {'room': self.room.id}
+        list_etag = self.client.get('/api/chat/rooms/')['ETag']
+        room = self.client.get(room_url)
+        messages_etag = self.client.get('/api/chat/messages/', messages_params)['ETag']
+
+        User.objects.filter(pk=self.bob.pk).update(updated_at=timezone.now() + timedelta(seconds=5))
+        self.assertEqual(self.client.get('/api/chat/rooms/', HTTP_IF_NONE_MATCH=list_etag).status_code, 200)
+        self.assertEqual(self.client.get(room_url, HTTP_IF_NONE_MATCH=room['ETag']).status_code, 200)
+        self.assertEqual(self.client.get(room_url, HTTP_IF_MODIFIED_SINCE=room['Last-Modified']).status_code, 200)
+        response = self.client.get('/api/chat/messages/', messages_params, HTTP_IF_NONE_MATCH=messages_etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_room_list_changes_with_messages_members_and_reads(self):
+        url = '/api/chat/rooms/'
+        params = {'include': 'unread_count'}
+        etag = self.client.get(url, params)['ETag']
+
+        self.client.post('/api/chat/messages/', {'room': self.room.id, 'content': 'new'})
+        etag, previous = self.client.get(url, params)['ETag'], etag
+        self.assertNotEqual(etag, previous)
+
+        self.room.participants.add(self.create_user('carol@example.com'))
+        etag, previous = self.client.get(url, params)['ETag'], etag
+        self.assertNotEqual(etag, previous)
+
+        ReadCursor.mark_read(self.alice, self.room.id)
+        self.assertEqual(self.client.get(url, params, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_room_detail_and_message_list(self):
+        self.assertEqual(self.revalidate(f'/api/chat/rooms/{self.room.id}/').status_code, 304)
+        url, params = '/api/chat/messages/', {'room': self.room.id}
+        self.assertEqual(self.revalidate(url, params).status_code, 304)
+
+        etag = self.client.get(url, params)['ETag']
+        Message.objects.create(room=self.room, sender=self.bob, content='again')
+        self.assertEqual(self.client.get(url, params, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        # Different pages of the same room don't share validators
+        self.assertNotEqual(self.client.get(url, {**params, 'page_size': 1})['ETag'], etag)
+
+
+class MetricsTests(ChatTestMixin, APITestCase):
+    def setUp(self):
+        self.alice = self.create_user('alice@example.com')
+        self.bob = self.create_user('bob@example.com')
+        self.room = self.create_room(self.alice, self.bob)
+
+    def test_histogram_exposition(self):
+        histogram = Histogram('test_seconds', 'Test', ('view',), buckets=(0.1, 1))
+        histogram.observe(0.05, 'a')
+        histogram.observe(0.5, 'a')
+        self.assertEqual(histogram.expose(), [
+            '# HELP test_seconds Test',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{view="a",le="0.1"} 1',
+            'test_seconds_bucket{view="a",le="1"} 2',
+            'test_seconds_bucket{view="a",le="+Inf"} 2',
+            'test_seconds_sum{view="a"} 0.55',
+            'test_seconds_count{view="a"} 2',
+        ])
+
+    def test_http_requests_are_recorded_per_view(self):
+        self.client.force_authenticate(self.alice)
+        before = http_request_queries.values.get(('room-list',), [[], 0, 0])[2]
+        self.client.get('/api/chat/rooms/')
+        counts, queries, requests = http_request_queries.values[('room-list',)]
+        self.assertEqual(requests, before + 1)
+        self.assertGreater(queries, 0)
+
+        body = self.client.get('/metrics/').content.decode()
+        self.assertIn('chat_http_request_duration_seconds_count{view="room-list",method="GET"}', body)
+        self.assertIn('chat_membership_cache_hits', body)
+
+    def test_metrics_are_internal(self):
+        response = self.client.get('/metrics/', REMOTE_ADDR='203.0.113.9')
+        self.assertEqual(response.status_code, 403)
+
+    async def test_consumer_events_are_recorded(self):
+        alice = await self.connect(self.alice, self.room)
+        await alice.send_json_to({'type': 'chat_message', 'message': 'hello'})
+        await alice.receive_json_from()
+        await alice.disconnect()
+
+        counts, queries, events = ws_event_queries.values[('ChatConsumer', 'receive.chat_message')]
+        self.assertGreater(events, 0)
+        self.assertGreater(queries, 0)
+        self.assertIn(('ChatConsumer', 'chat_message'), ws_event_duration.values)
+
+    async def test_unknown_frame_types_share_one_series(self):
+        alice = await self.connect(self.alice, self.room)
+        for i in range(20):
+            await alice.send_json_to({'type': f'junk{i}'})
+        await alice.send_json_to({'type': 'heartbeat'})
+        self.assertEqual((await alice.receive_json_from())['type'], 'heartbeat_ack')
+        await alice.disconnect()
+
+        events = {event for consumer, event in ws_event_duration.values if consumer == 'ChatConsumer'}
+        self.assertIn('receive.unknown', events)
+        self.assertFalse(any(event.startswith('receive.junk') for event in events))
+
+
+class BulkParticipantTests(ChatTestMixin, APITestCase):
+    def setUp(self):
+        self.alice = self.create_user('alice@example.com')
+        self.team = User.objects.bulk_create([
+            User(email=f'member{i}@example.com', username=f'member{i}@example.com') for i in range(20)
+        ])
+        self.client.force_authenticate(self.alice)
+
+    def test_room_creation_resolves_emails_in_one_query(self):
+        emails = [user.email for user in self.team]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/chat/rooms/', {
+                'name': 'Team', 'room_type': 'group', 'participant_emails': emails,
+            }, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['participant_count'], 21)
+        self.assertEqual(sum('"email" IN' in query['sql'] for query in queries), 1)
+
+    def test_room_creation_reports_every_missing_email(self):
+        response = self.client.post('/api/chat/rooms/', {
+            'name': 'Team', 'room_type': 'group',
+            'participant_emails': ['member0@example.com', 'nobody@example.com', 'ghost@example.com'],
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('nobody@example.com, ghost@example.com', str(response.data))
+
+    def test_add_participants_in_bulk(self):
+        room = self.create_room(self.alice, self.team[0])
+        emails = [user.email for user in self.team] + ['nobody@example.com']
+
+        def add():
+            return self.client.post(f'/api/chat/rooms/{room.id}/add_participants/', {'emails': emails}, format='json')
+
+        response = add()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['already_participants'], ['member0@example.com'])
+        self.assertEqual(len(response.data['added']), 19)
+        self.assertEqual(response.data['not_found'], ['nobody@example.com'])
+        self.assertEqual(response.data['room']['participant_count'], 21)
+
+        # Repeating the call is a fixed handful of queries, not one per email
+        with CaptureQueriesContext(connection) as queries:
+            add()
+        self.assertLessEqual(len(queries), 8)
+
+
+class DirectRoomTests(ChatTestMixin, APITestCase):
+    def setUp(self):
+        self.alice = self.create_user('alice@example.com')
+        self.bob = self.create_user('bob@example.com')
+        self.client.force_authenticate(self.alice)
+
+    def test_get_or_create_is_idempotent_in_both_directions(self):
+        self.assertEqual(self.client.get('/api/chat/rooms/direct/', {'email': 'bob@example.com'}).status_code, 404)
+
+        created = self.client.post('/api/chat/rooms/direct/', {'email': 'bob@example.com'})
+        self.assertEqual(created.status_code, 201)
+        self.assertEqual(created.data['participant_count'], 2)
+
+        self.client.force_authenticate(self.bob)
+        existing = self.client.post('/api/chat/rooms/direct/', {'email': 'alice@example.com'})
+        self.assertEqual((existing.status_code, existing.data['id']), (200, created.data['id']))
+        found = self.client.get('/api/chat/rooms/direct/', {'email': 'alice@example.com'})
+        self.assertEqual(found.data['id'], created.data['id'])
+
+    def test_room_creation_reuses_the_direct_room(self):
+        def create():
+            return self.client.post('/api/chat/rooms/', {
+                'room_type': 'direct', 'participant_emails': ['bob@example.com'],
+            }, format='json')
+
+        self.assertEqual(create().data['id'], create().data['id'])
+        self.assertEqual(Room.objects.filter(room_type='direct').count(), 1)
+
+    def test_room_type_is_fixed_once_created(self):
+        room = self.client.post('/api/chat/rooms/direct/', {'email': 'bob@example.com'}).data
+        response = self.client.patch(f'/api/chat/rooms/{room["id"]}/', {'room_type': 'group'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Room.objects.get(pk=room['id']).room_type, 'direct')
+        response = self.client.patch(f'/api/chat/rooms/{room["id"]}/', {'room_type': 'direct', 'name': 'Us'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_migration_merges_duplicate_direct_rooms(self):
+        merge = import_module('chat.migrations.0004_room_direct_key').merge_duplicate_direct_rooms
+        rooms = []
+        for _ in range(2):
+            room = Room.objects.create(room_type='direct', created_by=self.alice)
+            room.participants.add(self.alice, self.bob)
+            rooms.append(room)
+        first = Message.objects.create(room=rooms[0], sender=self.bob, content='first')
+        second = Message.objects.create(room=rooms[1], sender=self.bob, content='second')
+        ReadCursor.objects.create(user=self.alice, room=rooms[0], last_read_message_id=first.id)
+        ReadCursor.objects.create(user=self.alice, room=rooms[1], last_read_message_id=second.id)
+
+        merge(django_apps, None)
+
+        keeper = Room.objects.get(room_type='direct')
+        self.assertEqual(keeper.id, rooms[0].id)
+        self.assertEqual(keeper.direct_key, Room.direct_key_for(self.alice.id, self.bob.id))
+        self.assertEqual(keeper.messages.count(), 2)
+        self.assertEqual(ReadCursor.objects.get(user=self.alice, room=keeper).last_read_message_id, second.id)
+
+
+class TimerWheelTests(SimpleTestCase):
+    def test_keys_expire_once_their_deadline_passes(self):
+        wheel = TimerWheel(tick=1, slots=8)
+        wheel.advance(0)
+        wheel.schedule('a', 2.5)
+        wheel.schedule('b', 20)
+        wheel.schedule('c', 3)
+        wheel.cancel('c')
+
+        self.assertEqual(wheel.advance(2), [])
+        self.assertEqual(wheel.advance(3), ['a'])
+        # 'b' shares a slot with deadlines one revolution earlier
+        self.assertEqual(wheel.advance(12.5), [])
+        self.assertEqual(wheel.advance(21), ['b'])
+        self.assertEqual(len(wheel), 0)
+
+
+class PresenceTests(ChatTestMixin, APITestCase):
+    def setUp(self):
+        self.alice = self.create_user('alice@example.com')
+        self.bob = self.create_user('bob@example.com')
+        self.room = self.create_room(self.alice, self.bob)
+
+    async def test_user_goes_offline_after_last_tab_closes_or_times_out(self):
+        registry = PresenceRegistry(ttl=60)
+        registry.connect(1, 'alice')
+        registry.connect(1, 'alice')
+        registry.connect(1, 'bob')
+
+        registry.disconnect(1, 'alice')
+        self.assertTrue(registry.is_online(1, 'alice'))
+        registry.disconnect(1, 'alice')
+        self.assertFalse(registry.is_online(1, 'alice'))
+
+        registry.expire(time.monotonic() + 120)
+        self.assertEqual(registry.online_members(1), [])
+        self.assertEqual(dict(registry.pending[1]), {'alice': False, 'bob': False})
+        for task in registry._tasks:
+            task.cancel()
+
+    def test_remote_updates_are_applied_but_not_rebroadcast(self):
+        registry = PresenceRegistry()
+        registry.apply_remote({'origin': 'other', 'online': [[1, 'bob']], 'offline': []})
+        self.assertTrue(registry.is_online(1, 'bob'))
+        self.assertEqual(registry.pending, {})
+
+        registry.apply_remote({'origin': registry.origin, 'online': [[1, 'carol']], 'offline': []})
+        self.assertFalse(registry.is_online(1, 'carol'))
+        registry.apply_remote({'origin': 'other', 'online': [], 'offline': [[1, 'bob']]})
+        self.assertEqual(registry.online_members(1), [])
+
+    async def test_listener_stays_in_the_sync_group_past_group_expiry(self):
+        registry = PresenceRegistry(ttl=60, flush_interval=3600)
+        registry._ensure_started()
+        while registry._channel is None:
+            await asyncio.sleep(0)
+        layer = get_channel_layer()
+        later = time.time() + layer.group_expiry + 60
+
+        with mock.patch('channels.layers.time.time', return_value=later):
+            # The periodic announce renews the group membership...
+            await registry.flush()
+            # ...so a sync sent a day later still arrives
+            await layer.group_send('chat_presence', {
+                'type': 'presence.sync', 'origin': 'other', 'online': [[1, 'zed']], 'offline': [],
+            })
+            for _ in range(100):
+                if registry.is_online(1, 'zed'):
+                    break
+                await asyncio.sleep(0.01)
+        self.assertTrue(registry.is_online(1, 'zed'))
+        for task in registry._tasks:
+            task.cancel()
+
+    async def test_connect_sends_snapshot_and_broadcasts_changes(self):
+        alice = await self.connect(self.alice, self.room)
+        bob = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{self.room.id}/')
+        bob.scope['user'] = self.bob
+        bob.scope['url_route'] = {'kwargs': {'room_id': str(self.room.id)}}
+        await bob.connect()
+        await bob.receive_json_from()
+        snapshot = await bob.receive_json_from()
+        self.assertEqual((snapshot['type'], snapshot['online']), ('presence', sorted([self.alice.id, self.bob.id])))
+
+        await presence_registry.flush()
+        online = set()
+        while self.bob.id not in online:
+            frame = await alice.receive_json_from()
+            self.assertEqual((frame['type'], frame['snapshot']), ('presence', False))
+            online.update(frame['online'])
+
+        await bob.send_json_to({'type': 'heartbeat'})
+        frame = await bob.receive_json_from()
+        while frame['type'] == 'presence':
+            frame = await bob.receive_json_from()
+        self.assertEqual(frame, {'type': 'heartbeat_ack'})
+        await alice.disconnect()
+        await bob.disconnect()
+        self.assertFalse(presence_registry.is_online(self.room.id, self.bob.id))
+
+    def test_presence_endpoint(self):
+        self.client.force_authenticate(self.alice)
+        response = self.client.get(f'/api/chat/rooms/{self.room.id}/presence/')
+        self.assertEqual(response.data, {'room': self.room.id, 'online': []})
+
+        self.client.force_authenticate(self.create_user('carol@example.com'))
+        self.assertEqual(self.client.get(f'/api/chat/rooms/{self.room.id}/presence/').status_code, 404)
+
+
+class MultiplexConsumerTests(ChatTestMixin, TestCase):
+    def setUp(self):
+        self.alice = self.create_user('alice@example.com')
+        self.bob = self.create_user('bob@example.com')
+        self.room = self.create_room(self.alice, self.bob)
+        self.other = self.create_room(self.alice, self.bob, name='Other room')
+
+    async def connect_multiplexed(self, user):
+        communicator = WebsocketCommunicator(MultiplexChatConsumer.as_asgi(), '/ws/chat/')
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual((await communicator.receive_json_from())['type'], 'connection_established')
+        return communicator
+
+    async def receive(self, communicator):
+        """Next frame that isn't a presence update"""
+        frame = await communicator.receive_json_from()
+        while frame['type'] == 'presence':
+            frame = await communicator.receive_json_from()
+        return frame
+
+    async def subscribe(self, communicator, room, **extra):
+        await communicator.send_json_to({'type': 'subscribe', 'room': room.id, **extra})
+        self.assertEqual(await communicator.receive_json_from(), {'type': 'subscribed', 'room': room.id})
+        snapshot = await communicator.receive_json_from()
+        self.assertEqual((snapshot['type'], snapshot['room']), ('presence', room.id))
+
+    async def test_one_socket_carries_several_rooms(self):
+        alice = await self.connect_multiplexed(self.alice)
+        await self.subscribe(alice, self.room)
+        await self.subscribe(alice, self.other)
+        bob = await self.connect(self.bob, self.other)
+
+        await bob.send_json_to({'type': 'chat_message', 'message': 'over here'})
+        frame = await self.receive(alice)
+        self.assertEqual((frame['type'], frame['room']), ('chat_message', self.other.id))
+
+        await alice.send_json_to({'type': 'chat_message', 'room': self.other.id, 'message': 'hi bob'})
+        self.assertEqual((await self.receive(bob))['message']['content'], 'over here')
+        self.assertEqual((await self.receive(bob))['message']['content'], 'hi bob')
+        self.assertEqual((await self.receive(alice))['room'], self.other.id)
+
+        await alice.send_json_to({'type': 'unsubscribe', 'room': self.other.id})
+        self.assertEqual(await self.receive(alice), {'type': 'unsubscribed', 'room': self.other.id})
+        await bob.send_json_to({'type': 'chat_message', 'message': 'gone?'})
+        await self.receive(bob)
+        self.assertTrue(await alice.receive_nothing())
+
+        await alice.disconnect()
+        await bob.disconnect()
+        self.assertFalse(presence_registry.is_online(self.room.id, self.alice.id))
+
+    async def test_subscribe_syncs_missed_messages(self):
+        seen = await Message.objects.acreate(room=self.room, sender=self.bob, content='seen')
+        await Message.objects.acreate(room=self.room, sender=self.bob, content='missed')
+        alice = await self.connect_multiplexed(self.alice)
+        await self.subscribe(alice, self.room, last_seen_id=seen.id)
+
+        frame = await self.receive(alice)
+        self.assertEqual((frame['type'], frame['room']), ('sync', self.room.id))
+        self.assertEqual([m['content'] for m in frame['messages']], ['missed'])
+        await alice.disconnect()
+
+    async def test_rooms_must_be_joined_and_subscribed(self):
+        carol = await self.create_user_async('carol@example.com')
+        communicator = await self.connect_multiplexed(carol)
+
+        await communicator.send_json_to({'type': 'subscribe', 'room': self.room.id})
+        self.assertEqual(await communicator.receive_json_from(), {
+            'type': 'error', 'message': 'Room not found', 'room': self.room.id,
+        })
+        await communicator.send_json_to({'type': 'chat_message', 'room': self.room.id, 'message': 'hi'})
+        self.assertEqual((await communicator.receive_json_from())['message'], 'Not subscribed to this room')
+        await communicator.send_json_to({'type': 'chat_message', 'message': 'hi'})
+        self.assertEqual((await communicator.receive_json_from())['message'], "Frame needs a 'room' id")
+        await communicator.send_json_to({'type': 'subscribe', 'room': '²'})
+        self.assertEqual((await communicator.receive_json_from())['message'], "Frame needs a 'room' id")
+        self.assertFalse(await Message.objects.filter(room=self.room).aexists())
+        await communicator.disconnect()
+
+
+class NotificationTests(ChatTestMixin, APITestCase):
+    def setUp(self):
+        self.alice = self.create_user('alice@example.com')
+        self.bob = self.create_user('bob@example.com')
+        self.room = self.create_room(self.alice, self.bob)
+
+    def listen(self, user, *room_ids):
+        """A channel in the user's notification group and these rooms' groups"""
+        layer = get_channel_layer()
+        channel = async_to_sync(layer.new_channel)()
+        async_to_sync(layer.group_add)(f'user_{user.id}', channel)
+        for room_id in room_ids:
+            async_to_sync(layer.group_add)(f'room_notifications_{room_id}', channel)
+        return lambda: json.loads(async_to_sync(layer.receive)(channel)['payloads']['json'])
+
+    async def open_notifications(self, user):
+        notifications = WebsocketCommunicator(NotificationConsumer.as_asgi(), '/ws/notifications/')
+        notifications.scope['user'] = user
+        connected, _ = await notifications.connect()
+        self.assertTrue(connected)
+        return notifications
+
+    async def test_socket_receives_room_bumps(self):
+        notifications = await self.open_notifications(self.bob)
+        alice = await self.connect(self.alice, self.room)
+
+        layer = get_channel_layer()
+        with mock.patch.object(layer, 'group_send', wraps=layer.group_send) as group_send:
+            await alice.send_json_to({'type': 'chat_message', 'message': 'hello'})
+            frame = await notifications.receive_json_from()
+        self.assertEqual((frame['type'], frame['room']), ('room_bumped', self.room.id))
+        self.assertEqual(frame['last_message']['content'], 'hello')
+        # One send for the room's sockets and one for its notification sockets
+        self.assertEqual([call.args[0] for call in group_send.call_args_list], [
+            f'chat_{self.room.id}', f'room_notifications_{self.room.id}',
+        ])
+        await alice.disconnect()
+        await notifications.disconnect()
+
+    async def test_socket_follows_rooms_the_user_joins_and_leaves(self):
+        carol = await self.create_user_async('carol@example.com')
+        other_room = await database_sync_to_async(self.create_room)(self.alice, name='Other')
+        notifications = await self.open_notifications(carol)
+
+        await database_sync_to_async(other_room.participants.add)(carol)
+        await notify_users([carol.id], room_added_frame(other_room, 2), join_room=other_room.id)
+        self.assertEqual((await notifications.receive_json_from())['type'], 'room_added')
+        await notify_room(other_room.id, {'type': 'room_bumped', 'room': other_room.id})
+        self.assertEqual((await notifications.receive_json_from())['type'], 'room_bumped')
+
+        await database_sync_to_async(other_room.participants.remove)(carol)
+        await notify_room(other_room.id, {'type': 'room_bumped', 'room': other_room.id})
+        await notify_users([carol.id], {'type': 'marker'})
+        self.assertEqual((await notifications.receive_json_from())['type'], 'marker')
+        await notifications.disconnect()
+
+    def test_new_room_and_participants_are_pushed(self):
+        carol = self.create_user('carol@example.com')
+        bob_notifications = self.listen(self.bob)
+        carol_notifications = self.listen(carol)
+        self.client.force_authenticate(self.alice)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/chat/rooms/', {
+                'name': 'Plans', 'room_type': 'group', 'participant_emails': ['bob@example.com'],
+            }, format='json')
+        added = bob_notifications()
+        self.assertEqual((added['type'], added['room']['id']), ('room_added', response.data['id']))
+        self.assertEqual(added['room']['participant_count'], 2)
+
+        # Bob's socket now follows the room
+        bob_notifications = self.listen(self.bob, response.data['id'])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f'/api/chat/rooms/{response.data["id"]}/add_participant/', {'email': carol.email})
+        self.assertEqual(carol_notifications()['room']['id'], response.data['id'])
+        self.assertEqual(bob_notifications(), {
+            'type': 'participants_added', 'room': response.data['id'], 'user_ids': [carol.id], 'participant_count': 3,
+        })
+
+    def test_rest_messages_bump_the_room(self):
+        bob_notifications = self.listen(self.bob, self.room.id)
+        self.client.force_authenticate(self.alice)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/chat/messages/', {'room': self.room.id, 'content': 'over REST'})
+        frame = bob_notifications()
+        self.assertEqual((frame['type'], frame['last_message']['content']), ('room_bumped', 'over REST'))
+
+
+@override_settings(CHAT_WIRE_PROTOCOLS=['msgpack', 'json+deflate', 'msgpack+deflate'])
+class WireProtocolTests(ChatTestMixin, TestCase):
+    def setUp(self):
+        self.alice = self.create_user('alice@example.com')
+        self.bob = self.create_user('bob@example.com')
+        self.room = self.create_room(self.alice, self.bob)
+
+    async def open(self, user, query='', subprotocols=None):
+        communicator = WebsocketCommunicator(
+            ChatConsumer.as_asgi(), f'/ws/chat/{self.room.id}/?{query}', subprotocols=subprotocols
+        )
+        communicator.scope['user'] = user
+        communicator.scope['url_route'] = {'kwargs': {'room_id': str(self.room.id)}}
+        return communicator, await communicator.connect()
+
+    def test_every_protocol_round_trips_and_broadcasts_are_encoded_once_each(self):
+        frame = {'type': 'chat_message', 'room': 1, 'message': {'content': 'héllo ' * 50}}
+        payloads = encode_all(frame)
+        self.assertEqual(set(payloads), set(PROTOCOLS))
+        for name, protocol in PROTOCOLS.items():
+            self.assertEqual(protocol.decode(payloads[name]), frame)
+        self.assertLess(len(payloads['msgpack+deflate']), len(payloads['msgpack']))
+        with self.assertRaises(InvalidFrame):
+            PROTOCOLS['json+deflate'].decode(b'not deflate')
+
+    async def test_msgpack_subprotocol(self):
+        protocol = PROTOCOLS['msgpack']
+        alice, (connected, subprotocol) = await self.open(self.alice, subprotocols=['chat.msgpack', 'chat.json'])
+        self.assertEqual((connected, subprotocol), (True, 'chat.msgpack'))
+        self.assertEqual(protocol.decode(await alice.receive_from())['type'], 'connection_established')
+        self.assertEqual(protocol.decode(await alice.receive_from())['type'], 'presence')
+        bob = await self.connect(self.bob, self.room)
+
+        await alice.send_to(bytes_data=protocol.encode({'type': 'chat_message', 'message': 'packed'}))
+        self.assertEqual((await bob.receive_json_from())['message']['content'], 'packed')
+        echoed = protocol.decode(await alice.receive_from())
+        self.assertEqual((echoed['type'], echoed['message']['content']), ('chat_message', 'packed'))
+
+        await alice.send_to(bytes_data=b'\xc1')
+        self.assertEqual(protocol.decode(await alice.receive_from())['message'], 'Invalid msgpack frame')
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_deflate_by_query_parameter(self):
+        protocol = PROTOCOLS['json+deflate']
+        alice, (connected, subprotocol) = await self.open(self.alice, 'protocol=json%2Bdeflate')
+        self.assertEqual((connected, subprotocol), (True, None))
+        self.assertEqual(protocol.decode(await alice.receive_from())['type'], 'connection_established')
+        await alice.disconnect()
+
+    @override_settings(CHAT_WIRE_PROTOCOLS=[])
+    def test_only_json_is_encoded_unless_enabled(self):
+        self.assertEqual(list(encode_all({'type': 'typing'})), ['json'])
+
+    @override_settings(CHAT_WIRE_PROTOCOLS=['msgpack'])
+    async def test_unavailable_protocols_are_refused(self):
+        _, (connected, _) = await self.open(self.alice, 'protocol=msgpack+deflate')
+        self.assertFalse(connected)
+        _, (connected, _) = await self.open(self.alice, subprotocols=['chat.xml'])
+        self.assertFalse(connected)
+
+
+class RateLimitTests(ChatTestMixin, APITestCase):
+    def setUp(self):
+        self.alice = self.create_user('alice@example.com')
+        self.bob = self.create_user('bob@example.com')
+        self.room = self.create_room(self.alice, self.bob)
+
+    def test_token_buckets_refill_and_take_all_or_nothing(self):
+        limiter = RateLimiter([TokenBucketLimit('user', rate=1, burst=2), TokenBucketLimit('room', rate=1, burst=3)])
+        with mock.patch('chat.ratelimit.time.monotonic', return_value=100.0) as now:
+            limiter.take('ws', user=1, room=1)
+            limiter.take('ws', user=1, room=1)
+            with self.assertRaises(RateLimited) as raised:
+                limiter.take('ws', user=1, room=1)
+            self.assertEqual((raised.exception.limit, raised.exception.retry_after), ('user', 1.0))
+
+            # Another user still gets the room's last token, then the room is out
+            limiter.take('ws', user=2, room=1)
+            with self.assertRaises(RateLimited) as raised:
+                limiter.take('ws', user=3, room=1)
+            self.assertEqual(raised.exception.limit, 'room')
+            # ...and user 3's token wasn't taken
+            self.assertEqual(limiter.limits['user'].buckets.get(3)[0], 2)
+
+            now.return_value = 100.5
+            with self.assertRaises(RateLimited) as raised:
+                limiter.take('ws', user=1)
+            self.assertEqual(raised.exception.retry_after, 0.5)
+            now.return_value = 101.0
+            limiter.take('ws', user=1)
+
+            with self.assertRaises(RateLimited) as raised:
+                limiter.take('ws', cost=3, user=4)
+            self.assertIsNone(raised.exception.retry_after)
+        self.assertEqual(limiter.stats()['user_limited'], 3)
+
+    async def test_websocket_sends_over_the_limit_get_an_error(self):
+        alice = await self.connect(self.alice, self.room)
+        with mock.patch.multiple(rate_limiter.limits['message_user'], rate=0.01, burst=1):
+            await alice.send_json_to({'type': 'chat_message', 'message': 'first'})
+            self.assertEqual((await alice.receive_json_from())['type'], 'chat_message')
+            await alice.send_json_to({'type': 'chat_message', 'message': 'second'})
+            error = await alice.receive_json_from()
+            await alice.send_json_to({'type': 'chat_messages', 'messages': [{'message': 'third'}]})
+            batch_error = await alice.receive_json_from()
+
+        self.assertEqual(error['type'], 'error')
+        self.assertEqual((error['code'], error['limit'], error['room']), ('rate_limited', 'message_user', self.room.id))
+        self.assertGreater(error['retry_after'], 0)
+        self.assertEqual(batch_error['code'], 'rate_limited')
+        self.assertEqual(await Message.objects.filter(room=self.room).acount(), 1)
+        await alice.disconnect()
+
+    async def test_typing_repeats_the_throttle_drops_are_not_charged(self):
+        alice = await self.connect(self.alice, self.room)
+        limited = rate_limiter.limits['typing_user'].limited
+        with mock.patch.multiple(rate_limiter.limits['typing_user'], rate=0.01, burst=1):
+            for _ in range(10):
+                await alice.send_json_to({'type': 'typing', 'is_typing': True})
+            await alice.send_json_to({'type': 'heartbeat'})
+            self.assertEqual((await alice.receive_json_from())['type'], 'heartbeat_ack')
+        self.assertEqual(rate_limiter.limits['typing_user'].limited, limited)
+        await alice.disconnect()
+
+    def test_rest_sends_over_the_limit_get_429(self):
+        self.client.force_authenticate(self.alice)
+        with mock.patch.multiple(rate_limiter.limits['message_room'], rate=0.01, burst=1):
+            first = self.client.post('/api/chat/messages/', {'room': self.room.id, 'content': 'first'})
+            second = self.client.post('/api/chat/messages/', {'room': self.room.id, 'content': 'second'})
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(second.status_code, 429)
+        self.assertIn('Retry-After', second)
+        self.assertEqual(Message.objects.filter(room=self.room).count(), 1)
+
+    def test_rest_sends_are_charged_only_once_valid(self):
+        self.client.force_authenticate(self.alice)
+        with mock.patch.multiple(rate_limiter.limits['message_user'], rate=0.01, burst=1):
+            self.assertEqual(self.client.post('/api/chat/messages/', [1, 2], format='json').status_code, 400)
+            self.assertEqual(self.client.post('/api/chat/messages/', {'room': '²', 'content': 'x'}).status_code, 400)
+            self.assertEqual(self.client.post('/api/chat/messages/', {'room': self.room.id, 'content': ''}).status_code, 400)
+            response = self.client.post('/api/chat/messages/', {'room': self.room.id, 'content': 'valid'})
+        self.assertEqual(response.status_code, 201)
@@ -0,0 +1,105 @@
+import asyncio
+import time
+
+from django.conf import settings
+
+
+class TypingState:
+    __slots__ = ('last_broadcast', 'expiry_handle')
+
+    def __init__(self, last_broadcast, expiry_handle):
+        self.last_broadcast = last_broadcast
+        self.expiry_handle = expiry_handle
+
+
+class TypingThrottle:
+    """
+    Coalesces typing frames per (room, user) before they reach the channel layer.
+
+    A typing frame is broadcast only when it changes the user's state in the
+    room, or when the user is still typing and `refresh_interval` seconds
+    have passed since the last broadcast (so clients can time the indicator
+    out on their own). A user who stops sending frames is considered done
+    typing after `expiry` seconds and `on_expire` is called to announce it.
+    """
+
+    def __init__(self, refresh_interval=2.0, expiry=5.0):
+        self.refresh_interval = refresh_interval
+        self.expiry = expiry
+        self.states = {}
+        self.received = 0
+        self.broadcast = 0
+        self.suppressed = 0
+        self.expired = 0
+
+    def update(self, room_id, user_id, is_typing, on_expire):
+        """
+        Records a typing frame and returns whether it should be broadcast.
+        `on_expire` is a coroutine function, awaited if the state times out.
+        """
+        key = (room_id, user_id)
+        state = self.states.get(key)
+        self.received += 1
+
+        if not is_typing:
+            if state is None:
+                return self._suppress()
+            self.clear(room_id, user_id)
+            return self._broadcast()
+
+        loop = asyncio.get_running_loop()
+        now = time.monotonic()
+        handle = loop.call_later(self.expiry, self._expire, key, on_expire)
+        if state is None:
+            self.states[key] = TypingState(now, handle)
+            return self._broadcast()
+
+        state.expiry_handle.cancel()
+        state.expiry_handle = handle
+        if now - state.last_broadcast >= self.refresh_interval:
+            state.last_broadcast = now
+            return self._broadcast()
+        return self._suppress()
+
+    def would_broadcast(self, room_id, user_id, is_typing):
+        """Whether `update` would broadcast this frame, without recording it"""
+        state = self.states.get((room_id, user_id))
+        if not is_typing:
+            return state is not None
+        return state is None or time.monotonic() - state.last_broadcast >= self.refresh_interval
+
+    def clear(self, room_id, user_id):
+        """Forgets a user's typing state; returns whether they were typing"""
+        state = self.states.pop((room_id, user_id), None)
+        if state is None:
+            return False
+        state.expiry_handle.cancel()
+        return True
+
+    def _expire(self, key, on_expire):
+        if self.states.pop(key, None) is not None:
+            self.expired += 1
+            asyncio.ensure_future(on_expire())
+
+    def _broadcast(self):
+        self.broadcast += 1
+        return True
+
+    def _suppress(self):
+        self.suppressed += 1
+        return False
+
+    def stats(self):
+        return {
+            'typing_users': len(self.states),
+            'received': self.received,
+            'broadcast': self.broadcast,
+            'suppressed': self.suppressed,
+            'expired': self.expired,
+        }
+
+
+typing_throttle = TypingThrottle(
+    refresh_interval=settings.CHAT_TYPING_REFRESH_INTERVAL,
+    expiry=settings.CHAT_TYPING_EXPIRY,
+)
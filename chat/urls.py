@@ -1,16 +1,22 @@
 from django.urls import path
 from .views import (
     RoomViewSet, 
-    MessageViewSet
+    MessageViewSet,
+    MessageSearchViewSet,
     )
 
 urlpatterns = [
     # Room endpoints
     path('rooms/', RoomViewSet.as_view({'get': 'list', 'post': 'create'}), name='room-list'),
+    path('rooms/direct/', RoomViewSet.as_view({'get': 'direct', 'post': 'direct'}), name='room-direct'),
     path('rooms/<int:pk>/', RoomViewSet.as_view({'get': 'retrieve', 'put': 'update', 'patch': 'partial_update', 'delete': 'destroy'}), name='room-detail'),
     path('rooms/<int:pk>/add_participant/', RoomViewSet.as_view({'post': 'add_participant'}), name='room-add-participant'),
+    path('rooms/<int:pk>/add_participants/', RoomViewSet.as_view({'post': 'add_participants'}), name='room-add-participants'),
+    path('rooms/<int:pk>/presence/', RoomViewSet.as_view({'get': 'presence'}), name='room-presence'),
+    path('rooms/<int:pk>/mark_read/', RoomViewSet.as_view({'post': 'mark_read'}), name='room-mark-read'),
     
     # Message endpoints
     path('messages/', MessageViewSet.as_view({'get': 'list', 'post': 'create'}), name='message-list'),
     path('messages/<int:pk>/', MessageViewSet.as_view({'get': 'retrieve'}), name='message-detail'),
+    path('search/', MessageSearchViewSet.as_view({'get': 'list'}), name='message-search'),
 ]
\ No newline at end of file
@@ -1,23 +1,42 @@
 from rest_framework import viewsets, permissions, status
-from rest_framework.exceptions import PermissionDenied
+from rest_framework.exceptions import PermissionDenied, Throttled, ValidationError
 from rest_framework.response import Response
 from rest_framework.decorators import action
-from drf_spectacular.utils import extend_schema_view, extend_schema
+from drf_spectacular.utils import extend_schema_view, extend_schema, OpenApiParameter
 from django.shortcuts import render, get_object_or_404
+from django.utils import timezone
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db.models import Count, Max, OuterRef, Prefetch, Subquery, Sum
+from django.db.models.functions import Coalesce
 
 
 from account.responseSerializers import ErrorResponseSerializer
 
+from .cache import membership_cache
+from .conditional import ConditionalGetMixin
 from .models import (
     Message, 
+    ReadCursor,
     Room
 )
 from .serializers import( 
     MessageSerializer, 
     RoomSerializer,
     AddParticipantSerializer,
+    AddParticipantsSerializer,
+    AddParticipantsResultSerializer,
+    DirectRoomSerializer,
+    PresenceSerializer,
+    resolve_participant_emails,
+    MarkReadSerializer,
 )
+from .notifications import notify_participants_added, notify_room_added_on_commit, notify_room_bumped_on_commit
+from .pagination import MessageKeysetPagination
+from .presence import presence_registry
+from .ratelimit import RateLimited, rate_limiter
+from .search import get_search_backend
+from .writer import message_writer
 
 
 User = get_user_model()
@@ -26,12 +45,21 @@ User = get_user_model()
 @extend_schema_view(
     list=extend_schema(
         summary="List User's Rooms",
-        description="Retrieve all chat rooms where the authenticated user is a participant.",
+        description=(
+            "Retrieve all chat rooms where the authenticated user is a participant. "
+            "Pass 'include=last_message,unread_count' to add a last message preview and unread count per room."
+        ),
+        parameters=[
+            OpenApiParameter('include', str, description="Comma separated extras: last_message, unread_count"),
+        ],
         responses={200: RoomSerializer(many=True), 403: ErrorResponseSerializer}
     ),
     retrieve=extend_schema(
         summary="Get Room Details",
-        description="Retrieve detailed information about a specific room.",
+        description="Retrieve detailed information about a specific room. Accepts the same 'include' parameter as the list.",
+        parameters=[
+            OpenApiParameter('include', str, description="Comma separated extras: last_message, unread_count"),
+        ],
         responses={200: RoomSerializer, 404: ErrorResponseSerializer}
     ),
     create=extend_schema(
@@ -58,7 +86,7 @@ User = get_user_model()
         responses={204: None, 404: ErrorResponseSerializer}
     )
 )
-class RoomViewSet(viewsets.ModelViewSet):
+class RoomViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     """
     ViewSet for managing chat rooms.
     
@@ -69,15 +97,88 @@ class RoomViewSet(viewsets.ModelViewSet):
     - Update room details
     - Delete rooms
     - Add participants
+
+    List and retrieve answer 304 Not Modified when the client's ETag (or,
+    for a single room, Last-Modified) still matches the user's rooms.
     """
     serializer_class = RoomSerializer
     permission_classes = [permissions.IsAuthenticated]
+    include_options = ('last_message', 'unread_count')
+
+    def get_includes(self):
+        value = self.request.query_params.get('include', '')
+        return {name for name in value.split(',') if name in self.include_options}
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['include'] = self.get_includes()
+        return context
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional('list', lambda: super(RoomViewSet, self).list(request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional('retrieve', lambda: super(RoomViewSet, self).retrieve(request, *args, **kwargs))
+
+    def get_validators(self, action):
+        # Every change a room listing shows bumps Room.updated_at: edits,
+        # new messages and membership changes (see chat/signals.py).
+        # Membership rows added or removed for this user change the count,
+        # and participants' profile edits their User.updated_at.
+        member_rooms = Room.participants.through.objects.filter(user=self.request.user).values('room_id')
+        rooms = Room.objects.filter(id__in=member_rooms)
+        if action == 'retrieve':
+            rooms = rooms.filter(pk=self.kwargs['pk'])
+        state = Room.participants.through.objects.filter(room__in=rooms).aggregate(
+            count=Count('room_id', distinct=True),
+            rooms_modified=Max('room__updated_at'),
+            members_modified=Max('user__updated_at'),
+        )
+        if action == 'retrieve' and not state['count']:
+            return None
+
+        parts = [state['count'], state['rooms_modified'], state['members_modified']]
+        if 'unread_count' in self.get_includes():
+            # Read cursors only move forward, so their sum changes on every read
+            parts.append(ReadCursor.objects.filter(
+                user=self.request.user, room__in=rooms
+            ).aggregate(total=Sum('last_read_message_id'))['total'])
+        if action == 'list':
+            # The newest of the user's rooms can go back in time when they
+            # leave it, so the list is only revalidated by ETag
+            return parts, None
+        return parts, max(state['rooms_modified'], state['members_modified'])
 
     def get_queryset(self):
-        # Only return rooms the user participates in
-        return Room.objects.filter(
-            participants=self.request.user
-        ).distinct()
+        # Only return rooms the user participates in. Filtering through a
+        # subquery keeps the participants join free for the count below.
+        user = self.request.user
+        member_rooms = Room.participants.through.objects.filter(user=user).values('room_id')
+        queryset = Room.objects.filter(id__in=member_rooms).annotate(
+            participant_count=Count('participants')
+        ).prefetch_related(
+            Prefetch('participants', queryset=User.objects.only('id', 'email', 'first_name', 'last_name'))
+        )
+
+        # Optional extras, each a constant number of queries for any number of rooms
+        includes = self.get_includes()
+        if 'last_message' in includes:
+            queryset = queryset.prefetch_related(Prefetch(
+                'messages',
+                queryset=Message.objects.select_related('sender').order_by('-created_at')[:1],
+                to_attr='latest_messages',
+            ))
+        if 'unread_count' in includes:
+            last_read = ReadCursor.objects.filter(
+                room=OuterRef('pk'), user=user
+            ).values('last_read_message_id')[:1]
+            unread = Message.objects.filter(
+                room=OuterRef('pk'), id__gt=OuterRef('last_read_message_id')
+            ).exclude(sender=user).order_by().values('room').annotate(count=Count('id')).values('count')
+            queryset = queryset.annotate(
+                last_read_message_id=Coalesce(Subquery(last_read), 0)
+            ).annotate(unread_count=Coalesce(Subquery(unread), 0))
+        return queryset
 
     def perform_create(self, serializer):
         serializer.save()
@@ -102,7 +203,7 @@ class RoomViewSet(viewsets.ModelViewSet):
         
         # Only creator or existing participants can add others (depending on your logic)
         # For now, let's say any participant can add others
-        if request.user not in room.participants.all():
+        if not membership_cache.is_member(room.id, request.user.id):
             raise PermissionDenied("You are not a participant in this room.")
 
         serializer = AddParticipantSerializer(data=request.data)
@@ -110,21 +211,151 @@ class RoomViewSet(viewsets.ModelViewSet):
             email = serializer.validated_data['email']
             user = get_object_or_404(User, email=email)
             
-            if user in room.participants.all():
+            if membership_cache.is_member(room.id, user.id):
                 return Response(
                     {"error": "User is already a participant."},
                     status=status.HTTP_400_BAD_REQUEST
                 )
             
             room.participants.add(user)
+            # Reload so the annotated count and prefetched participants are fresh
+            room = self.get_queryset().get(pk=room.pk)
+            notify_participants_added(room, [user.id], room.participant_count)
             return Response(RoomSerializer(room, context=context).data)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    @extend_schema(
+        summary="Get or create a direct message room",
+        description=(
+            "Finds the direct message room between the authenticated user and the user with 'email' "
+            "(query parameter for GET, body for POST). GET answers 404 if there is none yet; POST creates it "
+            "(201) or returns the existing one (200). Each pair of users has at most one direct room."
+        ),
+        parameters=[OpenApiParameter('email', str, description="The other participant (GET only)")],
+        request=DirectRoomSerializer,
+        responses={200: RoomSerializer, 201: RoomSerializer, 400: ErrorResponseSerializer, 404: ErrorResponseSerializer}
+    )
+    @action(detail=False, methods=['get', 'post'])
+    def direct(self, request):
+        data = request.query_params if request.method == 'GET' else request.data
+        serializer = DirectRoomSerializer(data=data)
+        serializer.is_valid(raise_exception=True)
+        other = get_object_or_404(User, email=serializer.validated_data['email'])
+        if other.id == request.user.id:
+            return Response(
+                {"error": "Cannot start a direct message with yourself."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        created = False
+        if request.method == 'POST':
+            room, created = Room.get_or_create_direct(request.user, other)
+            if created:
+                notify_room_added_on_commit([request.user.id, other.id], room, 2)
+        key = Room.direct_key_for(request.user.id, other.id)
+        room = get_object_or_404(self.get_queryset(), direct_key=key)
+        return Response(
+            self.get_serializer(room).data,
+            status=status.HTTP_201_CREATED if created else status.HTTP_200_OK
+        )
+
+    @extend_schema(
+        summary="Add participants to group in bulk",
+        description=(
+            "Adds every user matching 'emails' to a group room, resolving all emails in one query and inserting "
+            "the memberships in bulk. Reports which emails were added, were already participants or matched no user."
+        ),
+        request=AddParticipantsSerializer,
+        responses={200: AddParticipantsResultSerializer, 400: ErrorResponseSerializer, 403: ErrorResponseSerializer}
+    )
+    @action(detail=True, methods=['post'])
+    def add_participants(self, request, pk=None):
+        room = self.get_object()
+        if room.room_type != 'group':
+            return Response(
+                {"error": "Cannot add participants to a direct message room."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if not membership_cache.is_member(room.id, request.user.id):
+            raise PermissionDenied("You are not a participant in this room.")
+
+        serializer = AddParticipantsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        users, not_found = resolve_participant_emails(serializer.validated_data['emails'])
+
+        members = membership_cache.get_members(room.id)
+        new_users = [user for user in users if user.id not in members]
+        if new_users:
+            room.participants.add(*new_users)
+            room = self.get_queryset().get(pk=room.pk)
+            notify_participants_added(room, [user.id for user in new_users], room.participant_count)
+
+        return Response({
+            'room': RoomSerializer(room, context=self.get_serializer_context()).data,
+            'added': [user.email for user in new_users],
+            'already_participants': [user.email for user in users if user.id in members],
+            'not_found': not_found,
+        })
+
+    @extend_schema(
+        summary="Online room members",
+        description=(
+            "Ids of the room's participants who currently have the room open, from the in-memory presence "
+            "registry. Live changes are pushed over the room's WebSocket as 'presence' frames."
+        ),
+        responses={200: PresenceSerializer, 404: ErrorResponseSerializer}
+    )
+    @action(detail=True, methods=['get'])
+    def presence(self, request, pk=None):
+        # Membership from the cache, so this never queries the database
+        if not membership_cache.is_member(pk, request.user.id):
+            return Response({"error": "Room not found."}, status=status.HTTP_404_NOT_FOUND)
+        return Response({'room': int(pk), 'online': presence_registry.online_members(pk)})
+
+    @extend_schema(
+        summary="Mark room as read",
+        description=(
+            "Marks every message in the room up to 'message_id' as read for the authenticated user, "
+            "in a single write. Without 'message_id' the whole room is marked read. The read cursor never moves backwards."
+        ),
+        request=MarkReadSerializer,
+        responses={200: MarkReadSerializer, 400: ErrorResponseSerializer, 404: ErrorResponseSerializer}
+    )
+    @action(detail=True, methods=['post'])
+    def mark_read(self, request, pk=None):
+        room = self.get_object()
+        serializer = MarkReadSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        last_read = ReadCursor.mark_read(request.user, room.id, serializer.validated_data.get('message_id'))
+        if last_read is None:
+            return Response(
+                {"error": "Message not found in this room."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response({
+            'room': room.id,
+            'last_read_message_id': last_read,
+            'unread_count': ReadCursor.unread_count(request.user, room.id),
+        })
+
 @extend_schema_view(
     list=extend_schema(
         summary="List Messages",
-        description="Retrieve messages from a specific room. Use 'room' query parameter to filter by room ID.",
+        description=(
+            "Retrieve messages from a specific room, newest first. Use 'room' query parameter to filter by room ID. "
+            "Results are paginated by message id: pass 'before' for older messages, 'after' for newer ones "
+            "and 'page_size' (max 200) to bound the page. Pass 'since' to only list messages newer than "
+            "a message id, e.g. the last one a client saw before going offline."
+        ),
+        parameters=[
+            OpenApiParameter('room', int, required=True),
+            OpenApiParameter('since', int, description="Only messages with an id greater than this"),
+            OpenApiParameter('before', int, description="Return messages older than this message id"),
+            OpenApiParameter('after', int, description="Return messages newer than this message id"),
+            OpenApiParameter('page_size', int, description="Number of messages per page (default 50, max 200)"),
+        ],
         responses={200: MessageSerializer(many=True), 403: ErrorResponseSerializer}
     ),
     retrieve=extend_schema(
@@ -139,35 +370,143 @@ class RoomViewSet(viewsets.ModelViewSet):
         responses={201: MessageSerializer, 400: ErrorResponseSerializer, 403: ErrorResponseSerializer}
     )
 )
-class MessageViewSet(viewsets.ModelViewSet):
+class MessageViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     """
     ViewSet for managing chat messages.
     
     Handles:
-    - List messages in a room (filtered by 'room' query parameter)
+    - List messages in a room (filtered by 'room' query parameter, keyset paginated)
     - Retrieve a specific message
     - Send new messages
+
+    Listing answers 304 Not Modified while the room's newest message and
+    `updated_at` are unchanged. Sending shares the WebSocket path's rate
+    limits and answers 429 with Retry-After when over them.
     """
     serializer_class = MessageSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = MessageKeysetPagination
     http_method_names = ['get', 'post', 'head', 'options']  # No update or delete
 
+    def list(self, request, *args, **kwargs):
+        return self.conditional('list', lambda: super(MessageViewSet, self).list(request, *args, **kwargs))
+
+    def get_validators(self, action):
+        room_id = self.request.query_params.get('room')
+        if not room_id or not room_id.isdecimal():
+            return None
+        if not membership_cache.is_member(room_id, self.request.user.id):
+            return None
+        latest_message = Message.objects.filter(room=OuterRef('pk')).order_by('-id').values('id')[:1]
+        # Messages show their senders' names
+        members_modified = Room.participants.through.objects.filter(
+            room=OuterRef('pk')
+        ).order_by().values('room').annotate(latest=Max('user__updated_at')).values('latest')
+        state = Room.objects.filter(pk=room_id).annotate(
+            latest_message_id=Subquery(latest_message),
+            members_modified=Subquery(members_modified),
+        ).values_list('updated_at', 'latest_message_id', 'members_modified').first()
+        if state is None:
+            return None
+        updated_at, latest_message_id, members_modified = state
+        return state, max(updated_at, members_modified or updated_at)
+
     def get_queryset(self):
         room_id = self.request.query_params.get('room')
-        if not room_id:
+        if not room_id or not room_id.isdecimal():
+            return Message.objects.none()
+        if not membership_cache.is_member(room_id, self.request.user.id):
             return Message.objects.none()
         
-        return Message.objects.filter(
-            room_id=room_id,
-            room__participants=self.request.user
+        queryset = Message.objects.filter(
+            room_id=room_id
         ).select_related('sender', 'room').order_by('-created_at')
 
+        since = self.request.query_params.get('since')
+        if since:
+            if not since.isdecimal():
+                raise ValidationError({'since': ['Must be a message id.']})
+            queryset = queryset.filter(id__gt=since)
+        return queryset
+
     def perform_create(self, serializer):
         room = serializer.validated_data['room']
-        if not room.participants.filter(id=self.request.user.id).exists():
+        if not membership_cache.is_member(room.id, self.request.user.id):
             raise PermissionDenied("You are not a participant in this room")
-        serializer.save(sender=self.request.user)
+        # Charged once the message is valid, as on the WebSocket path
+        try:
+            rate_limiter.take_messages('http', self.request.user.id, room.id)
+        except RateLimited as e:
+            raise Throttled(wait=e.retry_after)
+        if settings.CHAT_WRITE_BEHIND:
+            # Same writer thread as the WebSocket path, which also bumps the room
+            serializer.instance = message_writer.submit_sync(
+                room.id, self.request.user, serializer.validated_data['content']
+            )
+        else:
+            serializer.save(sender=self.request.user)
+            # Like the WebSocket path, so the room's validators change
+            Room.objects.filter(pk=room.pk).update(updated_at=timezone.now())
+        notify_room_bumped_on_commit(room.id, serializer.instance)
+
+
+@extend_schema_view(
+    list=extend_schema(
+        summary="Search Messages",
+        description=(
+            "Full-text search over messages in the rooms the authenticated user participates in, "
+            "best match first. The last search term also matches as a prefix. "
+            "Page through results with 'offset' and 'page_size' (max 100)."
+        ),
+        parameters=[
+            OpenApiParameter('q', str, required=True, description="Search terms"),
+            OpenApiParameter('room', int, description="Only search this room"),
+            OpenApiParameter('offset', int, description="Number of results to skip"),
+            OpenApiParameter('page_size', int, description="Number of results per page (default 20, max 100)"),
+        ],
+        responses={200: MessageSerializer(many=True), 400: ErrorResponseSerializer}
+    ),
+)
+class MessageSearchViewSet(viewsets.GenericViewSet):
+    """
+    Full-text message search, scoped to the caller's rooms.
+
+    Matching and ranking are done by the configured search backend (see
+    chat/search.py), which on SQLite uses the FTS5 index instead of scanning
+    every message with LIKE.
+    """
+    serializer_class = MessageSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    page_size = 20
+    max_page_size = 100
+
+    def list(self, request):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            raise ValidationError({'q': ['This parameter is required.']})
+        room_id = self.get_int_param('room')
+        offset = self.get_int_param('offset') or 0
+        page_size = max(1, min(self.get_int_param('page_size') or self.page_size, self.max_page_size))
+
+        # Fetch one extra result to know whether another page exists
+        messages = get_search_backend().search(
+            request.user, query, limit=page_size + 1, offset=offset, room_id=room_id
+        )
+        has_more = len(messages) > page_size
+        messages = messages[:page_size]
+        return Response({
+            'results': self.get_serializer(messages, many=True).data,
+            'has_more': has_more,
+            'next_offset': offset + page_size if has_more else None,
+        })
 
+    def get_int_param(self, name):
+        value = self.request.query_params.get(name)
+        if value in (None, ''):
+            return None
+        if not value.isdecimal():
+            raise ValidationError({name: ['Must be a non-negative integer.']})
+        return int(value)
 
 
 def login_page(request):
@@ -0,0 +1,175 @@
+import asyncio
+import atexit
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.db import connection, transaction, DatabaseError
+from django.utils import timezone
+
+from chat.models import Room, Message
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class MessageWriter:
+    """
+    Write-behind persistence for chat messages on one dedicated thread.
+
+    Messages submitted by consumers and REST requests are queued and
+    committed by a single writer thread in batches (group commit): one bulk
+    INSERT for the messages and one UPDATE bumping `updated_at` for every
+    room touched by the batch. A batch is committed when it reaches
+    `max_batch_size` messages or `max_delay` seconds after its first
+    message, whichever comes first; whatever queues up while a batch is
+    committing goes into the next one. With SQLite this keeps message
+    inserts from contending with each other for the database lock.
+
+    Batches are committed strictly in submission order and each submission
+    resolves once its message is committed, so callers broadcast only
+    persisted messages (with their ids) and in the order they were written.
+    Anything still queued when the process exits is committed before the
+    thread stops.
+    """
+
+    def __init__(self, max_batch_size=100, max_delay=0.05):
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.queue = queue.Queue()
+        self.flushes = 0
+        self.messages_written = 0
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def submit_nowait(self, room_id, sender, content):
+        """Queue a message; returns a Future resolving to the saved Message"""
+        self._ensure_started()
+        future = Future()
+        self.queue.put((Message(room_id=room_id, sender=sender, content=content), future))
+        return future
+
+    async def submit(self, room_id, sender, content):
+        """Queue a message and wait until it has been committed"""
+        return await asyncio.wrap_future(self.submit_nowait(room_id, sender, content))
+
+    def submit_sync(self, room_id, sender, content):
+        """Blocking variant for sync callers such as REST views"""
+        return self.submit_nowait(room_id, sender, content).result()
+
+    async def submit_many(self, room_id, sender, contents):
+        """
+        Queue several messages in order and wait for all of them. Returns one
+        result per message: the saved Message or the exception that stopped it.
+        """
+        futures = [self.submit_nowait(room_id, sender, content) for content in contents]
+        return await asyncio.gather(*map(asyncio.wrap_future, futures), return_exceptions=True)
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                thread = threading.Thread(target=self._run, name='chat-message-writer', daemon=True)
+                thread.start()
+                self._thread = thread
+
+    def close(self):
+        """Commit whatever is still queued and stop the writer thread"""
+        with self._start_lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self.queue.put(_STOP)
+            thread.join()
+
+    def _run(self):
+        try:
+            while True:
+                batch, stop = self._next_batch()
+                if batch:
+                    self._commit(batch)
+                if stop:
+                    return
+        finally:
+            connection.close()
+
+    def _next_batch(self):
+        """Blocks for a first message, then collects more until full or due"""
+        item = self.queue.get()
+        if item is _STOP:
+            return [], True
+        batch = [item]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch_size:
+            try:
+                item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _commit(self, batch):
+        try:
+            results = self.write_batch([message for message, _ in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def write_batch(self, messages):
+        """
+        Persist a batch and return one result per message: the saved
+        Message, or the exception that prevented it from being saved.
+        """
+        try:
+            with transaction.atomic():
+                Message.objects.bulk_create(messages)
+                self.bump_rooms(messages)
+        except DatabaseError:
+            # A bad row (e.g. a room deleted meanwhile) must not sink the
+            # whole batch: retry one by one and report per message.
+            logger.warning("Batched message insert failed, retrying individually", exc_info=True)
+            return [self.write_one(message) for message in messages]
+
+        self.flushes += 1
+        self.messages_written += len(messages)
+        return messages
+
+    def write_one(self, message):
+        try:
+            with transaction.atomic():
+                message.pk = None
+                message.save(force_insert=True)
+                self.bump_rooms([message])
+        except DatabaseError as e:
+            return e
+        self.messages_written += 1
+        return message
+
+    def bump_rooms(self, messages):
+        room_ids = {message.room_id for message in messages}
+        Room.objects.filter(id__in=room_ids).update(updated_at=timezone.now())
+
+    def stats(self):
+        return {
+            'pending': self.queue.qsize(),
+            'flushes': self.flushes,
+            'messages_written': self.messages_written,
+        }
+
+
+message_writer = MessageWriter(
+    max_batch_size=settings.CHAT_WRITE_BEHIND_BATCH_SIZE,
+    max_delay=settings.CHAT_WRITE_BEHIND_MAX_DELAY,
+)
+
+atexit.register(message_writer.close)
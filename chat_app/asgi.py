@@ -21,12 +21,15 @@ django_asgi_app = get_asgi_application()
 
 from chat.routing import websocket_urlpatterns
 from chat.middleware import JWTAuthMiddleware  # Add this import
+from chat.metrics import WebSocketMetricsMiddleware
 
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
     "websocket": AllowedHostsOriginValidator(
-        JWTAuthMiddleware(  # Replace AuthMiddlewareStack with this
-            URLRouter(websocket_urlpatterns)
+        WebSocketMetricsMiddleware(
+            JWTAuthMiddleware(  # Replace AuthMiddlewareStack with this
+                URLRouter(websocket_urlpatterns)
+            )
         )
     ),
 })
\ No newline at end of file
@@ -70,7 +70,105 @@ CHANNEL_LAYERS = {
     }
 }
 
+# Running several daphne processes on one machine: fan group messages out
+# between them through a Unix socket (see chat/layers.py).
+if os.environ.get('CHANNEL_LAYER_SOCKET'):
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'chat.layers.UnixSocketChannelLayer',
+            'CONFIG': {
+                'path': os.environ['CHANNEL_LAYER_SOCKET'],
+            },
+        }
+    }
+
+# Write-behind message persistence (see chat/writer.py). When enabled,
+# messages from ChatConsumer and the REST API are committed by one writer
+# thread in batches of up to CHAT_WRITE_BEHIND_BATCH_SIZE or every
+# CHAT_WRITE_BEHIND_MAX_DELAY seconds.
+CHAT_WRITE_BEHIND = os.environ.get('CHAT_WRITE_BEHIND', 'False') == 'True'
+CHAT_WRITE_BEHIND_BATCH_SIZE = int(os.environ.get('CHAT_WRITE_BEHIND_BATCH_SIZE', '100'))
+CHAT_WRITE_BEHIND_MAX_DELAY = float(os.environ.get('CHAT_WRITE_BEHIND_MAX_DELAY', '0.05'))
+
+# Process-local cache of room participant ids (see chat/cache.py)
+CHAT_MEMBERSHIP_CACHE_SIZE = int(os.environ.get('CHAT_MEMBERSHIP_CACHE_SIZE', '10000'))
+CHAT_MEMBERSHIP_CACHE_TTL = float(os.environ.get('CHAT_MEMBERSHIP_CACHE_TTL', '60'))
+
+# Typing indicators are re-broadcast at most every CHAT_TYPING_REFRESH_INTERVAL
+# seconds per user and room, and expire CHAT_TYPING_EXPIRY seconds after the
+# last typing frame (see chat/typing_indicators.py).
+CHAT_TYPING_REFRESH_INTERVAL = float(os.environ.get('CHAT_TYPING_REFRESH_INTERVAL', '2'))
+CHAT_TYPING_EXPIRY = float(os.environ.get('CHAT_TYPING_EXPIRY', '5'))
+
+# Per-connection outbound frame queue (see chat/outbound.py). On overflow,
+# typing frames are dropped first; then 'disconnect' closes the slow client
+# while 'drop_oldest' discards its oldest queued message.
+CHAT_OUTBOUND_QUEUE_SIZE = int(os.environ.get('CHAT_OUTBOUND_QUEUE_SIZE', '256'))
+CHAT_OUTBOUND_OVERFLOW_POLICY = os.environ.get('CHAT_OUTBOUND_OVERFLOW_POLICY', 'disconnect')
+
+# Users resolved from WebSocket JWTs are cached per process (see chat/middleware.py)
+CHAT_AUTH_CACHE_SIZE = int(os.environ.get('CHAT_AUTH_CACHE_SIZE', '10000'))
+CHAT_AUTH_CACHE_TTL = float(os.environ.get('CHAT_AUTH_CACHE_TTL', '300'))
+
+# Dotted path of the message search backend (see chat/search.py). Empty picks
+# the FTS5 index on SQLite and an unindexed substring search elsewhere.
+CHAT_SEARCH_BACKEND = os.environ.get('CHAT_SEARCH_BACKEND', '')
+
+# Reconnecting clients that pass ?last_seen_id= get the messages they missed
+# over the socket in chunks of CHAT_SYNC_CHUNK_SIZE; past CHAT_SYNC_MAX_MESSAGES
+# they're told to reload the history over REST instead.
+CHAT_SYNC_CHUNK_SIZE = int(os.environ.get('CHAT_SYNC_CHUNK_SIZE', '100'))
+CHAT_SYNC_MAX_MESSAGES = int(os.environ.get('CHAT_SYNC_MAX_MESSAGES', '1000'))
+
+# Presence (see chat/presence.py): a user drops offline CHAT_PRESENCE_TTL
+# seconds after their last heartbeat; clients are told to send one every
+# CHAT_PRESENCE_HEARTBEAT_INTERVAL seconds. Changes are broadcast in batches
+# every CHAT_PRESENCE_FLUSH_INTERVAL seconds.
+CHAT_PRESENCE_TTL = float(os.environ.get('CHAT_PRESENCE_TTL', '60'))
+CHAT_PRESENCE_HEARTBEAT_INTERVAL = float(os.environ.get('CHAT_PRESENCE_HEARTBEAT_INTERVAL', '25'))
+CHAT_PRESENCE_FLUSH_INTERVAL = float(os.environ.get('CHAT_PRESENCE_FLUSH_INTERVAL', '1'))
+
+# Rooms one socket on the multiplexed ws/chat/ endpoint may subscribe to
+CHAT_MAX_SUBSCRIPTIONS = int(os.environ.get('CHAT_MAX_SUBSCRIPTIONS', '500'))
+
+# Most messages one chat_messages frame may carry
+CHAT_MAX_BATCH_MESSAGES = int(os.environ.get('CHAT_MAX_BATCH_MESSAGES', '100'))
+
+# Token bucket rate limits (see chat/ratelimit.py): sustained rate per second
+# and burst size, per user and per room, on the WebSocket and REST paths.
+# A rate of 0 turns a limit off. CHAT_RATE_LIMIT_BUCKETS bounds the buckets
+# kept per limit.
+CHAT_MESSAGE_RATE_PER_USER = float(os.environ.get('CHAT_MESSAGE_RATE_PER_USER', '5'))
+CHAT_MESSAGE_BURST_PER_USER = int(os.environ.get('CHAT_MESSAGE_BURST_PER_USER', '100'))
+CHAT_MESSAGE_RATE_PER_ROOM = float(os.environ.get('CHAT_MESSAGE_RATE_PER_ROOM', '50'))
+CHAT_MESSAGE_BURST_PER_ROOM = int(os.environ.get('CHAT_MESSAGE_BURST_PER_ROOM', '500'))
+CHAT_TYPING_RATE_PER_USER = float(os.environ.get('CHAT_TYPING_RATE_PER_USER', '5'))
+CHAT_TYPING_BURST_PER_USER = int(os.environ.get('CHAT_TYPING_BURST_PER_USER', '20'))
+CHAT_RATE_LIMIT_BUCKETS = int(os.environ.get('CHAT_RATE_LIMIT_BUCKETS', '100000'))
+
+# WebSocket encodings clients may negotiate besides JSON (see chat/protocols.py),
+# e.g. 'msgpack,json+deflate,msgpack+deflate'. Every broadcast is encoded once
+# per enabled protocol, so only JSON is on unless listed here.
+CHAT_WIRE_PROTOCOLS = [
+    name.strip() for name in
+    os.environ.get('CHAT_WIRE_PROTOCOLS', '').split(',')
+    if name.strip()
+]
+CHAT_WIRE_DEFLATE_LEVEL = int(os.environ.get('CHAT_WIRE_DEFLATE_LEVEL', '6'))
+# Largest client frame accepted once inflated, in bytes
+CHAT_WIRE_MAX_FRAME_SIZE = int(os.environ.get('CHAT_WIRE_MAX_FRAME_SIZE', '65536'))
+
+# Clients allowed to scrape /metrics/ (see chat/metrics.py), comma separated
+CHAT_METRICS_ALLOWED_NETWORKS = [
+    network.strip()
+    for network in os.environ.get('CHAT_METRICS_ALLOWED_NETWORKS', '127.0.0.0/8,::1/128').split(',')
+    if network.strip()
+]
+# Connections with the deepest outbound queues exported per channel
+CHAT_METRICS_SLOWEST_CONNECTIONS = int(os.environ.get('CHAT_METRICS_SLOWEST_CONNECTIONS', '10'))
+
 MIDDLEWARE = [
+    'chat.metrics.MetricsMiddleware',  # Latency and query counts per view
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',  # Add Whitenoise for static files
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -113,6 +211,23 @@ DATABASES = {
     }
 }
 
+# SQLite tuned for many readers and one writer: WAL lets reads run while a
+# write commits, writers wait up to SQLITE_BUSY_TIMEOUT seconds for the lock
+# instead of failing with "database is locked", and IMMEDIATE transactions
+# take the write lock up front so they can't deadlock upgrading from a read.
+# synchronous=NORMAL is durable across application crashes in WAL mode; only
+# an OS crash or power loss can lose the last commits.
+if os.environ.get('SQLITE_WAL', 'True') == 'True':
+    DATABASES['default']['OPTIONS'] = {
+        'init_command': (
+            'PRAGMA journal_mode=WAL;'
+            'PRAGMA synchronous=NORMAL;'
+            f"PRAGMA mmap_size={int(os.environ.get('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))};"
+        ),
+        'transaction_mode': 'IMMEDIATE',
+        'timeout': float(os.environ.get('SQLITE_BUSY_TIMEOUT', '20')),
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -17,6 +17,8 @@ from django.contrib import admin
 from django.urls import path, include
 from drf_spectacular.views import SpectacularAPIView, SpectacularSwaggerView
 
+from chat.metrics import metrics_view
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/account/', include('account.urls')),
@@ -26,4 +28,7 @@ urlpatterns = [
     # API Documentation
     path('api/schema/', SpectacularAPIView.as_view(), name='schema'),
     path('api/docs/', SpectacularSwaggerView.as_view(url_name='schema'), name='swagger-ui'),
+
+    # Prometheus metrics, internal networks only
+    path('metrics/', metrics_view, name='metrics'),
 ]